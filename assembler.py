@@ -3,23 +3,31 @@ Tiny-ASM preprocessor and assembler.
 
 Supported instructions described at http://redd.it/1kqxz9.
 """
+import objfile
+from config import WORD_SIZE
 from exc import *
-from helpers import debug, fatal_error
+from helpers import fatal_error
 from opcodes import instructions, ADDRESS, LITERAL
-from preprocessor import Line, preprocess
+from preprocessor import Line, preprocess, prepare_source_code
+from preprocessor.imports import imported_files
+from sourcemap import SourceMap
 
 
 ###############################################################################
 # SMALL HELPERS
 ###############################################################################
 
-def to_hex(s):
+def to_int(s):
     try:
-        return '0x%02x' % (int(s),)
+        return int(s)
     except ValueError:
         raise InvalidArgumentError('Not an hex integer: {}'.format(s))
 
 
+def to_hex(s):
+    return '0x%02x' % (to_int(s),)
+
+
 def is_address(s):
     """ Check, wether the given argument represents an address """
     return s[0] == '['
@@ -34,92 +42,224 @@ def get_arg_type(t):
 # ASSEMBLER
 ###############################################################################
 
-def assemble(code):
+def build_signatures():
+    """
+    Map every mnemonic to its number of arguments and its opcodes by
+    argument kinds, which are True for addresses and False for literals
+    (see `is_address`).
+
+    :rtype: dict[str, (int, dict[tuple, str])]
+    """
+    signatures = {}
+
+    for mnem, opcodes in instructions.items():
+        num_args = len(next(iter(opcodes.values())))
+        signatures[mnem] = num_args, dict(
+            (tuple(arg_type is ADDRESS for arg_type in arg_types), opcode)
+            for opcode, arg_types in opcodes.items()
+        )
+
+    return signatures
+
+
+signatures = build_signatures()
+
+
+def assemble_instructions(code, source_map=None):
     """
+    Assemble the preprocessed code into (opcode, arguments) pairs.
+
     :type code: list[Line]
+    :param source_map: if given, the source line of every instruction is
+                       added to it
+    :type source_map: sourcemap.SourceMap
     """
     assert isinstance(code, list)
-
-    hexcode = []
+    address = 0
 
     for line in code:
-        iterator = iter(line.contents.split())
+        iterator = iter(line.tokens)
 
         for mnem in iterator:
-            debug('Processing token:', mnem)
-
             # Look up token in instructions list
             try:
-                instruction = instructions[mnem.upper()]
+                num_args, opcodes = signatures[mnem.upper()]
             except KeyError:
                 fatal_error('Unknown mnemonic: {}'.format(mnem),
                             UnknownMnemonicError, line)
-            debug('Instruction:', instruction)
-
-            # Get arguments, look up arg count from first opcode
-            opcode_def = list(instruction.values())[0]
-            num_args = len(opcode_def)
-            debug('Expected number of arguments:', num_args)
 
             arg_list = [next(iterator) for _ in range(num_args)]
-            arg_types = [get_arg_type(arg) for arg in arg_list]
-
-            debug('Arguments:', arg_list)
-            debug('Argument types:', arg_types)
 
             # Find matching instruction
-            opcode = None
-            for op in instruction:
-                # Check if the list of type arguments matches
-                opcode_args = instruction[op]
-                if opcode_args == tuple(arg_types):
-                    opcode = op
-
-            if opcode is None:
-                arg_str = ', '.join(t.name for t in arg_types)
+            try:
+                opcode = opcodes[tuple(is_address(arg) for arg in arg_list)]
+            except KeyError:
+                arg_str = ', '.join(get_arg_type(arg).upper()
+                                    for arg in arg_list)
                 msg = 'Unknown argument types for mnemonic {} and ' \
                       'given arguments: {}'.format(mnem, arg_str)
                 fatal_error(msg, AssemblerSyntaxError, line)
 
-            # Convert arguments to hex
+            # Convert arguments to ints
             # 1. Strip '[ ]'
-            arg_list = [arg.strip('[]') for arg in arg_list]
+            # 2. Convert to int
+            arg_list = [to_int(arg.strip('[]')) for arg in arg_list]
+
+            if source_map is not None:
+                source_map.add(address, line)
+            address += 1 + num_args
+
+            yield opcode, arg_list
+
 
-            # 2. Convert to hex
-            arg_list = [to_hex(arg) for arg in arg_list]
-            debug('Arguments (hex):', arg_list)
+def assemble(code, source_map=None):
+    """
+    Assemble the preprocessed code to hex code.
+
+    :type code: list[Line]
+    :param source_map: if given, filled with the source line of every
+                       instruction
+    """
+    hexcode = []
 
-            # Finally, create the opcode/hex string
-            hexcode.append('{} {}'.format(opcode, ' '.join(arg_list)).strip())
-            debug('')
+    for opcode, args in assemble_instructions(code, source_map):
+        # Create the opcode/hex string
+        arg_list = [to_hex(arg) for arg in args]
+        hexcode.append('{} {}'.format(opcode, ' '.join(arg_list)).strip())
 
     return ' '.join(hexcode)
 
 
-def assembler_to_hex(source_code, filename=None, preprocessor_only=False):
+def assemble_binary(code, symbols=None, source_map=None,
+                    word_size=WORD_SIZE):
+    """
+    Assemble the preprocessed code to an object file.
+
+    :type code: list[Line]
+    :type symbols: dict[str, int]
+    :type source_map: sourcemap.SourceMap
+    :param word_size: the word size the program is meant to run at
+    :rtype: bytes
+    """
+    tokens = []
+
+    for opcode, args in assemble_instructions(code, source_map):
+        tokens.append(int(opcode, 16))
+        tokens.extend(args)
+
+    return objfile.dumps(tokens, word_size, symbols=symbols,
+                         source_map=source_map)
+
+
+def assembler_to_hex(source_code, filename=None, preprocessor_only=False,
+                     cache=None, search_paths=(), symbols=None,
+                     source_map=None, optimize=False):
     """
     Convert a assembler program to `Tiny` machine code.
 
     Opcodes described at http://redd.it/1kqxz9
+
+    :type cache: cache.AssemblyCache
+    :param search_paths: directories to look up imported files in
+    :param symbols: if given, the label addresses are stored in this dict
+    :type symbols: dict[str, int]
+    :param source_map: if given, the source line of every instruction is
+                       added to it
+    :type source_map: sourcemap.SourceMap
+    :param optimize: remove code without effect, see
+                     `preprocessor.optimize.preprocessor_optimize`
+
+    The cache only keeps the hex code, so it isn't used if `symbols` or
+    a `source_map` are requested.
     """
+    filename = filename or '<input>'
+
+    if cache is not None and symbols is None and source_map is None and \
+            not preprocessor_only:
+        imports = imported_files(prepare_source_code(filename, source_code),
+                                 search_paths)
+        key = cache.key(source_code, filename, imports, optimize)
+        hexcode = cache.get(key)
 
-    code = preprocess(source_code, filename or '<input>')
+        if hexcode is None:
+            hexcode = assemble(preprocess(source_code, filename,
+                                          search_paths=search_paths,
+                                          optimize=optimize))
+            cache.put(key, hexcode)
+
+        return hexcode
+
+    code = preprocess(source_code, filename, symbols=symbols,
+                      search_paths=search_paths, optimize=optimize)
 
     if preprocessor_only:
-        return '\n'.join(c.contents for c in code)
+        return '\n'.join(' '.join(c.tokens) for c in code)
 
-    return assemble(code)
+    return assemble(code, source_map)
 
 
-def main():
-    import sys
+def assembler_to_binary(source_code, filename=None, search_paths=(),
+                        optimize=False, source_map=True, word_size=WORD_SIZE):
+    """
+    Convert a assembler program to a `Tiny` object file.
+
+    :param source_map: store where every instruction comes from in the
+                       object file, see `sourcemap`
+    :param word_size: the word size the program is meant to run at, the VM
+                      switches to it when loading the object file
+    """
+    symbols = {}
+    code = preprocess(source_code, filename or '<input>', symbols=symbols,
+                      search_paths=search_paths, optimize=optimize)
 
-    pp_only = sys.argv[1] == '--pp-only'
-    filename = sys.argv[1] if not pp_only else sys.argv[2]
+    return assemble_binary(code, symbols,
+                           SourceMap() if source_map else None, word_size)
+
+
+def main():
+    import argparse
+    import os
+
+    parser = argparse.ArgumentParser(description='Tiny-ASM assembler')
+    parser.add_argument('filename')
+    parser.add_argument('--pp-only', action='store_true',
+                        help='only run the preprocessor')
+    parser.add_argument('--binary', action='store_true',
+                        help='write a binary object file')
+    parser.add_argument('-o', '--output',
+                        help='object file name (default: <filename>.bin)')
+    parser.add_argument('-I', dest='search_paths', action='append',
+                        default=[], metavar='DIR',
+                        help='add a directory to look up imports in')
+    parser.add_argument('-O', dest='optimize', action='store_true',
+                        help='remove code without effect')
+    parser.add_argument('--no-source-map', dest='source_map',
+                        action='store_false',
+                        help="don't store the source lines in the object "
+                             "file")
+    parser.add_argument('--word-size', type=int, default=WORD_SIZE,
+                        choices=sorted(objfile.WORD_SIZES),
+                        help='word size to run the object file at '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    filename = args.filename
 
     try:
-        print(assembler_to_hex(open(filename).read(), filename=filename,
-                               preprocessor_only=pp_only))
+        if args.binary:
+            output = args.output or os.path.splitext(filename)[0] + '.bin'
+            with open(output, 'wb') as f:
+                f.write(assembler_to_binary(open(filename).read(),
+                                            filename=filename,
+                                            search_paths=args.search_paths,
+                                            optimize=args.optimize,
+                                            source_map=args.source_map,
+                                            word_size=args.word_size))
+        else:
+            print(assembler_to_hex(open(filename).read(), filename=filename,
+                                   preprocessor_only=args.pp_only,
+                                   search_paths=args.search_paths,
+                                   optimize=args.optimize))
     except Warning as w:
         print(w)
     except AssemblerException as e:
@@ -0,0 +1,258 @@
+"""
+Tiny-ASM batch runner.
+
+Runs many programs (or one program with many inputs) across a process pool.
+Every distinct program is assembled once in the parent process and decoded
+once per worker.
+
+A job is a dict with these keys (all optional but one of `source`/`file`):
+
+- source: the assembler source code
+- file:   path to the assembler source, used instead of `source`
+- args:   values substituted into the source using `str.format`
+- memory: initial memory cells as {address: value}
+- seed:   seed for `RANDOM`, a random one is chosen (and reported) if missing
+- stream: the stream of the seed to draw from, e.g. one per shard of a run
+          (see `rng`), 0 if missing
+- max_ticks, timeout: stop the job with an error after this many ticks or
+          seconds, so a hanging program doesn't block a worker forever
+
+`run_forks` instead continues a VM from its current state (e.g. after a
+shared setup prologue), once per job. Every job runs in a fork of the VM,
+see `VirtualMachine.fork`, and only uses `memory`, `seed`, `stream`,
+`max_ticks` and `timeout`.
+
+Results are returned in the order of the jobs.
+"""
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+import assembler
+from cache import AssemblyCache
+from decoder import decode, parse_hex
+from helpers import format_error, raise_errors
+from rng import Random, random_seed
+from virtualmachine import VirtualMachine, INTERPRETER
+
+
+Result = namedtuple('Result', ['output', 'ticks', 'error', 'seed'])
+
+# A job prepared for a worker
+Task = namedtuple('Task', ['hexcode', 'memory', 'seed', 'stream', 'max_ticks',
+                           'timeout', 'engine', 'error'])
+
+# A job for a fork of the VM
+ForkTask = namedtuple('ForkTask', ['memory', 'seed', 'stream', 'max_ticks',
+                                   'timeout'])
+
+
+def job_seed(job):
+    """ Get the job's seed, choose a random one if it has none """
+    seed = job.get('seed')
+    if seed is None:
+        seed = random_seed()
+
+    return seed
+
+
+###############################################################################
+# WORKER
+###############################################################################
+
+# Decoded programs of this worker, by hex code
+programs = {}
+
+
+def load_program(hexcode):
+    """
+    Decode a program once per worker. The decoded program also keeps its
+    compiled version (if any) for the next jobs.
+    """
+    try:
+        return programs[hexcode]
+    except KeyError:
+        program = decode(parse_hex(hexcode), VirtualMachine.opcode_table())
+        programs[hexcode] = program
+        return program
+
+
+def run_task(task):
+    """
+    Run a single task.
+
+    :type task: Task
+    :rtype: Result
+    """
+    if task.error is not None:
+        return Result('', 0, task.error, task.seed)
+
+    vm = VirtualMachine(task.engine, sink=None, source=None, seed=task.seed,
+                        stream=task.stream, max_ticks=task.max_ticks,
+                        timeout=task.timeout)
+    vm.testing = True
+    vm.debug = False
+
+    with raise_errors(), open(os.devnull, 'w') as devnull, \
+            redirect_stdout(devnull):
+        try:
+            for address, value in task.memory.items():
+                vm.mem_store(int(address), value)
+
+            vm.run(load_program(task.hexcode))
+        except Exception as e:
+            error = format_error(e)
+        else:
+            error = None
+
+    return Result(vm.output.getvalue(), vm.ticks, error, task.seed)
+
+
+# The VM the fork tasks of this worker continue from
+parent = None
+
+
+def init_fork_worker(state, engine):
+    """ Restore the VM to fork from its snapshot, once per worker """
+    global parent
+    parent = VirtualMachine(engine, sink=None, source=None)
+    parent.restore(state)
+
+
+def fork_task(vm, task):
+    """
+    Run a single task in a fork of `vm`.
+
+    :type task: ForkTask
+    :rtype: Result
+    """
+    child = vm.fork()
+    child.random = Random(task.seed, task.stream)
+    if task.max_ticks is not None:
+        child.max_ticks = task.max_ticks
+    if task.timeout is not None:
+        child.timeout = task.timeout
+    child.testing = True
+    child.debug = False
+
+    with raise_errors(), open(os.devnull, 'w') as devnull, \
+            redirect_stdout(devnull):
+        try:
+            for address, value in task.memory.items():
+                child.mem_store(int(address), value)
+
+            child.resume()
+        except Exception as e:
+            error = format_error(e)
+        else:
+            error = None
+
+    return Result(child.output.getvalue(), child.ticks, error, task.seed)
+
+
+def run_fork_task(task):
+    return fork_task(parent, task)
+
+
+###############################################################################
+# BATCH API
+###############################################################################
+
+def prepare(jobs, engine, cache):
+    """
+    Assemble the jobs' programs and build the worker tasks.
+
+    :rtype: list[Task]
+    """
+    tasks = []
+
+    with raise_errors(), open(os.devnull, 'w') as devnull, \
+            redirect_stdout(devnull):
+        for job in jobs:
+            seed = job_seed(job)
+
+            hexcode, error = None, None
+            try:
+                filename = job.get('file')
+                if filename is not None:
+                    source = open(filename).read()
+                else:
+                    source = job['source']
+
+                if job.get('args'):
+                    source = source.format(**job['args'])
+
+                hexcode = assembler.assembler_to_hex(source, filename,
+                                                     cache=cache)
+            except Exception as e:
+                error = format_error(e)
+
+            tasks.append(Task(hexcode, job.get('memory') or {}, seed,
+                              job.get('stream', 0), job.get('max_ticks'),
+                              job.get('timeout'), engine, error))
+
+    return tasks
+
+
+def run_batch(jobs, processes=None, engine=INTERPRETER, cache=None):
+    """
+    Run a list of jobs.
+
+    :param processes: number of worker processes, `None` uses one per CPU,
+                      0 runs the jobs in this process
+    :param engine: the VM engine to use, see `virtualmachine.ENGINES`
+    :type cache: cache.AssemblyCache
+    :rtype: list[Result]
+    """
+    jobs = list(jobs)
+    tasks = prepare(jobs, engine, cache or AssemblyCache())
+
+    if processes == 0 or len(tasks) <= 1:
+        return [run_task(task) for task in tasks]
+
+    processes = processes or os.cpu_count() or 1
+    chunksize = max(1, len(tasks) // (processes * 4))
+
+    with ProcessPoolExecutor(processes) as executor:
+        return list(executor.map(run_task, tasks, chunksize=chunksize))
+
+
+def run_forks(vm, jobs, processes=None):
+    """
+    Continue `vm` from its current state once per job.
+
+    The worker processes get a snapshot of the VM once and fork it for
+    every job, so the VM's state is only transferred once per worker.
+
+    :type vm: virtualmachine.VirtualMachine
+    :param processes: see `run_batch`
+    :rtype: list[Result]
+    """
+    tasks = [ForkTask(job.get('memory') or {}, job_seed(job),
+                      job.get('stream', 0), job.get('max_ticks'),
+                      job.get('timeout'))
+             for job in jobs]
+
+    if processes == 0 or len(tasks) <= 1:
+        return [fork_task(vm, task) for task in tasks]
+
+    processes = processes or os.cpu_count() or 1
+    chunksize = max(1, len(tasks) // (processes * 4))
+
+    with ProcessPoolExecutor(processes, initializer=init_fork_worker,
+                             initargs=(vm.snapshot(), vm.engine)) as executor:
+        return list(executor.map(run_fork_task, tasks, chunksize=chunksize))
+
+
+def read_jobs(path):
+    """ Read jobs from a JSON lines file """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main(path, processes=None, engine=INTERPRETER):
+    """ Run the jobs in `path` and print the results as JSON lines """
+    for result in run_batch(read_jobs(path), processes, engine):
+        print(json.dumps(result._asdict()))
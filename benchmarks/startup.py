@@ -0,0 +1,89 @@
+"""
+Tiny-ASM startup benchmark.
+
+Measures how long importing the VM and the assembler takes in a fresh
+interpreter, without the interpreter's own startup, and checks it against
+`BUDGETS`. Also checks that the VM doesn't import the modules it only needs
+for some features (see `LAZY`).
+
+    python benchmarks/startup.py [--runs N]
+
+Prints the results as JSON and exits with 1 if a budget is exceeded.
+"""
+import json
+import subprocess
+import sys
+from os.path import abspath, dirname
+from timeit import default_timer as timer
+
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+# Import time budgets in milliseconds
+BUDGETS = {
+    'virtualmachine': 30,
+    'assembler': 40,
+}
+
+# Modules importing `virtualmachine` must not load
+LAZY = ['assembler', 'asyncio', 'colorama', 'colors', 'cycles', 'enum',
+        'hashlib', 'inspect', 'json', 'preprocessor', 'profiler', 'random',
+        'snapshot', 'tracing', 'zlib']
+
+
+def run_python(code):
+    """ Run `code` in a fresh interpreter, return how long it took """
+    start = timer()
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+    return timer() - start
+
+
+def import_time(module, runs):
+    """
+    Get the fastest time of importing `module` in milliseconds, the
+    interpreter's startup subtracted.
+    """
+    baseline = min(run_python('pass') for _ in range(runs))
+    duration = min(run_python('import ' + module) for _ in range(runs))
+    return max(duration - baseline, 0) * 1000
+
+
+def loaded_modules(module):
+    """ Get the modules importing `module` loads """
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         'import sys; import {}; print(" ".join(sys.modules))'.format(module)],
+        cwd=ROOT,
+    )
+    return set(output.decode().split())
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10,
+                        help='take the fastest of N runs')
+    args = parser.parse_args()
+
+    # Warm up the bytecode caches
+    for module in BUDGETS:
+        run_python('import ' + module)
+
+    results = {}
+    for module, budget in BUDGETS.items():
+        results[module] = {'import_ms': round(import_time(module, args.runs), 2),
+                           'budget_ms': budget}
+
+    eager = sorted(set(LAZY) & loaded_modules('virtualmachine'))
+    results['virtualmachine']['eager_imports'] = eager
+
+    print(json.dumps(results, indent=2))
+
+    if eager or any(result['import_ms'] > result['budget_ms']
+                    for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
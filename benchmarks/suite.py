@@ -0,0 +1,302 @@
+"""
+Tiny-ASM benchmark suite.
+
+Runs fixed, reproducible workloads and prints the results as JSON, so runs
+can be compared across commits:
+
+    python benchmarks/suite.py -o before.json
+    ... change something ...
+    python benchmarks/suite.py --compare before.json
+
+Workloads:
+
+- assemble_large:   a generated program of `LARGE_LINES` lines with
+                    constants, labels, chars and subroutine calls
+- assemble_imports: a generated tree of `IMPORT_FILES` files, once with an
+                    empty import cache (cold) and once with a filled one
+                    (warm)
+- pi:               `pi.asm`, seeded with `SEED`, on every engine
+- math_multiply, math_divide: `lib/math` over a grid of arguments, on every
+                    engine
+- startup:          the import times of `startup.py`
+
+Every workload reports the best time of `--repeat` runs, its throughput
+(lines or ticks per second) and its peak memory, measured with tracemalloc
+in an extra run.
+"""
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from os.path import abspath, dirname, join
+from timeit import default_timer as timer
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import assembler
+import cache
+import startup
+from virtualmachine import VirtualMachine, ENGINES
+
+
+SEED = 1
+
+# Workload sizes, `--quick` divides them by `QUICK`
+LARGE_LINES = 30000
+IMPORT_FILES = 200
+PI_RUNS = 20
+MATH_STEP = 15
+QUICK = 10
+
+MATH_TEMPLATE = """
+MOV $arg0 {arg0}
+MOV $arg1 {arg1}
+@call({call}, $arg0, $arg1)
+DPRINT $return
+HALT
+
+#import {path}
+"""
+
+
+###############################################################################
+# WORKLOADS
+###############################################################################
+
+def generate_program(lines):
+    """ Generate a program of about `lines` lines """
+    code = ['$counter = [_]', '$acc = [_]',
+            '@start(bench_sub, 1)', '    ADD $return $arg0', '@end()']
+
+    blocks = max(lines // 6, 1)
+    for i in range(blocks):
+        code += ['block_{}:                   ; block {}'.format(i, i),
+                 '    MOV $counter {}'.format(i % 256),
+                 '    ADD $acc $counter      ; accumulate',
+                 '    JEQ :block_{} $acc 0'.format(i + 1),
+                 "    APRINT 'x'",
+                 '    @call(bench_sub, $acc)']
+    code.append('block_{}: HALT'.format(blocks))
+
+    return '\n'.join(code)
+
+
+def generate_imports(directory, files):
+    """
+    Generate a main file importing `files` files, which all import a common
+    file. Returns the main file's source and the total number of lines.
+    """
+    common = ['$common_{} = {}'.format(i, i) for i in range(20)]
+    with open(join(directory, 'common.asm'), 'w') as f:
+        f.write('\n'.join(common))
+
+    main = []
+    total = len(common)
+    for i in range(files):
+        lib = ['#import common.asm',
+               '@start(lib_{}, 1)'.format(i),
+               '    lib_{}_loop:'.format(i),
+               '    JLS :lib_{0}_done $arg0 $common_{1}'.format(i, i % 20),
+               '    SUB $arg0 $common_1',
+               '    ADD $return 1',
+               '    JMP :lib_{}_loop'.format(i),
+               '    lib_{}_done:'.format(i),
+               '@end()']
+        with open(join(directory, 'lib_{}.asm'.format(i)), 'w') as f:
+            f.write('\n'.join(lib))
+
+        main += ['#import lib_{}.asm'.format(i),
+                 'MOV $arg0 {}'.format(i % 256),
+                 '@call(lib_{}, $arg0)'.format(i)]
+        total += len(lib) + 3
+
+    main.append('HALT')
+    return '\n'.join(main), total + 1
+
+
+def assemble(source, filename):
+    # Warnings (e.g. pi.asm's redefined constants) would end up in the output
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        return assembler.assembler_to_hex(source, filename)
+
+
+def run_vm(engine, code):
+    """ Run an assembled program, return the number of ticks """
+    vm = VirtualMachine(engine, sink=None, source=None, seed=SEED)
+    vm.testing = True  # Don't exit on HALT
+    vm.run(code, preprocess=False)
+    return vm.ticks
+
+
+def math_programs(call, path, step):
+    """ Assemble the `lib/math` subroutine for a grid of arguments """
+    source = MATH_TEMPLATE.format(arg0='{arg0}', arg1='{arg1}', call=call,
+                                  path=path)
+
+    return [assemble(source.format(arg0=arg0, arg1=arg1), '<benchmark>')
+            for arg0 in range(0, 256, step)
+            for arg1 in range(1, 256, step)]
+
+
+def workloads(quick, engines, directory):
+    """
+    Build the workloads as (name, unit, function) triples. The functions
+    return the number of units (lines or ticks) they processed.
+    """
+    scale = QUICK if quick else 1
+
+    large = generate_program(LARGE_LINES // scale)
+    large_lines = large.count('\n') + 1
+    yield 'assemble_large', 'lines', \
+        lambda: len([assemble(large, '<benchmark>')]) * large_lines
+
+    imports, import_lines = generate_imports(directory, IMPORT_FILES // scale)
+    main_path = join(directory, 'main.asm')
+
+    def assemble_cold():
+        cache.sources.clear()
+        assemble(imports, main_path)
+        return import_lines
+
+    def assemble_warm():
+        assemble(imports, main_path)
+        return import_lines
+
+    yield 'assemble_imports_cold', 'lines', assemble_cold
+    yield 'assemble_imports_warm', 'lines', assemble_warm
+
+    with open(join(ROOT, 'pi.asm')) as f:
+        pi = assemble(f.read(), join(ROOT, 'pi.asm'))
+
+    step = MATH_STEP * (4 if quick else 1)
+    math = [(name, math_programs(name, join(ROOT, 'lib', 'math', path), step))
+            for name, path in (('math_multiply', 'multiply.asm'),
+                               ('math_divide', 'divide.asm'))]
+
+    for engine in engines:
+        def run_pi(engine=engine):
+            return sum(run_vm(engine, pi) for _ in range(PI_RUNS // scale))
+
+        yield 'pi/' + engine, 'ticks', run_pi
+
+        for name, programs in math:
+            yield '{}/{}'.format(name, engine), 'ticks', \
+                lambda engine=engine, programs=programs: \
+                sum(run_vm(engine, code) for code in programs)
+
+
+###############################################################################
+# MEASURING
+###############################################################################
+
+def measure(unit, func, repeat):
+    """ Measure the best time and the peak memory of a workload """
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = timer()
+        units = func()
+        seconds = min(seconds, timer() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {unit: units,
+            'seconds': round(seconds, 6),
+            unit + '_per_second': round(units / seconds),
+            'peak_kib': round(peak / 1024)}
+
+
+def commit():
+    """ Get the checked out commit, None outside of a git repository """
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=ROOT, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return output.decode().strip()
+
+
+def compare(results, old):
+    """ Print the speedup of every throughput over an older run """
+    for name, result in sorted(results.items()):
+        for metric, value in sorted(result.items()):
+            try:
+                old_value = old[name][metric]
+            except KeyError:
+                continue
+
+            if metric.endswith('_per_second') and old_value:
+                ratio = value / old_value
+            elif metric.endswith('_ms') and value:
+                ratio = old_value / value
+            else:
+                continue
+
+            print('{:32} {:24} {:6.2f}x'.format(name, metric, ratio),
+                  file=sys.stderr)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--engine', dest='engines', action='append',
+                        choices=ENGINES, help='only run these engines')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='take the best time of N runs')
+    parser.add_argument('--quick', action='store_true',
+                        help='run smaller workloads, e.g. as a smoke test')
+    parser.add_argument('--skip-startup', action='store_true',
+                        help="don't measure the import times")
+    parser.add_argument('-o', dest='output', metavar='FILE',
+                        help='write the results to FILE instead of stdout')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='print the speedups over the results in FILE')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, unit, func in workloads(args.quick,
+                                          args.engines or ENGINES,
+                                          directory):
+            results[name] = measure(unit, func, args.repeat)
+            print(name, file=sys.stderr)
+
+    if not args.skip_startup:
+        results['startup'] = dict(
+            (module + '_ms', round(startup.import_time(module, args.repeat), 2))
+            for module in startup.BUDGETS
+        )
+
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'results': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'])
+
+
+if __name__ == '__main__':
+    main()
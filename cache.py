@@ -0,0 +1,204 @@
+"""
+Tiny-ASM assembly cache.
+
+Two levels of caching:
+
+- `SourceCache`: imported files as already preprocessed line blocks, keyed
+  by the file's content hash. Used by the import preprocessor.
+- `AssemblyCache`: the assembled programs, keyed by the hashes of the source
+  code and every (transitively) imported file. Kept in memory and,
+  optionally, on disk, both with LRU eviction.
+"""
+import os
+from collections import OrderedDict, namedtuple
+
+import config
+
+
+SourceFile = namedtuple('SourceFile', ['path', 'digest', 'lines'])
+
+
+def digest(data):
+    import hashlib  # Slow to import
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+###############################################################################
+# IMPORTED FILES
+###############################################################################
+
+class SourceCache(object):
+    """
+    Cache imported files as preprocessed line blocks.
+
+    A file is only re-read if its modification time or size changed, and
+    only re-processed if its contents changed.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        #: Absolute path → (mtime, size), SourceFile
+        #: :type: OrderedDict[str, ((int, int), SourceFile)]
+        self.files = OrderedDict()
+
+    def read(self, path):
+        try:
+            return open(path).read()
+        except UnicodeDecodeError:
+            return open(path, encoding='utf-8').read()
+
+    def get(self, path, process):
+        """
+        Get the file at `path`. `process` is called with the contents to
+        build the line block, if it's not cached yet.
+
+        :rtype: SourceFile
+        """
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        key = os.path.abspath(path)
+
+        try:
+            cached_signature, source = self.files[key]
+        except KeyError:
+            cached_signature, source = None, None
+
+        if cached_signature != signature:
+            contents = self.read(path)
+            content_digest = digest(contents)
+
+            if source is None or source.digest != content_digest:
+                source = SourceFile(path, content_digest,
+                                    tuple(process(contents)))
+
+        self.files[key] = (signature, source)
+        self.files.move_to_end(key)
+
+        while len(self.files) > self.maxsize:
+            self.files.popitem(last=False)
+
+        return source
+
+    def clear(self):
+        self.files.clear()
+
+
+#: The cache used by the import preprocessor
+sources = SourceCache()
+
+
+###############################################################################
+# ASSEMBLED PROGRAMS
+###############################################################################
+
+class AssemblyCache(object):
+    """
+    Cache assembled programs in memory and, if `directory` is given, on disk.
+
+    The memory cache keeps at most `maxsize` programs, the disk cache at most
+    `max_bytes` bytes. Both evict the least recently used programs first.
+    """
+
+    def __init__(self, maxsize=128, directory=None, max_bytes=16 * 2 ** 20):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.max_bytes = max_bytes
+        #: :type: OrderedDict[str, str]
+        self.memory = OrderedDict()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, source_code, filename, imports=(), optimize=False):
+        """
+        Build the cache key for a program.
+
+        :param imports: the (path, content hash) pairs of all imported files,
+                        see `preprocessor.imports.imported_files`
+        :param optimize: wether the program is optimized
+        """
+        import hashlib
+
+        key = hashlib.sha256()
+        key.update('{} {} {} {}\0'.format(config.WORD_SIZE, config.MEMORY_SIZE,
+                                          optimize, filename).encode('utf-8'))
+        key.update(digest(source_code).encode('utf-8'))
+
+        for path, file_digest in imports:
+            key.update('{}\0{}\0'.format(path, file_digest).encode('utf-8'))
+
+        return key.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.hex')
+
+    def get(self, key):
+        """ Look up a program, returns None if it isn't cached """
+        try:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        except KeyError:
+            pass
+
+        if self.directory is None:
+            return None
+
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                hexcode = f.read()
+        except FileNotFoundError:
+            return None
+
+        os.utime(path)  # Mark as recently used
+        self.remember(key, hexcode)
+
+        return hexcode
+
+    def put(self, key, hexcode):
+        self.remember(key, hexcode)
+
+        if self.directory is not None:
+            path = self.path(key)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+            with open(tmp_path, 'w') as f:
+                f.write(hexcode)
+            os.replace(tmp_path, path)
+
+            self.evict_files()
+
+    def remember(self, key, hexcode):
+        self.memory[key] = hexcode
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def evict_files(self):
+        """ Remove the least recently used files until under `max_bytes` """
+        entries = []
+        total = 0
+
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.hex'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        while total > self.max_bytes and entries:
+            _, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.memory.clear()
+
+        if self.directory is not None:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.hex'):
+                    os.remove(entry.path)
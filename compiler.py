@@ -0,0 +1,421 @@
+"""
+Tiny-ASM compiler backend.
+
+Compiles a decoded program into a single generated Python function. Every
+basic block becomes straight-line code over the VM's memory, jumps set the
+block index and go through a (binary searched) dispatch on it.
+
+The generated code works on the memory as a plain list, which is faster to
+access than the VM's typed memory. Stores wrap values around with a modulo,
+so programs are compiled once per word size. Instructions accessing memory
+beyond the memory size report the error instead, so they're compiled once
+per memory size, too.
+
+The function also returns before a block that would exceed a given number
+of ticks, so long runs can be interrupted (e.g. for checkpoints). The driver
+interprets the rest of the ticks then.
+
+Jump targets that aren't known at compile time (e.g. `JMP $jump_back` to an
+address that wasn't recognized as a block start) make the function return
+to the driver, which recompiles the program with the new block.
+"""
+from decoder import memory_accesses
+from exc import VirtualRuntimeError
+from opcodes import *
+from sources import InputPending
+
+
+# Block leafs with at most this many blocks are dispatched linearly
+LINEAR_DISPATCH = 4
+
+# Inlined instruction implementations, the result will be stored in the
+# first argument. `{0}` is the first argument's address, `{1}` the second
+# argument as expression.
+DATA_TEMPLATES = {
+    AndInstruction: 'm[{0}] & {1}',
+    OrInstruction: 'm[{0}] | {1}',
+    XorInstruction: 'm[{0}] ^ {1}',
+    AddInstruction: 'm[{0}] + {1}',
+    SubInstruction: 'm[{0}] - {1}',
+    MovInstruction: '{1}',
+    NotInstruction: '~ {0}',
+}
+
+# Inlined jumps: destination and condition
+JUMP_TEMPLATES = {
+    JmpInstruction: ('{0}', None),
+    JzInstruction: ('{0}', '{1} == 0'),
+    JeqInstruction: ('{0}', '{1} == {2}'),
+    JlsInstruction: ('{0}', '{1} < {2}'),
+    JgtInstruction: ('{0}', '{1} > {2}'),
+}
+
+
+def stuck(vm, address, prev, ticks):
+    vm.instr_pointer, vm.prev_instr_pointer, vm.ticks = address, prev, ticks
+    vm.error('Stuck in infinite loop!', VirtualRuntimeError)
+
+
+def out_of_bounds(vm, address, prev, ticks):
+    vm.instr_pointer, vm.prev_instr_pointer, vm.ticks = address, prev, ticks
+    vm.out_of_bounds(vm.program.instructions[address])
+
+
+###############################################################################
+# ANALYSIS
+###############################################################################
+
+def is_terminator(decoded, instruction_classes):
+    """ Check, wether the instruction ends a basic block """
+    return decoded.return_type == ReturnValue.JUMP or \
+        instruction_classes[decoded.mnem] is HaltInstruction
+
+
+def instruction_boundaries(program):
+    """
+    Get the addresses of the instructions as laid out by the assembler.
+    """
+    boundaries = []
+    address = 0
+
+    while address < len(program):
+        decoded = program.instructions[address]
+        if decoded is None:
+            break
+
+        boundaries.append(address)
+        address += decoded.size
+
+    return boundaries
+
+
+def find_leaders(program, instruction_classes):
+    """
+    Find the start addresses of all basic blocks.
+
+    These are the entry point, jump targets, the instructions following a
+    jump and literals moved into memory that point to an instruction (return
+    addresses for `JMP $jump_back`).
+    """
+    boundaries = instruction_boundaries(program)
+    targets = set(boundaries)
+    leaders = {program.entry}
+
+    for address in boundaries:
+        decoded = program.instructions[address]
+
+        if is_terminator(decoded, instruction_classes):
+            leaders.add(address + decoded.size)
+
+            # Static jump target
+            if instruction_classes[decoded.mnem] in JUMP_TEMPLATES and \
+                    not (decoded.deref and decoded.deref[0]):
+                leaders.add(decoded.args[0])
+
+        elif instruction_classes[decoded.mnem] is MovInstruction:
+            if not decoded.deref and decoded.args[1] in targets:
+                leaders.add(decoded.args[1])
+
+    return set(leader for leader in leaders
+               if 0 <= leader < len(program) and
+               program.instructions[leader] is not None)
+
+
+def collect_block(program, leader, leaders, instruction_classes):
+    """
+    Collect the instructions of the basic block starting at `leader`.
+
+    :rtype: list[decoder.Decoded]
+    """
+    block = []
+    address = leader
+
+    while 0 <= address < len(program):
+        decoded = program.instructions[address]
+        if decoded is None:
+            break
+
+        block.append(decoded)
+        address += decoded.size
+
+        if is_terminator(decoded, instruction_classes) or address in leaders:
+            break
+
+    return block
+
+
+###############################################################################
+# CODE GENERATION
+###############################################################################
+
+class CodeGenerator(object):
+    def __init__(self, program, instruction_classes, word_size, memory_size):
+        #: :type: decoder.Program
+        self.program = program
+        self.instruction_classes = instruction_classes
+        self.max_int = 2 ** word_size
+        self.memory_size = memory_size
+        self.lines = []
+        self.indent = 0
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def arg(self, decoded, i):
+        """ Get the i-th argument as an expression """
+        if decoded.deref and decoded.deref[i]:
+            return 'm[{}]'.format(decoded.args[i])
+        return str(decoded.args[i])
+
+    def args(self, decoded):
+        return [self.arg(decoded, i) for i in range(len(decoded.args))]
+
+    def emit_store(self, dest, value):
+        if value.isdigit():
+            # Literal, wrap it at compile time
+            self.emit('m[{}] = {}'.format(dest, int(value) % self.max_int))
+        else:
+            self.emit('m[{}] = ({}) % {}'.format(dest, value, self.max_int))
+
+    def state(self, decoded, prev, remaining):
+        """
+        Get the (instr_pointer, prev_instr_pointer, ticks) right before
+        `decoded` is executed. `remaining` is the number of instructions left
+        in the block, including this one.
+        """
+        return '{}, {}, ticks - {}'.format(
+            decoded.address, 'prev' if prev is None else prev, remaining
+        )
+
+    def emit_jump(self, decoded, dest, prev, remaining):
+        """
+        Jump to `dest`. A jump to itself gets stuck, see
+        `VirtualMachine.instr_jump`.
+        """
+        self.emit('pc = {}'.format(dest))
+        if not dest.isdigit():
+            self.emit('if pc == {}:'.format(decoded.address))
+            self.indent += 1
+            self.emit('stuck(vm, {})'.format(
+                self.state(decoded, prev, remaining)
+            ))
+            self.indent -= 1
+        elif int(dest) == decoded.address:
+            # Known at compile time
+            self.emit('stuck(vm, {})'.format(
+                self.state(decoded, prev, remaining)
+            ))
+
+        self.emit('prev = {}'.format(decoded.address))
+        self.emit('continue')
+
+    def emit_fallthrough(self, decoded):
+        self.emit('pc = {}'.format(decoded.address + decoded.size))
+        self.emit('prev = {}'.format(decoded.address))
+        self.emit('continue')
+
+    def emit_jump_instruction(self, decoded, dest, condition, prev,
+                              remaining):
+        if condition is None:
+            self.emit_jump(decoded, dest, prev, remaining)
+            return
+
+        self.emit('if {}:'.format(condition))
+        self.indent += 1
+        self.emit_jump(decoded, dest, prev, remaining)
+        self.indent -= 1
+        self.emit_fallthrough(decoded)
+
+    def emit_handler_call(self, decoded, prev, remaining):
+        """
+        Call the instruction's handler for everything not inlined.
+        `remaining` is like in `state`.
+        """
+        call = 'h[{!r}]({})'.format(decoded.mnem,
+                                    ', '.join(self.args(decoded)))
+
+        if self.instruction_classes[decoded.mnem] is AreadInstruction:
+            # Stop right before the AREAD if there's no input yet
+            self.emit('try:')
+            self.indent += 1
+            self.emit('dest, value = {}'.format(call))
+            self.indent -= 1
+            self.emit('except InputPending:')
+            self.indent += 1
+            self.emit('vm.waiting = True')
+            self.emit('return {}'.format(self.state(decoded, prev, remaining)))
+            self.indent -= 1
+            self.emit_store('dest', 'value')
+
+        elif decoded.return_type == ReturnValue.DATA:
+            self.emit('dest, value = {}'.format(call))
+            self.emit_store('dest', 'value')
+
+        elif decoded.return_type == ReturnValue.JUMP:
+            self.emit('dest = {}'.format(call))
+            self.emit('if dest is not None:')
+            self.indent += 1
+            self.emit_jump(decoded, 'dest', prev, remaining)
+            self.indent -= 1
+            self.emit_fallthrough(decoded)
+
+        else:
+            self.emit(call)
+            self.emit('if not vm.running:')
+            self.indent += 1
+            self.emit('return {}, {}, ticks'.format(
+                decoded.address + decoded.size, decoded.address
+            ))
+            self.indent -= 1
+
+    def emit_out_of_bounds(self, decoded, prev, remaining):
+        """
+        Report an instruction accessing memory that doesn't exist and return
+        without executing it. `remaining` is like in `state`.
+        """
+        state = self.state(decoded, prev, remaining)
+        self.emit('out_of_bounds(vm, {})'.format(state))
+        self.emit('return {}'.format(state))
+
+    def emit_block(self, block):
+        self.emit('if ticks + {} > stop:'.format(len(block)))
+        self.indent += 1
+        self.emit('return pc, prev, ticks')
+        self.indent -= 1
+        self.emit('ticks += {}'.format(len(block)))
+        prev = None  # Only known at runtime for the first instruction
+
+        for i, decoded in enumerate(block):
+            instruction_class = self.instruction_classes[decoded.mnem]
+            args = self.args(decoded)
+
+            if any(address >= self.memory_size
+                   for address in memory_accesses(decoded)):
+                self.emit_out_of_bounds(decoded, prev, len(block) - i)
+                return
+
+            if instruction_class in DATA_TEMPLATES:
+                template = DATA_TEMPLATES[instruction_class]
+                self.emit_store(decoded.args[0],
+                                template.format(decoded.args[0], *args[1:]))
+
+            elif instruction_class in JUMP_TEMPLATES:
+                dest, condition = JUMP_TEMPLATES[instruction_class]
+                self.emit_jump_instruction(
+                    decoded, dest.format(*args),
+                    condition and condition.format(*args),
+                    prev, len(block) - i
+                )
+
+            else:
+                self.emit_handler_call(decoded, prev, len(block) - i)
+
+            prev = decoded.address
+
+        last = block[-1]
+        if not is_terminator(last, self.instruction_classes):
+            self.emit_fallthrough(last)
+        elif self.instruction_classes[last.mnem] is HaltInstruction:
+            # HALT didn't stop the VM, continue with the next instruction
+            self.emit_fallthrough(last)
+
+    def emit_dispatch(self, leaders, blocks):
+        """ Emit a binary search over the block indices """
+        if len(leaders) <= LINEAR_DISPATCH:
+            for leader in leaders:
+                self.emit('if pc == {}:'.format(leader))
+                self.indent += 1
+                self.emit_block(blocks[leader])
+                self.indent -= 1
+            return
+
+        middle = len(leaders) // 2
+        self.emit('if pc < {}:'.format(leaders[middle]))
+        self.indent += 1
+        self.emit_dispatch(leaders[:middle], blocks)
+        self.indent -= 1
+        self.emit('else:')
+        self.indent += 1
+        self.emit_dispatch(leaders[middle:], blocks)
+        self.indent -= 1
+
+    def generate(self, leaders):
+        leaders = sorted(leaders)
+        blocks = dict((leader, collect_block(self.program, leader, leaders,
+                                             self.instruction_classes))
+                      for leader in leaders)
+
+        self.emit('def run(vm, m, h, pc, prev, ticks, stop):')
+        self.indent += 1
+        self.emit('while True:')
+        self.indent += 1
+        if leaders:
+            self.emit_dispatch(leaders, blocks)
+        self.emit('return pc, prev, ticks')
+
+        return '\n'.join(self.lines)
+
+
+###############################################################################
+# COMPILER
+###############################################################################
+
+class CompiledProgram(object):
+    """
+    A decoded program compiled to a Python function.
+
+    Call it with `(vm, memory, handlers, instr_pointer, prev_instr_pointer,
+    ticks, stop)`, where `memory` is a list. It returns the new
+    (instr_pointer, prev_instr_pointer, ticks) once the VM is halted, the
+    next block would exceed `stop` ticks or the instruction pointer doesn't
+    point to a known block.
+    """
+
+    def __init__(self, program, instruction_classes, word_size,
+                 memory_size):
+        self.program = program
+        self.instruction_classes = instruction_classes
+        self.word_size = word_size
+        self.memory_size = memory_size
+        self.leaders = find_leaders(program, instruction_classes)
+        self.source = None
+        self.run = None
+
+        self.compile()
+
+    def compile(self):
+        generator = CodeGenerator(self.program, self.instruction_classes,
+                                  self.word_size, self.memory_size)
+        self.source = generator.generate(self.leaders)
+
+        namespace = {'stuck': stuck, 'out_of_bounds': out_of_bounds,
+                     'InputPending': InputPending}
+        exec(compile(self.source, '<tiny-compiled>', 'exec'), namespace)
+        self.run = namespace['run']
+
+    def add_block(self, address):
+        """
+        Add a new block starting at `address` and recompile.
+
+        Returns False if there's no instruction at that address.
+        """
+        if not 0 <= address < len(self.program) or \
+                self.program.instructions[address] is None:
+            return False
+
+        self.leaders.add(address)
+        self.compile()
+        return True
+
+    def __call__(self, *args):
+        return self.run(*args)
+
+
+def compile_program(program, instruction_classes, word_size, memory_size):
+    """
+    :type program: decoder.Program
+    :type instruction_classes: dict[str, type]
+    :rtype: CompiledProgram
+    """
+    return CompiledProgram(program, instruction_classes, word_size,
+                           memory_size)
@@ -1,16 +1,13 @@
-DEBUG = True
+DEBUG = False
 TESTING = False
 
 ###############################################################################
 # CONSTANTS
 ###############################################################################
 
+# Defaults, a VirtualMachine can use other word and memory sizes, e.g.
+# VirtualMachine(word_size=32)
 WORD_SIZE = 8
 MAX_INT = 2 ** WORD_SIZE
 MEMORY_SIZE = 2 ** WORD_SIZE
 RAND_MAX = 25
-
-# WORD_SIZE = 32
-# MAX_INT = 2 ** WORD_SIZE
-# MEMORY_SIZE = 256
-# RAND_MAX = 255
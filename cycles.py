@@ -0,0 +1,47 @@
+"""
+Tiny-ASM cycle detection.
+
+A program is stuck if it reaches the same state twice: it can only repeat
+the same instructions forever then. Every loop of a program contains a
+backward jump, so the VM only has to look at the states at backward jumps
+(the instruction pointer, the memory, the position in the random numbers
+and the number of characters read, see `VirtualMachine.state`).
+
+Keeping all of them would take a lot of memory, so `CycleDetector` uses
+Brent's algorithm: it keeps a single state and compares it to the next
+ones, and saves a new one after 1, 2, 4, 8, ... states. A cycle is found
+after a small multiple of the states it takes to enter it and to go around
+it once. The states are compared by their hash first and by their content
+only if it matches, so there are no false positives.
+"""
+
+
+class CycleDetector(object):
+    """
+    Finds repeating states, see the module's documentation.
+    """
+
+    def __init__(self):
+        self.saved = None
+        self.saved_hash = None
+        # Compare `limit` states to the saved one before saving another one
+        self.limit = 1
+        self.count = 0
+
+    def __call__(self, state):
+        """
+        Check the next state, returns True if it was seen before.
+
+        :param state: a hashable state
+        """
+        state_hash = hash(state)
+        if state_hash == self.saved_hash and state == self.saved:
+            return True
+
+        self.count += 1
+        if self.count == self.limit:
+            self.saved, self.saved_hash = state, state_hash
+            self.limit *= 2
+            self.count = 0
+
+        return False
@@ -0,0 +1,186 @@
+"""
+Tiny-ASM machine code decoder.
+
+Turns the assembled machine code into a program of pre-resolved instructions
+once, so the virtual machine's main loop only has to dispatch.
+"""
+from collections import namedtuple
+
+from exc import VirtualRuntimeError
+from helpers import get_ordered_annotations
+from opcodes import instructions, ReturnValue, ADDRESS, LITERAL
+
+
+###############################################################################
+# DATA TYPES
+###############################################################################
+
+# A single decoded instruction:
+# - address:     position of the opcode in the token stream
+# - opcode:      the opcode as it's listed in `opcodes.instructions`
+# - mnem:        the instruction's mnemonic, used to look up the handler
+# - args:        the arguments as ints
+# - deref:       for every argument, wether the memory contents have to be
+#                passed instead of the address (None if no argument has to)
+# - return_type: the ReturnValue the handler's result is interpreted as
+# - size:        number of tokens (opcode + arguments)
+Decoded = namedtuple('Decoded', ['address', 'opcode', 'mnem', 'args',
+                                 'deref', 'return_type', 'size'])
+
+# The per-opcode part of a decoded instruction
+OpcodeSpec = namedtuple('OpcodeSpec', ['opcode', 'mnem', 'num_args', 'deref',
+                                       'return_type'])
+
+
+class Program(object):
+    """
+    A decoded program.
+
+    Every token address gets its own decoded instruction, as jumps may land
+    in the middle of what the assembler emitted as an instruction. Addresses
+    that cannot be decoded are stored in `errors` and only reported when the
+    VM actually tries to execute them.
+    """
+
+    def __init__(self, tokens, entry=0, symbols=None, source_map=None):
+        #: :type: list[int]
+        self.tokens = tokens
+        self.entry = entry
+        #: Label → address
+        #: :type: dict[str, int]
+        self.symbols = symbols or {}
+        #: Where the instructions come from, None if unknown
+        #: :type: sourcemap.SourceMap
+        self.source_map = source_map
+        #: Address → label, see `label_at`
+        #: :type: dict[int, str]
+        self.labels = None
+        #: :type: list[Decoded]
+        self.instructions = [None] * len(tokens)
+        #: :type: dict[int, (str, type)]
+        self.errors = {}
+        #: Compiled versions of this program, by VM class, word size and
+        #: memory size
+        #: :type: dict[(type, int, int), compiler.CompiledProgram]
+        self.compiled = {}
+        #: Superinstructions of this program, by VM class, word size, memory
+        #: size and wether loops are optimized
+        #: :type: dict[(type, int, int, bool), list]
+        self.fused = {}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def label_at(self, address):
+        """
+        Get the label of an address, None if there is none. If several labels
+        point to the same address, the first one defined is used.
+        """
+        if self.labels is None:
+            self.labels = {}
+            for label, label_address in self.symbols.items():
+                self.labels.setdefault(label_address, label)
+
+        return self.labels.get(address)
+
+
+def memory_accesses(decoded):
+    """
+    Get the memory addresses an instruction reads or writes: the
+    destination of a store and the dereferenced arguments.
+
+    :type decoded: Decoded
+    :rtype: list[int]
+    """
+    addresses = []
+    if decoded.return_type == ReturnValue.DATA:
+        addresses.append(decoded.args[0])
+    if decoded.deref is not None:
+        addresses += [arg for arg, deref in zip(decoded.args, decoded.deref)
+                      if deref]
+    return addresses
+
+
+###############################################################################
+# DECODER
+###############################################################################
+
+def get_annotations(instruction_class):
+    func = getattr(instruction_class, '__call__', None)
+    if getattr(func, '__code__', None) is None:
+        return {}
+    return get_ordered_annotations(func, skip=1)  # self
+
+
+def build_opcode_table(instruction_classes):
+    """
+    Resolve every opcode's argument handling from the instructions'
+    annotations.
+
+    :type instruction_classes: dict[str, type]
+    :rtype: dict[int, OpcodeSpec]
+    """
+    table = {}
+
+    for mnem, spec in instructions.items():
+        annotations = get_annotations(instruction_classes[mnem])
+        return_type = annotations.pop('return', None)
+        required_types = list(annotations.values())
+
+        for opcode, arg_types in spec.items():
+            # Some instructions allow a parameter to be an address OR an
+            # literal but the implementation requires a literal. In this case,
+            # we need to pass the memory content instead of the address.
+            deref = tuple(arg_type == ADDRESS and required == LITERAL
+                          for arg_type, required in zip(arg_types,
+                                                        required_types))
+
+            table[int(opcode, 16)] = OpcodeSpec(
+                opcode, mnem, len(arg_types),
+                deref if any(deref) else None, return_type
+            )
+
+    return table
+
+
+def parse_hex(hexcode):
+    """
+    Convert the assembler's hex output to a list of ints.
+    """
+    return [int(token, 0) for token in hexcode.split()]
+
+
+def decode(tokens, opcode_table, entry=0, symbols=None, source_map=None):
+    """
+    Decode a list of tokens.
+
+    :type tokens: list[int] | memoryview
+    :type opcode_table: dict[int, OpcodeSpec]
+    :type source_map: sourcemap.SourceMap
+    :rtype: Program
+    """
+    program = Program(tokens, entry, symbols, source_map)
+    num_tokens = len(tokens)
+
+    for address, token in enumerate(tokens):
+        try:
+            spec = opcode_table[token]
+        except KeyError:
+            msg = 'Unknown opcode: 0x{:02X}'.format(token)
+            program.errors[address] = (msg, VirtualRuntimeError)
+            continue
+
+        size = spec.num_args + 1
+        if address + size > num_tokens:
+            msg = 'Unexpectedly reached EOF. Maybe an argument is ' \
+                  'missing or a messed up jump occured'
+            program.errors[address] = (msg, VirtualRuntimeError)
+            continue
+
+        args = tuple(tokens[address + 1:address + size])
+        program.instructions[address] = Decoded(
+            address, spec.opcode, spec.mnem, args, spec.deref,
+            spec.return_type, size
+        )
+
+    return program
@@ -0,0 +1,28 @@
+['$return = [_]',
+ '$jump_back = [_]',
+ '$arg0 = [_]',
+ '$arg1 = [_]',
+ 'math_divide:',
+ 'MOV $return 0',
+ '',
+ '    math_div_loop:',
+ '    JLS     :math_div_done      $arg0       $arg1',
+ '    ADD                         $return     1',
+ '    SUB                         $arg0       $arg1',
+ '    JMP     :math_div_loop',
+ '',
+ '    math_div_done:',
+ 'JMP $jump_back',
+ '',
+ '$pi_rand0 = [_]',
+ '$pi_rand1 = [_]',
+ '',
+ '    MOV                         $pi_rand0   15',
+ '    MOV                         $pi_rand1   2',
+ '',
+ 'MOV $arg0 $pi_rand0',
+ 'MOV $arg1 $pi_rand1',
+ 'MOV $jump_back :ret0',
+ 'JMP :math_divide',
+ 'ret0:',
+ 'HALT']
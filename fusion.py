@@ -0,0 +1,210 @@
+"""
+Tiny-ASM superinstructions.
+
+Fuses straight sequences of simple instructions into superinstructions, which
+the interpreter runs in a single dispatch. Typical sequences are the argument
+MOVs and the JMP emitted for every `@call` and the JEQ / ADD / ADD / JMP loops
+in `lib/math`.
+
+A superinstruction covers a run of at least `MIN_LENGTH` instructions that
+the compiler can inline (see `compiler.DATA_TEMPLATES` and
+`compiler.JUMP_TEMPLATES`) and is compiled to a Python function. Conditional
+jumps may leave it early, an unconditional jump ends it. The function returns
+the new instruction pointer, the previous instruction pointer and the number
+of instructions it executed, so the VM's ticks stay the same as without
+fusion.
+
+Superinstructions start at the block leaders (see `compiler.find_leaders`)
+and right after instructions that can't be inlined. Jumps to other addresses
+run the regular instructions until the next superinstruction starts.
+"""
+from compiler import (CodeGenerator, DATA_TEMPLATES, JUMP_TEMPLATES,
+                      find_leaders, instruction_boundaries)
+
+
+# Shortest sequence worth fusing
+MIN_LENGTH = 2
+
+
+def stuck(vm, address, prev, ticks, dest):
+    """
+    Let the VM report a jump to itself, with the state it would have without
+    fusion.
+    """
+    vm.instr_pointer = address
+    vm.prev_instr_pointer = prev
+    vm.ticks += ticks
+    vm.instr_jump(dest)
+
+
+###############################################################################
+# ANALYSIS
+###############################################################################
+
+def can_fuse(decoded, instruction_classes, memory_size):
+    """
+    Check, wether the instruction can be part of a superinstruction. All
+    memory it accesses has to exist, so it can't fail halfway through.
+    """
+    instruction_class = instruction_classes[decoded.mnem]
+
+    if instruction_class in DATA_TEMPLATES:
+        addresses = [decoded.args[0]]
+    elif instruction_class in JUMP_TEMPLATES:
+        addresses = []
+    else:
+        return False
+
+    if decoded.deref is not None:
+        addresses += [arg for arg, deref in zip(decoded.args, decoded.deref)
+                      if deref]
+
+    return all(address < memory_size for address in addresses)
+
+
+def find_sequences(program, instruction_classes, memory_size):
+    """
+    Find the instruction sequences to fuse.
+
+    :rtype: list[list[decoder.Decoded]]
+    """
+    boundaries = instruction_boundaries(program)
+    starts = find_leaders(program, instruction_classes)
+
+    # Sequences can't start in the middle of an instruction
+    starts &= set(boundaries)
+    starts.update(address + program.instructions[address].size
+                  for address in boundaries
+                  if not can_fuse(program.instructions[address],
+                                  instruction_classes, memory_size))
+
+    sequences = []
+    for start in sorted(starts):
+        sequence = []
+        address = start
+
+        while 0 <= address < len(program):
+            decoded = program.instructions[address]
+            if decoded is None or \
+                    not can_fuse(decoded, instruction_classes, memory_size):
+                break
+
+            sequence.append(decoded)
+            address += decoded.size
+
+            # Unconditional jumps end the sequence
+            if instruction_classes[decoded.mnem] in JUMP_TEMPLATES and \
+                    JUMP_TEMPLATES[instruction_classes[decoded.mnem]][1] \
+                    is None:
+                break
+
+        if len(sequence) >= MIN_LENGTH:
+            sequences.append(sequence)
+
+    return sequences
+
+
+###############################################################################
+# CODE GENERATION
+###############################################################################
+
+class FusionGenerator(CodeGenerator):
+    """
+    Generates the superinstructions' functions. They're called with the VM,
+    its memory, the previous instruction pointer and the tick limit.
+    """
+
+    def __init__(self, program, instruction_classes):
+        self.program = program
+        self.instruction_classes = instruction_classes
+        self.lines = []
+        self.indent = 0
+        self.count = 0  # Instructions executed so far
+
+    def emit_store(self, dest, value):
+        # The VM's memory wraps the values itself
+        self.emit('m[{}] = {}'.format(dest, value))
+
+    def emit_jump(self, decoded, dest, prev):
+        if not dest.isdigit():
+            self.emit('if {} == {}:'.format(dest, decoded.address))
+            self.indent += 1
+            self.emit_stuck(decoded, dest, prev)
+            self.indent -= 1
+        elif int(dest) == decoded.address:
+            self.emit_stuck(decoded, dest, prev)
+            return
+
+        self.emit('return {}, {}, {}'.format(dest, decoded.address,
+                                             self.count))
+
+    def emit_stuck(self, decoded, dest, prev):
+        self.emit('stuck(vm, {}, {}, {}, {})'.format(
+            decoded.address, 'prev' if prev is None else prev,
+            self.count - 1, dest
+        ))
+
+    def emit_sequence(self, sequence):
+        self.emit('def fused_{}(vm, m, prev, stop):'.format(sequence[0].address))
+        self.indent += 1
+
+        prev = None  # Only known at runtime for the first instruction
+        for i, decoded in enumerate(sequence):
+            self.count = i + 1
+            instruction_class = self.instruction_classes[decoded.mnem]
+            args = self.args(decoded)
+
+            if instruction_class in DATA_TEMPLATES:
+                template = DATA_TEMPLATES[instruction_class]
+                self.emit_store(decoded.args[0],
+                                template.format(decoded.args[0], *args[1:]))
+
+            else:
+                dest, condition = JUMP_TEMPLATES[instruction_class]
+                if condition is None:
+                    self.emit_jump(decoded, dest.format(*args), prev)
+                    break
+
+                self.emit('if {}:'.format(condition.format(*args)))
+                self.indent += 1
+                self.emit_jump(decoded, dest.format(*args), prev)
+                self.indent -= 1
+
+            prev = decoded.address
+
+        else:
+            last = sequence[-1]
+            self.emit('return {}, {}, {}'.format(last.address + last.size,
+                                                 last.address, len(sequence)))
+
+        self.indent -= 1
+        self.emit('fused_{0}.size = {1}'.format(sequence[0].address,
+                                                len(sequence)))
+
+
+def fuse(program, instruction_classes, memory_size):
+    """
+    Build the superinstructions of a program.
+
+    :type program: decoder.Program
+    :type instruction_classes: dict[str, type]
+    :returns: the superinstruction starting at every address, None if there
+              is none. Their `size` is the number of fused instructions.
+    :rtype: list[function]
+    """
+    sequences = find_sequences(program, instruction_classes, memory_size)
+
+    generator = FusionGenerator(program, instruction_classes)
+    for sequence in sequences:
+        generator.emit_sequence(sequence)
+
+    namespace = {'stuck': stuck}
+    exec(compile('\n'.join(generator.lines), '<tiny-fused>', 'exec'),
+         namespace)
+
+    fused = [None] * len(program)
+    for sequence in sequences:
+        address = sequence[0].address
+        fused[address] = namespace['fused_{}'.format(address)]
+
+    return fused
@@ -1,18 +1,8 @@
-import inspect
 import sys
 from collections import OrderedDict
+from contextlib import contextmanager
 
-from colors import red, yellow, magenta
-
-from config import TESTING, DEBUG
-
-
-def debug(*args):
-    """
-    Debug output
-    """
-    if DEBUG:
-        print(magenta(('{} ' * len(args)).format(*args)))
+from config import TESTING
 
 
 def neighborhood(iterable):
@@ -20,7 +10,11 @@ def neighborhood(iterable):
     Yield the list as (item, next item).
     """
     iterator = iter(iterable)
-    item = next(iterator)  # throws StopIteration if empty.
+
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return  # Empty iterable, nothing to yield
 
     for _next in iterator:
         yield (item, _next)
@@ -29,21 +23,41 @@ def neighborhood(iterable):
     yield (item, None)
 
 
-def get_ordered_annotations(func):
+def get_ordered_annotations(func, skip=0):
     """
-    Get annotations for function as an OrderedDict
+    Get annotations for function as an OrderedDict, None for parameters
+    without one. Reads the code object directly, importing `inspect` is slow.
+
+    :param skip: number of leading parameters to leave out, e.g. `self`
     """
+    code = func.__code__
+    names = code.co_varnames[:code.co_argcount + code.co_kwonlyargcount]
+    if code.co_flags & 0x04:  # *args
+        names += (code.co_varnames[len(names)],)
+
     annotations = OrderedDict()
-    signature = inspect.signature(func)
-    for parameter in signature.parameters.values():
-        annotations[parameter.name] = parameter.annotation
+    for name in names[skip:]:
+        annotations[name] = func.__annotations__.get(name)
 
-    if signature.return_annotation != signature.empty:
-        annotations['return'] = signature.return_annotation
+    if 'return' in func.__annotations__:
+        annotations['return'] = func.__annotations__['return']
 
     return annotations
 
 
+def colored(color, s):
+    """
+    Color a string for printing to stdout, if stdout is a terminal.
+
+    :param color: a function from the `colors` package, e.g. 'red'
+    """
+    if not sys.stdout.isatty():
+        return s
+
+    import colors
+    return getattr(colors, color)(s)
+
+
 ###############################################################################
 # ERROR HANDLING
 ###############################################################################
@@ -57,7 +71,7 @@ def fatal_error(msg, exc_class, line=None, exit_func=lambda: sys.exit(1)):
         if line:
             msg = line_error(msg, line)
 
-        print(red('FATAL ERROR:'), msg)
+        print(colored('red', 'FATAL ERROR:'), msg)
         exit_func()
 
 
@@ -68,7 +82,7 @@ def syntax_error(msg, exc_class, line=None, exit_func=lambda: sys.exit(1)):
         if line:
             msg = line_error(msg, line)
 
-        print(red('SYNTAX ERROR:'), msg)
+        print(colored('red', 'SYNTAX ERROR:'), msg)
         exit_func()
 
 
@@ -78,7 +92,27 @@ def warn(msg, exc_class, line=None):
     else:
         if line:
             msg = line_error(msg, line)
-        print(yellow('WARNING:'), msg)
+        print(colored('yellow', 'WARNING:'), msg)
+
+
+@contextmanager
+def raise_errors():
+    """
+    Raise errors and warnings as exceptions instead of printing them and
+    exiting, like when testing.
+    """
+    global TESTING
+
+    testing, TESTING = TESTING, True
+    try:
+        yield
+    finally:
+        TESTING = testing
+
+
+def format_error(e):
+    """ Describe an exception as '<class name>: <message>' """
+    return '{}: {}'.format(type(e).__name__, e)
 
 
 def line_error(msg, line):
@@ -0,0 +1,283 @@
+"""
+Tiny-ASM counted loop optimization.
+
+Recognizes simple counted loops and runs them in closed form, e.g. the
+multiplication loop in `lib/math/multiply.asm`:
+
+    loop:
+    JEQ :done $arg1 $counter
+    ADD $counter 1
+    ADD $return $arg0
+    JMP :loop
+
+A loop qualifies if it consists of a conditional jump out of the loop
+(JEQ, JZ, JLS or JGT), a body of ADDs and SUBs and a JMP back to the
+conditional jump. The body may only add values that don't change inside
+the loop, so every cell changes by the same amount every iteration.
+
+When the loop is entered, the number of iterations is solved for from the
+exit condition, with the word size's wraparound. Then all changes are applied
+at once and the ticks are counted as if the loop had run normally.
+
+If the iteration count can't be solved (e.g. the loop never ends, or a
+JLS/JGT operand would wrap around) or the loop would run past the tick
+limit, the loop is run by the regular superinstruction.
+"""
+from math import gcd
+
+from compiler import instruction_boundaries
+from opcodes import *
+
+
+# Instructions the loop body may consist of and their sign
+BODY = {AddInstruction: 1, SubInstruction: -1}
+
+# Exit conditions
+CONDITIONS = (JeqInstruction, JzInstruction, JlsInstruction, JgtInstruction)
+
+
+###############################################################################
+# SOLVING
+###############################################################################
+
+def solve_equal(a, da, b, db, max_int):
+    """
+    Get the smallest n with a + n * da == b + n * db (modulo max_int), None
+    if there is none.
+    """
+    step = (da - db) % max_int
+    diff = (b - a) % max_int
+    if diff == 0:
+        return 0
+
+    divisor = gcd(step, max_int)
+    if diff % divisor:
+        return None
+
+    modulus = max_int // divisor
+    return diff // divisor * pow(step // divisor, -1, modulus) % modulus
+
+
+def solve_less(x, dx, v, max_int):
+    """
+    Get the smallest n with x + n * dx < v, None if there is none or x would
+    wrap around before.
+    """
+    if x < v:
+        return 0
+    if dx == 0 or dx <= max_int // 2:
+        return None  # Doesn't decrease
+
+    step = max_int - dx
+    n = (x - v) // step + 1
+    if x - n * step < 0:
+        return None
+
+    return n
+
+
+def solve_greater(x, dx, v, max_int):
+    """
+    Get the smallest n with x + n * dx > v, None if there is none or x would
+    wrap around before.
+    """
+    if x > v:
+        return 0
+    if dx == 0 or dx > max_int // 2:
+        return None  # Doesn't increase
+
+    n = (v - x) // dx + 1
+    if x + n * dx >= max_int:
+        return None
+
+    return n
+
+
+def solve(condition, a, da, b, db, max_int):
+    """
+    Get the number of iterations until the condition `condition(a, b)` is
+    true, if `a` and `b` change by `da` and `db` every iteration.
+    """
+    if condition is JzInstruction:
+        return solve_equal(a, da, 0, 0, max_int)
+    if condition is JeqInstruction:
+        return solve_equal(a, da, b, db, max_int)
+
+    if da and db:
+        return None
+
+    if condition is JgtInstruction:
+        # a > b is b < a
+        a, da, b, db = b, db, a, da
+
+    if db == 0:
+        return solve_less(a, da, b, max_int)
+    else:
+        return solve_greater(b, db, a, max_int)
+
+
+###############################################################################
+# LOOPS
+###############################################################################
+
+class CountedLoop(object):
+    """
+    A loop run in closed form, used like a superinstruction (see `fusion`).
+    """
+
+    def __init__(self, head, end, condition, operands, changes, length,
+                 max_int, fallback):
+        """
+        :param head: address of the exit condition
+        :param end: where the exit condition jumps to
+        :param condition: the exit condition's instruction class
+        :param operands: the exit condition's operands as (value, is_address)
+        :param changes: for every changed cell, the values added every
+                        iteration as (sign, value, is_address)
+        :param length: number of instructions in an iteration
+        :param fallback: the superinstruction starting at `head`
+        """
+        self.head = head
+        self.end = end
+        self.condition = condition
+        self.operands = operands
+        self.changes = changes
+        self.length = length
+        self.max_int = max_int
+        self.fallback = fallback
+
+        # Only checked against the tick limit if the loop isn't solved
+        self.size = fallback.size
+
+    def deltas(self, m):
+        """ Get the change of every changed cell per iteration """
+        return dict(
+            (cell, sum(sign * (m[value] if is_address else value)
+                       for sign, value, is_address in values) % self.max_int)
+            for cell, values in self.changes.items()
+        )
+
+    def __call__(self, vm, m, prev, stop):
+        deltas = self.deltas(m)
+
+        values = []
+        for value, is_address in self.operands:
+            if is_address:
+                values.append((m[value], deltas.get(value, 0)))
+            else:
+                values.append((value, 0))
+        if len(values) == 1:
+            values.append((0, 0))
+
+        (a, da), (b, db) = values
+        n = solve(self.condition, a, da, b, db, self.max_int)
+
+        ticks = n * self.length + 1 if n else 0
+        if not n or vm.ticks + ticks > stop:
+            return self.fallback(vm, m, prev, stop)
+
+        for cell, delta in deltas.items():
+            m[cell] = (m[cell] + n * delta) % self.max_int
+
+        return self.end, self.head, ticks
+
+
+def find_loop(program, jump, instruction_classes, memory_size):
+    """
+    Check, wether the JMP `jump` closes a counted loop. Returns the loop's
+    head, exit condition, body and where the exit condition jumps to, None if
+    it doesn't.
+    """
+    if jump.deref:
+        return None
+
+    head = jump.args[0]
+    if not 0 <= head < jump.address:
+        return None
+
+    test = program.instructions[head]
+    if test is None or instruction_classes[test.mnem] not in CONDITIONS:
+        return None
+
+    # A computed exit or one jumping to the JMP never leaves the loop
+    end = test.args[0]
+    if test.deref and test.deref[0] or end == jump.address:
+        return None
+
+    body = []
+    address = head + test.size
+    while address < jump.address:
+        decoded = program.instructions[address]
+        if decoded is None or instruction_classes[decoded.mnem] not in BODY:
+            return None
+
+        body.append(decoded)
+        address += decoded.size
+
+    # Without a body, nothing changes between the tests
+    if address != jump.address or not body:
+        return None
+
+    addresses = [decoded.args[0] for decoded in body]
+    addresses += [arg for decoded in body + [test] if decoded.deref
+                  for arg, deref in zip(decoded.args, decoded.deref)
+                  if deref]
+    if any(address >= memory_size for address in addresses):
+        return None
+
+    return head, test, body, end
+
+
+def optimize_loops(program, instruction_classes, word_size, memory_size,
+                   fused):
+    """
+    Replace the superinstructions at the heads of counted loops with
+    `CountedLoop`s.
+
+    :type program: decoder.Program
+    :param fused: the program's superinstructions, see `fusion.fuse`
+    :rtype: list
+    """
+    fused = list(fused)
+
+    for address in instruction_boundaries(program):
+        jump = program.instructions[address]
+        if instruction_classes[jump.mnem] is not JmpInstruction:
+            continue
+
+        loop = find_loop(program, jump, instruction_classes, memory_size)
+        if loop is None:
+            continue
+
+        head, test, body, end = loop
+        if fused[head] is None:
+            continue
+
+        changes = {}
+        for decoded in body:
+            is_address = bool(decoded.deref and decoded.deref[1])
+            changes.setdefault(decoded.args[0], []).append(
+                (BODY[instruction_classes[decoded.mnem]], decoded.args[1],
+                 is_address)
+            )
+
+        # Every iteration has to add the same values
+        if any(is_address and value in changes
+               for values in changes.values()
+               for _, value, is_address in values):
+            continue
+
+        operands = [(arg, bool(test.deref and test.deref[i + 1]))
+                    for i, arg in enumerate(test.args[1:])]
+
+        # A cell can never equal a literal it can't hold, the closed forms
+        # assume both sides are reduced
+        if any(not is_address and not 0 <= value < 2 ** word_size
+               for value, is_address in operands):
+            continue
+
+        fused[head] = CountedLoop(head, end, instruction_classes[test.mnem],
+                                  operands, changes, len(body) + 2,
+                                  2 ** word_size, fused[head])
+
+    return fused
@@ -0,0 +1,212 @@
+"""
+Tiny-ASM binary object format.
+
+Layout (all integers little endian):
+
+    header   magic 'TINY', version, token width (bytes), word size (bits),
+             entry point, number of tokens, number of symbols, length of
+             the source map (bytes, 0 for none)
+    code     the opcodes and arguments, one token per `width` bytes
+    symbols  for every symbol: address, length of the name (bytes, 16 bit),
+             name (utf-8)
+    sources  the source map, see `sourcemap`
+
+The code section directly follows the header, so it can be used as a
+memoryview of ints without copying it out of the buffer.
+"""
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from exc import AssemblerException, VirtualRuntimeError
+from helpers import fatal_error
+from sourcemap import SourceMap
+
+
+MAGIC = b'TINY'
+VERSION = 2
+
+HEADER = struct.Struct('<4sBBHIIII')
+SYMBOL = struct.Struct('<IH')
+
+# Token width in bytes → memoryview/array format
+FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+# Word sizes a program can be assembled for, one per token width
+WORD_SIZES = set(width * 8 for width in FORMATS)
+
+
+###############################################################################
+# SMALL HELPERS
+###############################################################################
+
+def is_object(data):
+    """ Check, wether the given data starts with an object file header """
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def token_width(tokens, word_size):
+    """ Get the smallest token width that fits the word size and all tokens """
+    largest = max(tokens, default=0)
+
+    for width in sorted(FORMATS):
+        if width * 8 >= word_size and largest < 2 ** (width * 8):
+            return width
+
+    fatal_error('Token too large for object file: {}'.format(largest),
+                AssemblerException)
+
+
+###############################################################################
+# OBJECT FILES
+###############################################################################
+
+class ObjectFile(object):
+    """
+    A loaded object file.
+
+    `code` is a memoryview into the loaded buffer, so keep the object around
+    as long as the code is used.
+    """
+
+    def __init__(self, code, word_size, entry=0, symbols=None,
+                 source_map=None, buffer=None):
+        #: :type: memoryview
+        self.code = code
+        self.word_size = word_size
+        self.entry = entry
+        #: :type: dict[str, int]
+        self.symbols = symbols or {}
+        #: :type: sourcemap.SourceMap
+        self.source_map = source_map
+
+        self._buffer = buffer  # Keep mmaps open
+
+    def close(self):
+        self.code.release()
+
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+
+def dumps(tokens, word_size, entry=0, symbols=None, source_map=None):
+    """
+    Build an object file.
+
+    :type tokens: list[int]
+    :type symbols: dict[str, int]
+    :type source_map: sourcemap.SourceMap
+    :rtype: bytes
+    """
+    symbols = symbols or {}
+    width = token_width(tokens, word_size)
+
+    code = array(FORMATS[width], tokens)
+    if sys.byteorder == 'big':
+        code.byteswap()
+
+    sources = source_map.dumps() if source_map is not None else b''
+
+    parts = [HEADER.pack(MAGIC, VERSION, width, word_size, entry,
+                         len(tokens), len(symbols), len(sources)),
+             code.tobytes()]
+
+    for name, address in symbols.items():
+        name = name.encode('utf-8')
+        if len(name) > 0xffff:
+            fatal_error('Symbol name too long for object file: {} '
+                        'bytes'.format(len(name)), AssemblerException)
+
+        parts.append(SYMBOL.pack(address, len(name)))
+        parts.append(name)
+
+    parts.append(sources)
+
+    return b''.join(parts)
+
+
+def loads(data):
+    """
+    Load an object file from a bytes-like object without copying the code.
+
+    :rtype: ObjectFile
+    """
+    view = memoryview(data)
+
+    if len(view) < HEADER.size or not is_object(view):
+        fatal_error('Not a Tiny object file', VirtualRuntimeError)
+
+    (magic, version, width, word_size, entry, num_tokens, num_symbols,
+     sources_size) = HEADER.unpack_from(view)
+
+    if version != VERSION:
+        fatal_error('Unsupported object file version: {}'.format(version),
+                    VirtualRuntimeError)
+
+    if width not in FORMATS:
+        fatal_error('Invalid token width: {}'.format(width),
+                    VirtualRuntimeError)
+
+    if word_size not in WORD_SIZES:
+        fatal_error('Invalid word size: {}'.format(word_size),
+                    VirtualRuntimeError)
+
+    code_end = HEADER.size + num_tokens * width
+    if len(view) < code_end:
+        fatal_error('Truncated object file', VirtualRuntimeError)
+
+    code = view[HEADER.size:code_end].cast(FORMATS[width])
+    if sys.byteorder == 'big' and width > 1:
+        # Wrong byte order, we have to copy after all
+        swapped = array(FORMATS[width], code)
+        swapped.byteswap()
+        code = memoryview(swapped)
+
+    # Read symbol table
+    symbols = {}
+    offset = code_end
+    for _ in range(num_symbols):
+        if len(view) < offset + SYMBOL.size:
+            fatal_error('Truncated object file', VirtualRuntimeError)
+
+        address, length = SYMBOL.unpack_from(view, offset)
+        offset += SYMBOL.size
+        if len(view) < offset + length:
+            fatal_error('Truncated object file', VirtualRuntimeError)
+
+        try:
+            name = bytes(view[offset:offset + length]).decode('utf-8')
+        except UnicodeDecodeError:
+            fatal_error('Corrupt symbol table', VirtualRuntimeError)
+        symbols[name] = address
+        offset += length
+
+    source_map = None
+    if sources_size:
+        if len(view) < offset + sources_size:
+            fatal_error('Truncated object file', VirtualRuntimeError)
+
+        try:
+            source_map = SourceMap.loads(view[offset:offset + sources_size])
+        except (struct.error, IndexError, UnicodeDecodeError):
+            fatal_error('Corrupt source map', VirtualRuntimeError)
+
+    return ObjectFile(code, word_size, entry, symbols, source_map, data)
+
+
+def load(path):
+    """
+    Memory-map an object file.
+
+    :rtype: ObjectFile
+    """
+    with open(path, 'rb') as f:
+        # Empty files can't be mapped, they're no object files either
+        if not os.fstat(f.fileno()).st_size:
+            return loads(b'')
+
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return loads(mapped)
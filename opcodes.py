@@ -1,13 +1,7 @@
-import random
-import sys
-from enum import Enum
-from colors import green
-from config import RAND_MAX
-
-
-class ArgTypes(Enum):
-    ADDRESS = 0
-    LITERAL = 1
+# Plain constants instead of enums, importing `enum` is slow
+class ArgTypes(object):
+    ADDRESS = 'address'
+    LITERAL = 'literal'
 
 ADDRESS = ArgTypes.ADDRESS
 LITERAL = ArgTypes.LITERAL
@@ -120,7 +114,8 @@ instructions = {
     },
     'AREAD': {
         # Custom opcode:
-        # Read one char from stdin and store the ASCII value at M[a]
+        # Read one char from the input and store the ASCII value at M[a],
+        # 0 at the end of the input
         # opcode | a
         '0x24': (ADDRESS,)
     }
@@ -143,9 +138,9 @@ opcodes = dict(
 # using annotations. If the instructions sets memory or does a jump, it's
 # return is annotated using the ReturnValue class.
 
-class ReturnValue(Enum):
-    DATA = 0  # Returns: register, data
-    JUMP = 1  # Returns: destination or None
+class ReturnValue(object):
+    DATA = 'data'  # Returns: register, data
+    JUMP = 'jump'  # Returns: destination or None
 
 
 class Instruction(object):
@@ -200,7 +195,8 @@ class MovInstruction(Instruction):
 
 class RandomInstruction(Instruction):
     def __call__(self, a: ADDRESS) -> ReturnValue.DATA:
-        return a, random.randint(0, RAND_MAX)
+        # The VM's own stream, see `rng`
+        return a, self.vm.random()
 
 
 ###############################################################################
@@ -274,10 +270,7 @@ class PrintInstruction(Instruction):
         raise NotImplementedError()
 
     def __call__(self, a: LITERAL):
-        s = str(self.convert(a))
-
-        self.vm.output.write(s)
-        sys.stdout.write(green(s))
+        self.vm.write(str(self.convert(a)))
 
 
 class AprintInstruction(PrintInstruction):
@@ -290,5 +283,13 @@ class DprintInstruction(PrintInstruction):
         return int(a)
 
 
+class AreadInstruction(Instruction):
+    def __call__(self, a: ADDRESS) -> ReturnValue.DATA:
+        # Show prompts before waiting for input
+        self.vm.flush()
+        c = self.vm.read()
+        return a, ord(c) if c else 0
+
+
 __all__ = ['LITERAL', 'ADDRESS', 'instructions', 'opcodes', 'ReturnValue']
 __all__ += [m for m in dir() if m.endswith('Instruction')]
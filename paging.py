@@ -0,0 +1,121 @@
+"""
+Tiny-ASM copy-on-write memory.
+
+`PagedMemory` splits the memory into pages of `PAGE_SIZE` cells, which can
+be shared between several memories. A shared page is copied the first time
+it's written to, so forked VMs (see `VirtualMachine.fork`) only pay for the
+pages they actually change.
+
+Reading a cell goes through a Python method instead of the typed array, so
+a VM is a bit slower once it has been forked.
+"""
+from ctypes import sizeof
+
+
+# Cells per page, has to be a power of two
+PAGE_SIZE = 64
+
+
+class PagedMemory(object):
+    """
+    Memory made up of shared pages.
+
+    Behaves like the VM's typed memory, i.e. storing a value wraps it around
+    to the word size.
+    """
+
+    def __init__(self, pages, cell_type, size, page_size=PAGE_SIZE):
+        #: :type: list[ctypes.Array]
+        self.pages = pages
+        #: Wether the page belongs to this memory only and may be written
+        #: :type: bytearray
+        self.owned = bytearray(len(pages))
+        self.cell_type = cell_type
+        self.size = size
+        self.page_size = page_size
+
+        self.shift = page_size.bit_length() - 1
+        self.mask = page_size - 1
+
+    @classmethod
+    def from_memory(cls, memory, page_size=PAGE_SIZE):
+        """
+        Split the VM's typed memory into pages.
+
+        :type memory: ctypes.Array
+        """
+        if page_size & (page_size - 1):
+            raise ValueError('Page size has to be a power of two')
+
+        cell_type = memory._type_
+        cell_size = sizeof(cell_type)
+
+        pages = []
+        for start in range(0, len(memory), page_size):
+            length = min(page_size, len(memory) - start)
+            pages.append((cell_type * length).from_buffer_copy(
+                memory, start * cell_size
+            ))
+
+        return cls(pages, cell_type, len(memory), page_size)
+
+    def fork(self):
+        """
+        Get a new memory with the same contents. All pages are shared
+        afterwards, both memories copy them before writing.
+
+        :rtype: PagedMemory
+        """
+        self.owned = bytearray(len(self.pages))
+        return PagedMemory(list(self.pages), self.cell_type, self.size,
+                           self.page_size)
+
+    def copy_page(self, index):
+        page = self.pages[index]
+        self.pages[index] = type(page).from_buffer_copy(page)
+        self.owned[index] = 1
+
+    def owned_pages(self):
+        """ Get the number of pages that have been copied """
+        return sum(self.owned)
+
+    ###########################################################################
+    # ACCESS
+    ###########################################################################
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        return self.pages[i >> self.shift][i & self.mask]
+
+    def __setitem__(self, i, value):
+        index = i >> self.shift
+        if not self.owned[index]:
+            self.copy_page(index)
+
+        self.pages[index][i & self.mask] = value
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def tolist(self):
+        cells = []
+        for page in self.pages:
+            cells.extend(page)
+
+        return cells
+
+    def update(self, cells):
+        """
+        Overwrite the memory with a list of cells. Only the pages with
+        changed cells are written to.
+        """
+        for index, page in enumerate(self.pages):
+            start = index << self.shift
+            new = cells[start:start + len(page)]
+
+            if page[:] != new:
+                if not self.owned[index]:
+                    self.copy_page(index)
+                self.pages[index][:] = new
@@ -1,15 +1,65 @@
-from collections import namedtuple
+import re
+
+# A char constant (which may be a space or a semicolon), a comment or any
+# other run of non-whitespace
+TOKEN = re.compile(r"'(?:\\.|[^'\\])'(?!\S)|;.*|[^\s;]+")
+
+
+class Line(object):
+    """
+    A line of source code, as tokens.
+
+    The contents are tokenized once when the line is read, the preprocessors
+    work on the tokens and only build a new line if they change any.
+
+    Lines generated by a macro keep the position of the line using the macro,
+    `macro` is the macro's name then (e.g. '@call').
+    """
+    __slots__ = ('lineno', 'filename', 'original_contents', '_contents',
+                 'tokens', 'macro')
+
+    def __init__(self, lineno, filename, original_contents, contents=None,
+                 tokens=None, macro=None):
+        self.lineno = lineno
+        self.filename = filename
+        self.original_contents = original_contents
+        self._contents = contents
+        #: :type: tuple[str]
+        self.tokens = tuple(TOKEN.findall(contents)) if tokens is None \
+            else tokens
+        self.macro = macro
+
+    @property
+    def contents(self):
+        """
+        The line as code, the tokens are only joined if it's asked for
+        """
+        if self._contents is None:
+            self._contents = ' '.join(self.tokens)
+        return self._contents
+
+    def __repr__(self):
+        return 'Line({!r}, {!r}, {!r}, {!r})'.format(
+            self.lineno, self.filename, self.original_contents, self.contents
+        )
+
+
+def set_contents(line, contents):
+    return Line(line.lineno, line.filename, line.original_contents, contents,
+                macro=line.macro)
+
+
+def set_tokens(line, tokens):
+    return Line(line.lineno, line.filename, line.original_contents,
+                tokens=tuple(tokens), macro=line.macro)
 
-Line = namedtuple('Line', ['lineno', 'filename', 'original_contents',
-                           'contents'])
-set_contents = lambda line, contents: Line(line.lineno, line.filename,
-                                           line.original_contents, contents)
 
 from . chars import preprocessor_chars
 from . comments import preprocessor_comments
 from . constants import preprocessor_constants
 from . imports import preprocessor_import
 from . labels import preprocessor_labels
+from . optimize import preprocessor_optimize
 from . subroutine import preprocessor_subroutine
 
 
@@ -22,19 +72,32 @@ def prepare_source_code(filename, source_code):
     return code
 
 
-def preprocess(source_code, filename):
+def preprocess(source_code, filename, symbols=None, search_paths=(),
+               optimize=False):
     """
+    The preprocessors are chained generators, so every line streams through
+    all of them. Only the stages that need to look at the whole program
+    (subroutines and labels) keep the lines they got.
+
     :type source_code: str
+    :param symbols: if given, the label addresses are stored in this dict
+    :type symbols: dict[str, int]
+    :param search_paths: directories to look up imported files in
+    :param optimize: remove code without effect, see `preprocessor_optimize`
     """
     # Prepare source code for processing
     code = prepare_source_code(filename, source_code)
 
     # Run preprocessors
-    preprocessors = (preprocessor_import, preprocessor_comments,
-                     preprocessor_subroutine, preprocessor_constants,
-                     preprocessor_labels, preprocessor_chars)
+    preprocessors = [lambda lines: preprocessor_import(lines, search_paths),
+                     preprocessor_comments,
+                     preprocessor_subroutine, preprocessor_constants]
+    if optimize:
+        preprocessors.append(preprocessor_optimize)
+    preprocessors += [lambda lines: preprocessor_labels(lines, symbols),
+                      preprocessor_chars]
 
     for preprocessor in preprocessors:
-        code = list(preprocessor(code))
+        code = preprocessor(code)
 
-    return code
+    return list(code)
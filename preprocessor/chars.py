@@ -1,4 +1,4 @@
-from preprocessor import set_contents
+from preprocessor import set_tokens
 
 
 def is_char(c):
@@ -39,13 +39,11 @@ def preprocessor_chars(lines):
     """
 
     for line in lines:
-        contents = line.contents
-
-        # Convert spaces before splitting!
-        # Otherwise line.split() will result in a big mess
-        contents = contents.replace("' '", str(ord(' ')))
-        tokens = contents.split()
-
-        # Process chars
-        tokens = [char_to_int(tok) if is_char(tok) else tok for tok in tokens]
-        yield set_contents(line, ' '.join(tokens))
+        # Char constants are single tokens, even if they're a space
+        for token in line.tokens:
+            if token[0] == "'":
+                line = set_tokens(line, [char_to_int(token) if is_char(token)
+                                         else token for token in line.tokens])
+                break
+
+        yield line
@@ -1,4 +1,4 @@
-from preprocessor import set_contents
+from preprocessor import set_tokens
 
 
 SEPARATOR = ';'
@@ -20,14 +20,15 @@ def preprocessor_comments(lines):
     :type lines: list[Line]
     """
     for line in lines:
-        contents = line.contents.strip()
+        tokens = line.tokens
 
-        # Line comment, skip to next one
-        if contents and contents[0] == ';':
+        # Empty line or line comment, skip to next one
+        if not tokens or tokens[0][0] == SEPARATOR:
             continue
 
-        # Remove trailing comment
-        contents = contents.split(SEPARATOR)[0].strip()
+        # Remove trailing comment, the tokenizer keeps it as the last token
+        if tokens[-1][0] == SEPARATOR:
+            yield set_tokens(line, tokens[:-1])
+            continue
 
-        if contents:
-            yield set_contents(line, contents)
+        yield line
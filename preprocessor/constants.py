@@ -1,9 +1,10 @@
 from itertools import count
 
 from config import MEMORY_SIZE
-from exc import AssemblerException, RedefinitionWarning, NoSuchConstantError
-from helpers import fatal_error, neighborhood, warn, debug
-from preprocessor import set_contents
+from exc import AssemblerException, AssemblerSyntaxError, \
+    RedefinitionWarning, NoSuchConstantError
+from helpers import fatal_error, warn
+from preprocessor import set_tokens
 
 
 automem_counter = count()
@@ -38,20 +39,38 @@ def preprocessor_constants(lines):
     automem_counter = count()
     constants = {}
 
-    for lineno, line in enumerate(lines):
-        tokens = []
-        iterator = iter(line.contents.split())
+    for line in lines:
+        tokens = line.tokens
+
+        # Most lines don't use constants, pass them on as they are
+        for token in tokens:
+            if token[0] == '$':
+                break
+        else:
+            yield line
+            continue
+
+        replaced = []
         is_assignment_line = False
+        i = 0
 
         # Process all tokens in this line
-        for token, next_token in neighborhood(iterator):
+        while i < len(tokens):
+            token = tokens[i]
+            i += 1
+
             if token[0] == '$':
                 const_name = token[1:]
 
-                if next_token == '=':
+                if i < len(tokens) and tokens[i] == '=':
                     # Found assignment, store the associated value
                     is_assignment_line = True
-                    value = next(iterator)
+                    try:
+                        value = tokens[i + 1]
+                    except IndexError:
+                        fatal_error('Missing value for ${}'.format(const_name),
+                                    AssemblerSyntaxError, line)
+                    i += 2
 
                     if const_name in constants:
                         warn('Redefined ${}'.format(const_name),
@@ -66,16 +85,15 @@ def preprocessor_constants(lines):
                 else:
                     # Found usage of constant, replace with stored value
                     try:
-                        tokens.append(constants[const_name])
+                        replaced.append(constants[const_name])
                     except KeyError:
                         fatal_error('No such constant: ${}'.format(const_name),
                                     NoSuchConstantError, line)
 
             else:
                 # Uninteresting token
-                tokens.append(token)
+                replaced.append(token)
 
         # Skip assignment lines
         if not is_assignment_line:
-            debug('Constants:', constants)
-            yield set_contents(line, ' '.join(tokens))
+            yield set_tokens(line, replaced)
@@ -1,15 +1,95 @@
+import os
+
+from cache import sources
 from helpers import fatal_error
 from preprocessor import Line
+from preprocessor.comments import preprocessor_comments
+
+
+DIRECTIVES = ('#import', '#include')
+
+
+def process_file(path):
+    """
+    Get a function that converts a file's contents into a line block.
+    Comments are processed right away, so cached blocks can be reused as
+    they are.
+    """
+    def process(contents):
+        return preprocessor_comments(
+            Line(i, path, l.strip(), l.strip())
+            for i, l in enumerate(contents.splitlines())
+        )
+
+    return process
+
+
+def read_source(path):
+    """
+    Get the file at `path` from the source cache.
 
+    :rtype: cache.SourceFile
+    """
+    return sources.get(path, process_file(path))
+
+
+def import_path(line):
+    """
+    Get the path of an import directive, None if it's no import.
+
+    :type line: Line
+    """
+    tokens = line.tokens
 
-def read_file(path):
-    try:
-        return open(path).readlines()
-    except UnicodeDecodeError:
-        return open(path, encoding='utf-8').readlines()
+    if tokens and tokens[0] in DIRECTIVES:
+        return ' '.join(tokens[1:])
 
 
-def preprocessor_import(lines):
+def resolve(path, importing_file, search_paths=()):
+    """
+    Find an imported file. Relative paths are looked up relative to the
+    importing file first, then in the search paths.
+
+    Returns the absolute path or None if the file doesn't exist.
+    """
+    if os.path.isabs(path):
+        candidates = [path]
+    else:
+        candidates = [os.path.join(os.path.dirname(importing_file), path)]
+        candidates += [os.path.join(directory, path)
+                       for directory in search_paths]
+
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return os.path.abspath(candidate)
+
+
+def import_chain(lines):
+    """
+    Describe where a file has been imported from.
+
+    :type lines: list[Line]
+    """
+    return ''.join('\n  imported from {}:{}'.format(line.filename,
+                                                    line.lineno + 1)
+                   for line in reversed(lines))
+
+
+def imported_files(lines, search_paths=()):
+    """
+    Get the absolute paths and content hashes of all imported files.
+
+    :type lines: list[Line]
+    :rtype: list[(str, str)]
+    """
+    imported = []
+    for _ in preprocessor_import(lines, search_paths, imported):
+        pass
+
+    return [(path, read_source(path).digest) for path in imported]
+
+
+def preprocessor_import(lines, search_paths=(), imported=None):
     """
     Process import directives.
 
@@ -19,7 +99,7 @@ def preprocessor_import(lines):
         APRINT '!'
 
     b.asm:
-        #include a.asm
+        #import a.asm
         HALT
 
     Results in:
@@ -27,35 +107,49 @@ def preprocessor_import(lines):
         APRINT '!'
         HALT
 
+    `#include` is accepted as an alias of `#import`. Imported files are
+    looked up relative to the importing file, then in `search_paths`.
+
     Note: A file will be imported only once. A file cannot import the importing
     file.
 
     :type lines: list[Line]
+    :param imported: if given, the absolute paths of the imported files are
+                     appended to this list
     """
-    lines = list(lines)
     included = set()  # Files we already included
 
-    while lines:
-        # Take the first line from the stack
-        line = lines.pop(0)
-        contents = line.contents.strip()
-
-        if contents.startswith('#import'):
-            path = contents.split('#import')[1].strip()
-
-            if path not in included:
-                # Put the new contents to the top of the stack
-                to_include = None
-                try:
-                    to_include = read_file(path)
-                except FileNotFoundError:
-                    fatal_error('File not found: {}'.format(path),
-                                FileNotFoundError, line)
-
-                # Insert lines into the current position
-                lines[0:0] = [Line(i, path, l.strip(), l.strip())
-                              for i, l in enumerate(to_include)]
-                included.add(path)
+    # Stack of the lines we're iterating over and the import directive
+    # that brought us there
+    stack = [(iter(lines), None)]
+
+    while stack:
+        for line in stack[-1][0]:
+            path = import_path(line)
+            if path is None:
+                # No includes to process, yield the line
+                yield line
+                continue
+
+            resolved = resolve(path, line.filename, search_paths)
+            if resolved is None:
+                chain = [importer for _, importer in stack[1:]]
+                fatal_error('File not found: {}{}'.format(
+                    path, import_chain(chain)
+                ), FileNotFoundError, line)
+                continue
+
+            if resolved in included:
+                continue
+
+            included.add(resolved)
+            if imported is not None:
+                imported.append(resolved)
+
+            # Continue with the imported file
+            stack.append((iter(read_source(resolved).lines), line))
+            break
+
         else:
-            # No includes to process, yield the line
-            yield line
+            # Reached the end of the file
+            stack.pop()
@@ -1,34 +1,9 @@
 from exc import NoSuchLabelError, RedefinitionError
-from helpers import debug, fatal_error
-from preprocessor import set_contents
+from helpers import fatal_error
+from preprocessor import set_tokens
 
 
-def collect_labels(lines):
-    labels = {}
-
-    token_count = 0
-
-    # Pass 1: Collect labels
-    for line in lines:
-        tokens = line.contents.split()
-
-        for index, token in enumerate(tokens):
-            if token[-1] == ':':
-                # Label definition
-                label = token[:-1]
-
-                if label in labels:
-                    fatal_error('Redefinition of label: ' + label,
-                                RedefinitionError, line)
-
-                labels[label] = token_count + index - len(labels)
-
-        token_count += len(tokens)
-
-    return labels
-
-
-def preprocessor_labels(lines):
+def preprocessor_labels(lines, symbols=None):
     """
     Replace labels with the referenced instruction number.
 
@@ -41,37 +16,80 @@ def preprocessor_labels(lines):
 
         GOTO 0
 
+    Runs in a single pass: references to labels that are already defined
+    are replaced right away, forward references are recorded in a fixup
+    table and patched once all labels are known.
+
     :type lines: list[Line]
+    :param symbols: if given, the label addresses are stored in this dict
+    :type symbols: dict[str, int]
     """
-    labels = collect_labels(lines)
+    labels = {}
+
+    # The processed lines, either as they are or as (line, tokens) if they
+    # contain labels
+    code = []
+
+    # Forward references: (index in `code`, index in tokens, label, line)
+    fixups = []
+
+    address = 0
 
-    # Update references
     for line in lines:
+        for token in line.tokens:
+            if token[0] == ':' or token[-1] == ':':
+                break
+        else:
+            # Nothing to replace
+            if line.tokens:
+                code.append(line)
+                address += len(line.tokens)
+            continue
+
         tokens = []
 
-        for token in line.contents.split():
+        for token in line.tokens:
+
+            # Label definitions
+            if token[-1] == ':':
+                label = token[:-1]
+
+                if label in labels:
+                    fatal_error('Redefinition of label: ' + label,
+                                RedefinitionError, line)
+
+                labels[label] = address
+                continue
 
             # Label usage
             if token[0] == ':':
-                label_name = token[1:]
+                label = token[1:]
 
-                try:
-                    instruction_no = labels[label_name]
-                except KeyError:
-                    fatal_error('No such label: {}'.format(label_name),
-                                NoSuchLabelError, line)
+                if label in labels:
+                    token = str(labels[label])
                 else:
-                    tokens.append(str(instruction_no))
-
-            # Label definitions
-            elif token[-1] == ':':
-                # Skip
-                continue
+                    fixups.append((len(code), len(tokens), label, line))
 
-            else:
-                tokens.append(token)
+            tokens.append(token)
+            address += 1
 
-        # If there any tokens left, yield them
+        # If there any tokens left, keep them
         if tokens:
-            debug('Labels:', labels)
-            yield set_contents(line, ' '.join(tokens))
+            code.append((line, tokens))
+
+    # Patch the forward references
+    for index, token_index, label, line in fixups:
+        try:
+            code[index][1][token_index] = str(labels[label])
+        except KeyError:
+            fatal_error('No such label: {}'.format(label),
+                        NoSuchLabelError, line)
+
+    if symbols is not None:
+        symbols.update(labels)
+
+    for line in code:
+        if isinstance(line, tuple):
+            line = set_tokens(*line)
+
+        yield line
@@ -0,0 +1,216 @@
+from itertools import islice
+
+from opcodes import instructions
+from preprocessor import set_tokens
+
+
+JUMPS = {'JMP', 'JZ', 'JEQ', 'JLS', 'JGT'}
+
+# Instructions that write their first argument without reading it
+WRITES = {'MOV', 'NOT', 'RANDOM', 'AREAD'}
+
+# Instructions that may be removed if their result is never used. RANDOM and
+# AREAD have side effects (the random state and the input).
+REMOVABLE = {'MOV', 'NOT', 'ADD', 'SUB', 'AND', 'OR', 'XOR'}
+
+# How far to look for an instruction overwriting a store
+MAX_DISTANCE = 32
+
+
+def address(arg):
+    """
+    Get the address of a `[..]` argument as an int, so `[0]` and `[00]` are
+    the same cell. None if it's no address.
+    """
+    if arg[0] == '[':
+        return int(arg[1:-1])
+
+
+class Instruction(object):
+    """ An instruction along with the labels pointing to it """
+
+    def __init__(self, labels, mnem, args, line):
+        #: :type: list[str]
+        self.labels = labels
+        self.mnem = mnem
+        #: :type: list[str]
+        self.args = args
+        #: The addresses of the `[..]` arguments, None for the others
+        self.addresses = [address(arg) for arg in args]
+        self.line = line
+
+    def target(self):
+        """ Get the label a jump points to, None if it's computed """
+        if self.args[0][0] == ':':
+            return self.args[0][1:]
+
+    def reads(self):
+        """ Get the addresses the instruction reads from """
+        addresses = self.addresses
+        if self.mnem in WRITES:
+            addresses = addresses[1:]
+        return set(a for a in addresses if a is not None)
+
+    def tokens(self):
+        return [label + ':' for label in self.labels] + \
+            [self.mnem] + self.args
+
+
+def parse(lines):
+    """
+    Split the code into instructions. Returns None if the code can't be
+    optimized, e.g. because it can't be parsed or jumps to fixed addresses.
+
+    :type lines: list[Line]
+    :returns: the instructions and the labels at the end of the code
+    """
+    code = []
+    labels = []
+    tokens = iter([(token, line) for line in lines for token in line.tokens])
+
+    for token, line in tokens:
+        if token[-1] == ':':
+            labels.append(token[:-1])
+            continue
+
+        mnem = token.upper()
+        if mnem not in instructions:
+            return None
+
+        num_args = len(next(iter(instructions[mnem].values())))
+        args = list(islice(tokens, num_args))
+        if len(args) != num_args or \
+                any(arg_line is not line for _, arg_line in args):
+            return None
+
+        try:
+            instruction = Instruction(labels, mnem,
+                                      [arg for arg, _ in args], line)
+        except ValueError:
+            return None
+        labels = []
+
+        # Jumps to fixed addresses break once we move code around
+        if mnem in JUMPS and instruction.args[0][0] not in ':[':
+            return None
+
+        code.append(instruction)
+
+    return code, labels
+
+
+###############################################################################
+# OPTIMIZATIONS
+###############################################################################
+# Every optimization checks, wether the instruction at `i` can be removed.
+
+def is_self_move(code, i):
+    """ MOV [a] [a] """
+    instruction = code[i]
+    return instruction.mnem == 'MOV' and \
+        instruction.addresses[0] is not None and \
+        instruction.addresses[0] == instruction.addresses[1]
+
+
+def is_dead_store(code, i):
+    """ A store that's overwritten before it's read """
+    instruction = code[i]
+    if instruction.mnem not in REMOVABLE or \
+            instruction.addresses[0] is None:
+        return False
+
+    dest = instruction.addresses[0]
+    for following in code[i + 1:i + 1 + MAX_DISTANCE]:
+        if following.mnem in JUMPS or following.mnem == 'HALT' or \
+                dest in following.reads():
+            return False
+
+        if following.mnem in WRITES and following.addresses[0] == dest:
+            return True
+
+    return False
+
+
+def is_jump_to_next(code, i, end_labels):
+    """ A jump to the instruction that follows anyway """
+    instruction = code[i]
+    if instruction.mnem not in JUMPS:
+        return False
+
+    following = code[i + 1].labels if i + 1 < len(code) else end_labels
+    return instruction.target() in following
+
+
+def is_unreachable(code, i):
+    """ Code following a JMP that isn't jumped to """
+    return i > 0 and code[i - 1].mnem == 'JMP' and not code[i].labels
+
+
+def creates_stuck_jump(code, i):
+    """
+    Check, wether removing the instruction at `i` moves a label to a jump to
+    that label, which the VM reports as getting stuck.
+    """
+    if not i < len(code) - 1:
+        return False
+
+    following = code[i + 1]
+    return following.mnem in JUMPS and following.target() in code[i].labels
+
+
+def remove(code, i, end_labels):
+    """ Remove an instruction, its labels move to the next one """
+    labels = code.pop(i).labels
+
+    if i < len(code):
+        code[i].labels = labels + code[i].labels
+    else:
+        end_labels[:0] = labels
+
+
+def preprocessor_optimize(lines):
+    """
+    Remove code without any effect:
+
+    - moves from an address to itself
+    - stores that are overwritten before anything reads them (e.g. the
+      `MOV $return 0` of `@start` if the subroutine sets $return right away)
+    - jumps to the next instruction
+    - unreachable code following a JMP
+
+    Runs before the labels are resolved, so the jumps point to the right
+    instructions afterwards. Code that jumps to fixed addresses isn't
+    optimized. Computed jumps (e.g. `JMP $jump_back`) are expected to use
+    addresses from labels.
+
+    :type lines: list[Line]
+    """
+    lines = list(lines)
+
+    parsed = parse(lines)
+    if parsed is None:
+        yield from lines
+        return
+
+    code, end_labels = parsed
+
+    changed = True
+    while changed:
+        changed = False
+        i = 0
+
+        while i < len(code):
+            if (is_self_move(code, i) or is_dead_store(code, i) or
+                    is_jump_to_next(code, i, end_labels) or
+                    is_unreachable(code, i)) and \
+                    not creates_stuck_jump(code, i):
+                remove(code, i, end_labels)
+                changed = True
+            else:
+                i += 1
+
+    for instruction in code:
+        yield set_tokens(instruction.line, instruction.tokens())
+
+    if end_labels:
+        yield set_tokens(lines[-1], [label + ':' for label in end_labels])
@@ -1,20 +1,29 @@
 from itertools import count
 from exc import AssemblerSyntaxError, AssemblerNameError, AssemblerException
-from helpers import syntax_error, fatal_error, debug
+from helpers import syntax_error, fatal_error
 from preprocessor import Line
 
-line_counter = count()
 call_counter = count()
 
 
 def reset_counters():
-    global line_counter, call_counter
-    line_counter = count()
+    global call_counter
     call_counter = count()
 
 
-def build_line(contents):
-    return Line(next(line_counter), '<subroutine>', contents, contents)
+def build_line(contents, line, macro):
+    """ Build a line generated by `macro` in place of `line` """
+    return Line(line.lineno, line.filename, line.original_contents, contents,
+                macro=macro)
+
+
+def macro_call(line):
+    """
+    Get a line's macro call (e.g. `@call(name, $a)`), None if it has none.
+    """
+    tokens = line.tokens
+    if tokens and tokens[0][0] == '@':
+        return ' '.join(tokens)
 
 
 def verify_start(parts, line):
@@ -31,9 +40,9 @@ def collect_definitions(lines):
     subroutines = {}
 
     for line in lines:
-        contents = line.contents.strip()
+        contents = macro_call(line)
 
-        if contents.startswith('@start('):
+        if contents and contents.startswith('@start('):
             # : :type: list[str]
             contents = contents.replace('@start(', '')
 
@@ -70,15 +79,13 @@ def process_call(line, contents, subroutines):
         )
         fatal_error(msg, AssemblerException, line)
 
-    debug('@call of {}'.format(name))
-
     for i, arg in enumerate(args):
-        yield build_line('MOV $arg{} {}'.format(i, arg))
+        yield build_line('MOV $arg{} {}'.format(i, arg), line, '@call')
 
     counter = next(call_counter)
-    yield build_line('MOV $jump_back :ret{}'.format(counter))
-    yield build_line('JMP :{}'.format(name))
-    yield build_line('ret{}:'.format(counter))
+    yield build_line('MOV $jump_back :ret{}'.format(counter), line, '@call')
+    yield build_line('JMP :{}'.format(name), line, '@call')
+    yield build_line('ret{}:'.format(counter), line, '@call')
 
 
 def _subroutine_process_start(line, contents):
@@ -88,36 +95,35 @@ def _subroutine_process_start(line, contents):
 
     name = parts[0].replace('@start', '').strip('( ')
 
-    debug('@start: {}'.format(name))
-
-    yield build_line('{}:'.format(name))
-    yield build_line('MOV $return 0')
-    yield build_line('')
+    yield build_line('{}:'.format(name), line, '@start')
+    yield build_line('MOV $return 0', line, '@start')
+    yield build_line('', line, '@start')
 
 
 def preprocessor_subroutine(lines):
     reset_counters()
 
+    lines = list(lines)  # Needs two passes
     subroutines = collect_definitions(lines)
 
     if not subroutines:
         # Check, if there are calls w/o definition
         for line in lines:
-            if '@call' in line.contents:
+            if any(token.startswith('@call') for token in line.tokens):
                 fatal_error('@call without subroutine definition',
                             AssemblerException, line)
 
         yield from lines
         return
 
-    debug('{} subroutines found: {}'.format(len(subroutines), subroutines))
-
-    # Build preamble
-    yield build_line('$return = [_]')
-    yield build_line('$jump_back = [_]')
+    # Build preamble, it belongs to the first definition
+    first = next(line for line in lines
+                 if line.tokens and line.tokens[0].startswith('@start('))
+    yield build_line('$return = [_]', first, '@start')
+    yield build_line('$jump_back = [_]', first, '@start')
 
     for i in range(max(subroutines.values())):
-        yield build_line('$arg{} = [_]'.format(i))
+        yield build_line('$arg{} = [_]'.format(i), first, '@start')
 
     # Process start()/end()/call()
     in_subroutine = False
@@ -125,9 +131,12 @@ def preprocessor_subroutine(lines):
 
     for line in lines:
         #: :type: str
-        contents = line.contents.strip()
+        contents = macro_call(line)
+
+        if contents is None:
+            yield line
 
-        if contents.startswith('@call'):
+        elif contents.startswith('@call'):
             yield from process_call(line, contents, subroutines)
             call_count += 1
 
@@ -142,10 +151,8 @@ def preprocessor_subroutine(lines):
             if not in_subroutine:
                 assert False
 
-            debug('@end')
-
             in_subroutine = False
-            yield Line(0, '<subroutine>', '', 'JMP $jump_back')
+            yield build_line('JMP $jump_back', line, '@end')
 
         else:
             yield line
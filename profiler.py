@@ -0,0 +1,202 @@
+"""
+Tiny-ASM execution profiler.
+
+Counts how often every instruction is executed and how long it takes. The
+counts are reported per opcode, per instruction address (along with the
+source line it was assembled from), per label and per source file.
+
+Labels own every instruction up to the next label, so a subroutine's time is
+split between its name and its internal labels (e.g. `math_divide` and
+`math_div_loop`). The per-file report sums them up for library files
+containing a single subroutine.
+
+Enable it with `VirtualMachine(profile=True)`. The program is then run by a
+separate loop, the regular engines aren't slowed down.
+"""
+import json
+from bisect import bisect_right
+from collections import namedtuple
+
+from sourcemap import SourceMap
+
+
+# A row of a report: the name of what was measured, how often it was
+# executed and the time spent in seconds
+Row = namedtuple('Row', ['name', 'count', 'time'])
+
+
+class Profiler(object):
+    def __init__(self):
+        #: :type: decoder.Program
+        self.program = None
+        #: Executions and time by address
+        #: :type: list[int]
+        self.counts = []
+        #: :type: list[float]
+        self.times = []
+
+    def reset(self, program):
+        """
+        Start profiling a new program.
+
+        :type program: decoder.Program
+        """
+        self.program = program
+        self.counts = [0] * len(program)
+        self.times = [0.0] * len(program)
+
+    @property
+    def source_map(self):
+        """
+        Where the instructions come from. Looked up when reporting, the
+        source map may be attached to the program after loading it.
+
+        :rtype: sourcemap.SourceMap
+        """
+        if self.program is None or self.program.source_map is None:
+            return SourceMap()
+        return self.program.source_map
+
+    ###########################################################################
+    # AGGREGATION
+    ###########################################################################
+
+    def executed(self):
+        """ Get the addresses of all executed instructions """
+        return [address for address, count in enumerate(self.counts)
+                if count]
+
+    def aggregate(self, key):
+        """
+        Sum up the executed instructions by `key(address)`, most time
+        consuming first.
+
+        :rtype: list[Row]
+        """
+        counts = {}
+        times = {}
+
+        for address in self.executed():
+            name = key(address)
+            counts[name] = counts.get(name, 0) + self.counts[address]
+            times[name] = times.get(name, 0.0) + self.times[address]
+
+        rows = [Row(name, counts[name], times[name]) for name in counts]
+        rows.sort(key=lambda row: (-row.time, -row.count, str(row.name)))
+
+        return rows
+
+    def by_opcode(self):
+        def key(address):
+            decoded = self.program.instructions[address]
+            return '{} ({})'.format(decoded.mnem, decoded.opcode)
+
+        return self.aggregate(key)
+
+    def by_address(self):
+        return self.aggregate(lambda address: address)
+
+    def by_label(self):
+        """
+        Every instruction belongs to the nearest label before it, `None` for
+        the instructions before the first label.
+        """
+        symbols = sorted((address, label) for label, address
+                         in self.program.symbols.items())
+        addresses = [address for address, _ in symbols]
+
+        def key(address):
+            i = bisect_right(addresses, address)
+            return symbols[i - 1][1] if i else None
+
+        return self.aggregate(key)
+
+    def by_file(self):
+        def key(address):
+            line = self.source_map.get(address)
+            return line.filename if line else None
+
+        return self.aggregate(key)
+
+    ###########################################################################
+    # REPORTS
+    ###########################################################################
+
+    def source(self, address):
+        """ Describe where an address was assembled from """
+        line = self.source_map.get(address)
+        if line is None:
+            return ''
+
+        return '{}:{}  {}'.format(line.filename, line.lineno + 1,
+                                  line.original_contents.strip())
+
+    def report(self, limit=20):
+        """
+        Build the text report, showing at most `limit` rows per table.
+
+        :rtype: str
+        """
+        total = sum(self.times) or 1.0
+        sections = [
+            ('Opcodes', self.by_opcode(), str),
+            ('Labels', self.by_label(), str),
+            ('Files', self.by_file(), str),
+            ('Addresses', self.by_address(),
+             lambda address: '{:5}  {}'.format(address,
+                                               self.source(address))),
+        ]
+
+        lines = ['Executed {} instructions in {:.6f}s'.format(
+            sum(self.counts), sum(self.times)
+        )]
+
+        for title, rows, describe in sections:
+            lines.append('')
+            lines.append(title)
+            lines.append('  {:>10}  {:>6}  {:>10}  {}'.format(
+                'time (s)', '%', 'count', 'name'
+            ))
+
+            for row in rows[:limit]:
+                lines.append('  {:10.6f}  {:6.2f}  {:10}  {}'.format(
+                    row.time, row.time / total * 100, row.count,
+                    describe(row.name)
+                ))
+
+        return '\n'.join(lines)
+
+    def to_json(self):
+        """
+        Build the JSON report.
+
+        :rtype: dict
+        """
+        def rows(rows):
+            return [row._asdict() for row in rows]
+
+        addresses = rows(self.by_address())
+        for row in addresses:
+            decoded = self.program.instructions[row['name']]
+            line = self.source_map.get(row['name'])
+
+            row['mnem'] = decoded.mnem
+            row['label'] = self.program.label_at(row['name'])
+            row['file'] = line.filename if line else None
+            row['line'] = line.lineno + 1 if line else None
+            row['source'] = line.original_contents.strip() if line else None
+            row['macro'] = line.macro if line else None
+
+        return {
+            'count': sum(self.counts),
+            'time': sum(self.times),
+            'opcodes': rows(self.by_opcode()),
+            'labels': rows(self.by_label()),
+            'files': rows(self.by_file()),
+            'addresses': addresses,
+        }
+
+    def dump(self, path):
+        """ Write the JSON report to `path` """
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
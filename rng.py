@@ -0,0 +1,132 @@
+"""
+Tiny-ASM random numbers.
+
+Every VM draws the values of `RANDOM` from its own `Random`, so VMs don't
+affect each other's numbers and a run can be reproduced from its seed.
+
+The numbers are counter-based: chunk `n` of a stream is derived from
+(seed, stream, n) alone, by hashing them with SHAKE-256. So
+
+- every (seed, stream) pair is an independent stream, e.g. shard `i` of a
+  run across processes can use `Random(seed, stream=i)`. Both are 64 bit
+  unsigned ints, other ints are taken modulo 2**64 (so -1 is 2**64 - 1),
+- the state is just the number of values drawn so far, which makes it cheap
+  to save in snapshots and to continue from anywhere, see `Random.seek`.
+
+Values are generated in blocks of `block_size` values at a time, a single
+hash per chunk. The block size doesn't change the numbers.
+"""
+import os
+
+from config import RAND_MAX
+
+
+# Values per chunk, see the module's documentation
+CHUNK_SIZE = 256
+
+# Default values generated per refill
+BLOCK_SIZE = 4096
+
+# Seeds and streams are taken modulo this, so they fit in snapshots
+SEED_RANGE = 2 ** 64
+
+
+def random_seed():
+    """ Choose a random 64 bit seed """
+    return int.from_bytes(os.urandom(8), 'little')
+
+
+class Random(object):
+    """
+    A stream of random values from 0 to `high`.
+    """
+
+    def __init__(self, seed=None, stream=0, high=RAND_MAX,
+                 block_size=BLOCK_SIZE):
+        """
+        :param seed: a 64 bit unsigned int, a random one is chosen if None.
+                     Other ints are taken modulo 2**64.
+        :param stream: the stream of this seed to draw from, modulo 2**64
+                       like the seed
+        :param high: the largest value, at most 255
+        :param block_size: values to generate at a time, rounded to whole
+                           chunks
+        """
+        if not 0 <= high <= 255:
+            raise ValueError('Unsupported maximum value: {}'.format(high))
+
+        self.seed = random_seed() if seed is None else seed % SEED_RANGE
+        self.stream = stream % SEED_RANGE
+        self.high = high
+        self.chunks = max(block_size // CHUNK_SIZE, 1)
+
+        # Map the bytes of the hash to values by rejecting the ones that
+        # would make the smaller values more likely
+        span = high + 1
+        limit = 256 - 256 % span
+        self.table = bytes(b % span for b in range(256))
+        self.rejected = bytes(range(limit, 256))
+        # Bytes to hash per chunk, so it's very unlikely to come up short
+        self.chunk_bytes = CHUNK_SIZE * 256 // limit + 64
+
+        self.block = b''
+        self.index = 0
+        #: Number of the first chunk after the block
+        self.next_chunk = 0
+
+    def __call__(self):
+        """ Draw the next value """
+        index = self.index
+        if index == len(self.block):
+            self.refill()
+            index = 0
+
+        self.index = index + 1
+        return self.block[index]
+
+    def chunk(self, n):
+        """ Generate the `n`th chunk of the stream """
+        import hashlib
+
+        key = '{}:{}:{}'.format(self.seed, self.stream, n).encode()
+        values = b''
+        extra = 0
+
+        while len(values) < CHUNK_SIZE:
+            data = (key + b':%d' % extra) if extra else key
+            digest = hashlib.shake_256(data).digest(self.chunk_bytes)
+            values += digest.translate(self.table, self.rejected)
+            extra += 1
+
+        return values[:CHUNK_SIZE]
+
+    def refill(self):
+        """ Generate the next block """
+        first = self.next_chunk
+        self.block = b''.join(self.chunk(n)
+                              for n in range(first, first + self.chunks))
+        self.index = 0
+        self.next_chunk = first + self.chunks
+
+    @property
+    def position(self):
+        """ The number of values drawn so far """
+        return (self.next_chunk * CHUNK_SIZE) - len(self.block) + self.index
+
+    def seek(self, position):
+        """ Continue after the first `position` values of the stream """
+        chunk, index = divmod(position, CHUNK_SIZE)
+        self.block, self.index, self.next_chunk = b'', 0, chunk
+
+        if index:
+            self.refill()
+            self.index = index
+
+    def copy(self):
+        """ Get a stream continuing from the same position """
+        other = Random(self.seed, self.stream, self.high,
+                       self.chunks * CHUNK_SIZE)
+        other.block = self.block
+        other.index = self.index
+        other.next_chunk = self.next_chunk
+        return other
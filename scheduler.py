@@ -0,0 +1,116 @@
+"""
+Tiny-ASM VM scheduler.
+
+Runs many VMs cooperatively in one asyncio event loop, e.g. to host
+interactive programs for many users in one process. Every VM runs for a
+time slice and then yields to the others, so a long running program can't
+starve the rest. VMs waiting for input (see `sources.AsyncStream`) don't
+take any time at all until their input arrives.
+
+A time slice is measured in ticks (the quantum). The scheduler adjusts every
+VM's quantum, so its slices take about `TIME_SLICE` seconds, regardless of
+the engine and the program's instructions.
+
+    scheduler = Scheduler(max_ticks=10 ** 7, timeout=60)
+    results = await scheduler.run_all(vms)
+
+Every VM has to have a program loaded, see `VirtualMachine.load_source`.
+"""
+import asyncio
+from collections import namedtuple
+from timeit import default_timer as timer
+
+from helpers import format_error, raise_errors
+
+
+# Ticks of the first time slice
+QUANTUM = 10000
+MIN_QUANTUM = 100
+MAX_QUANTUM = 10 ** 7
+
+# Target duration of a time slice in seconds
+TIME_SLICE = 0.005
+
+# A finished VM, `error` is None if it halted normally
+Result = namedtuple('Result', ['output', 'ticks', 'error'])
+
+
+class Scheduler(object):
+    """
+    Runs VMs with fair time slicing, see the module's documentation.
+    """
+
+    def __init__(self, quantum=QUANTUM, time_slice=TIME_SLICE,
+                 max_ticks=None, timeout=None):
+        """
+        :param quantum: ticks of every VM's first time slice
+        :param time_slice: target duration of a time slice in seconds
+        :param max_ticks: default tick budget of a VM, None for no limit
+        :param timeout: default timeout of a VM in seconds, including the
+                        time it waits for input
+        """
+        self.quantum = quantum
+        self.time_slice = time_slice
+        self.max_ticks = max_ticks
+        self.timeout = timeout
+
+    async def run(self, vm, max_ticks=None, timeout=None):
+        """
+        Run a VM until it halts, fails or exceeds its tick budget or timeout.
+
+        :type vm: virtualmachine.VirtualMachine
+        :param max_ticks: the VM's tick budget, defaults to `self.max_ticks`
+        :param timeout: the VM's timeout, defaults to `self.timeout`
+        :rtype: Result
+        """
+        max_ticks = self.max_ticks if max_ticks is None else max_ticks
+        timeout = self.timeout if timeout is None else timeout
+
+        # Report errors instead of exiting
+        vm.testing = True
+
+        try:
+            await asyncio.wait_for(self.run_slices(vm, max_ticks), timeout)
+        except asyncio.TimeoutError:
+            error = 'Exceeded the timeout of {}s'.format(timeout)
+        except Exception as e:
+            error = format_error(e)
+        else:
+            error = None
+            if vm.running:
+                error = 'Exceeded the budget of {} ticks'.format(max_ticks)
+
+        return Result(vm.output.getvalue(), vm.ticks, error)
+
+    async def run_slices(self, vm, max_ticks):
+        """
+        Run a VM slice by slice, until it stops or runs out of ticks.
+        """
+        stop = None if max_ticks is None else vm.ticks + max_ticks
+        quantum = self.quantum
+
+        while vm.running and vm.ticks != stop:
+            ticks = quantum if stop is None else min(quantum, stop - vm.ticks)
+
+            start, start_ticks = timer(), vm.ticks
+            with raise_errors():
+                vm.execute(ticks)
+            elapsed, executed = timer() - start, vm.ticks - start_ticks
+
+            # Aim for slices of `time_slice` seconds
+            if elapsed and executed:
+                quantum = int(executed * self.time_slice / elapsed)
+                quantum = min(max(quantum, MIN_QUANTUM), MAX_QUANTUM)
+
+            if vm.waiting:
+                await vm.source.wait()
+            else:
+                await asyncio.sleep(0)
+
+    async def run_all(self, vms):
+        """
+        Run all VMs concurrently.
+
+        :rtype: list[Result]
+        """
+        return await asyncio.gather(*[self.run(vm) for vm in vms])
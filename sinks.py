@@ -0,0 +1,104 @@
+"""
+Tiny-ASM output sinks.
+
+Everything a program prints (APRINT, DPRINT) is passed to the VM's sink, see
+`VirtualMachine(sink=...)`. A sink is any object with a `write(s)` and a
+`flush()` method:
+
+- None keeps the output in memory only (`VirtualMachine.output`)
+- `Stream` collects the output and writes it to a stream in larger chunks
+- `Callback` passes the output on to a function
+- `Null` discards the output, not even the in-memory copy is kept
+
+Besides `Null`, the VM keeps an in-memory copy of the output, which `run`
+returns. The VM flushes its sink when it stops running, halts and before a
+program reads input.
+"""
+import sys
+
+
+# The default sink: print to stdout, see `VirtualMachine`
+STDOUT = 'stdout'
+
+# Number of characters `Stream` collects before writing them
+BUFFER_SIZE = 8192
+
+
+class Stream(object):
+    """
+    Write the output to a stream, to stdout by default.
+
+    With `line_buffering`, every line is written right away, so interactive
+    programs show their output while they're running. With `color` None,
+    the output is colored if the stream is a terminal.
+    """
+
+    def __init__(self, stream=None, color=False, buffer_size=BUFFER_SIZE,
+                 line_buffering=False):
+        self.stream = stream
+        self.color = color
+        self.buffer_size = buffer_size
+        self.line_buffering = line_buffering
+
+        #: :type: list[str]
+        self.buffer = []
+        self.size = 0
+
+    def write(self, s):
+        self.buffer.append(s)
+        self.size += len(s)
+
+        if self.size >= self.buffer_size or \
+                self.line_buffering and '\n' in s:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        s = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+
+        # Look up stdout late, so redirecting it works
+        stream = self.stream or sys.stdout
+
+        color = self.color
+        if color is None:
+            color = stream.isatty()
+        if color:
+            from colors import green
+            s = green(s)
+
+        stream.write(s)
+        stream.flush()
+
+
+class Callback(object):
+    """
+    Call `func` with everything the program prints.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def write(self, s):
+        self.func(s)
+
+    def flush(self):
+        pass
+
+
+class Null(object):
+    """
+    Discard the output.
+    """
+
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''
@@ -0,0 +1,170 @@
+"""
+Tiny-ASM VM snapshots.
+
+A snapshot captures the complete state of a `VirtualMachine`, including the
+program it runs, so a run can be continued later on, e.g. after a crash or
+from a warmed-up state.
+
+Layout (all integers little endian):
+
+    header   magic 'TSNP', version, word size (bits), flags, memory size,
+             instruction pointer, previous instruction pointer, ticks,
+             length of the output (bytes), length of the program (bytes),
+             the seed, stream and position of the random numbers (see `rng`)
+    body     the memory cells (word size / 8 bytes each), the output so far
+             (utf-8) and the program as an object file, see `objfile`
+
+The body is zlib compressed if the COMPRESSED flag is set.
+"""
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+
+import objfile
+from exc import VirtualRuntimeError
+from helpers import fatal_error
+from paging import PagedMemory
+
+
+MAGIC = b'TSNP'
+VERSION = 2
+
+HEADER = struct.Struct('<4sBBBxIQQQIIQQQ')
+
+# Flags
+RUNNING = 1
+COMPRESSED = 2
+
+# A loaded snapshot, `memory` holds the raw memory cells (little endian),
+# `random` the seed, stream and position of the random numbers
+Snapshot = namedtuple('Snapshot', ['word_size', 'memory_size', 'running',
+                                   'instr_pointer', 'prev_instr_pointer',
+                                   'ticks', 'memory', 'output', 'program',
+                                   'random'])
+
+
+###############################################################################
+# SMALL HELPERS
+###############################################################################
+
+def is_snapshot(data):
+    """ Check, wether the given data starts with a snapshot header """
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def memory_bytes(memory):
+    """ Get the memory's cells as little endian bytes """
+    if isinstance(memory, PagedMemory):
+        return b''.join(memory_bytes(page) for page in memory.pages)
+
+    view = memoryview(memory).cast('B')
+    if sys.byteorder == 'big' and len(view) != len(memory):
+        cells = array(memory._type_._type_, view.cast(memory._type_._type_))
+        cells.byteswap()
+        return cells.tobytes()
+
+    return view.tobytes()
+
+
+def set_memory_bytes(memory, data):
+    """ Fill the memory with little endian cells, see `memory_bytes` """
+    view = memoryview(memory).cast('B')
+    if sys.byteorder == 'big' and len(view) != len(memory):
+        cells = array(memory._type_._type_, data)
+        cells.byteswap()
+        data = cells.tobytes()
+
+    view[:] = data
+
+
+###############################################################################
+# SNAPSHOTS
+###############################################################################
+
+def dumps(vm, compress=True):
+    """
+    Take a snapshot of a VM with a loaded program.
+
+    :type vm: virtualmachine.VirtualMachine
+    :rtype: bytes
+    """
+    program = vm.program
+    output = vm.output.getvalue().encode('utf-8')
+    code = objfile.dumps(list(program.tokens), vm.word_size, program.entry,
+                         program.symbols, program.source_map)
+
+    flags = RUNNING if vm.running else 0
+    body = b''.join([memory_bytes(vm.memory), output, code])
+    if compress:
+        flags |= COMPRESSED
+        body = zlib.compress(body, 1)
+
+    header = HEADER.pack(MAGIC, VERSION, vm.word_size, flags,
+                         len(vm.memory), vm.instr_pointer,
+                         vm.prev_instr_pointer, vm.ticks, len(output),
+                         len(code), vm.random.seed, vm.random.stream,
+                         vm.random.position)
+
+    return header + body
+
+
+def loads(data):
+    """
+    Load a snapshot from a bytes-like object.
+
+    :rtype: Snapshot
+    """
+    view = memoryview(data)
+
+    if len(view) < HEADER.size or not is_snapshot(view):
+        fatal_error('Not a Tiny snapshot', VirtualRuntimeError)
+
+    (magic, version, word_size, flags, memory_size, instr_pointer,
+     prev_instr_pointer, ticks, output_size, code_size, seed, stream,
+     position) = HEADER.unpack_from(view)
+
+    if version != VERSION:
+        fatal_error('Unsupported snapshot version: {}'.format(version),
+                    VirtualRuntimeError)
+
+    body = view[HEADER.size:]
+    if flags & COMPRESSED:
+        try:
+            body = memoryview(zlib.decompress(body))
+        except zlib.error:
+            fatal_error('Corrupt snapshot', VirtualRuntimeError)
+
+    memory_end = memory_size * (word_size // 8)
+    output_end = memory_end + output_size
+    if len(body) != output_end + code_size:
+        fatal_error('Truncated snapshot', VirtualRuntimeError)
+
+    return Snapshot(word_size, memory_size, bool(flags & RUNNING),
+                    instr_pointer, prev_instr_pointer, ticks,
+                    bytes(body[:memory_end]),
+                    bytes(body[memory_end:output_end]).decode('utf-8'),
+                    objfile.loads(bytes(body[output_end:])),
+                    (seed, stream, position))
+
+
+def save(vm, path, compress=True):
+    """
+    Write a snapshot to `path`. The file is replaced atomically, so a crash
+    while saving leaves the previous snapshot intact.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    with open(tmp_path, 'wb') as f:
+        f.write(dumps(vm, compress))
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    """
+    :rtype: Snapshot
+    """
+    with open(path, 'rb') as f:
+        return loads(f.read())
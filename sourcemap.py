@@ -0,0 +1,187 @@
+"""
+Tiny-ASM source maps.
+
+A source map stores where every instruction of an assembled program comes
+from: the file, the line and the macro (e.g. `@call`) that generated it, if
+any. The assembler builds it while assembling and object files store it
+(see `objfile`), so profiles, traces and runtime errors can point at the
+source without running the preprocessor again.
+
+Every distinct location is stored once, the addresses only refer to it:
+
+    locations  number of locations, then for every location: line number,
+               file index, macro index (0xffffffff for none), length of the
+               source line (bytes), the source line (utf-8)
+    strings    number of file names and macro names, then for every one:
+               length (bytes), the name (utf-8)
+    addresses  number of instructions, then for every one: address, location
+               index
+
+All integers are unsigned 32 bit little endian.
+"""
+import struct
+from array import array
+from collections import namedtuple
+
+
+COUNT = struct.Struct('<I')
+LOCATION = struct.Struct('<IIII')
+ADDRESS = struct.Struct('<II')
+
+NONE = 0xffffffff
+
+# Where an instruction comes from. Has the same attributes as a
+# `preprocessor.Line` for error messages: `lineno` starts at 0 and
+# `original_contents` is the source line.
+Location = namedtuple('Location', ['filename', 'lineno', 'macro',
+                                   'original_contents'])
+
+
+class SourceMap(object):
+    """
+    Maps instruction addresses to their `Location`, see the module's
+    documentation.
+    """
+
+    def __init__(self):
+        #: :type: list[Location]
+        self.locations = []
+        #: Address → index in `locations`, -1 for addresses without one
+        self.index = array('i')
+        self._indices = {}
+
+    def __len__(self):
+        return sum(1 for i in self.index if i >= 0)
+
+    def add(self, address, line):
+        """
+        Map an address to the line it was assembled from.
+
+        :type line: preprocessor.Line
+        """
+        location = Location(line.filename, line.lineno, line.macro,
+                            line.original_contents)
+        self.add_location(address, location)
+
+    def add_location(self, address, location):
+        try:
+            i = self._indices[location]
+        except KeyError:
+            i = self._indices[location] = len(self.locations)
+            self.locations.append(location)
+
+        self._set(address, i)
+
+    def _set(self, address, i):
+        if address >= len(self.index):
+            self.index.extend([-1] * (address + 1 - len(self.index)))
+        self.index[address] = i
+
+    def get(self, address):
+        """
+        Get the location of an address, None if it has none.
+
+        :rtype: Location
+        """
+        if 0 <= address < len(self.index):
+            i = self.index[address]
+            if i >= 0:
+                return self.locations[i]
+
+        return None
+
+    def items(self):
+        """ Get the (address, location) pairs """
+        return [(address, self.locations[i])
+                for address, i in enumerate(self.index) if i >= 0]
+
+    ###########################################################################
+    # SERIALIZATION
+    ###########################################################################
+
+    def dumps(self):
+        """
+        :rtype: bytes
+        """
+        strings = []
+        string_indices = {}
+
+        def string(s):
+            if s is None:
+                return NONE
+            if s not in string_indices:
+                string_indices[s] = len(strings)
+                strings.append(s)
+            return string_indices[s]
+
+        parts = [COUNT.pack(len(self.locations))]
+        for location in self.locations:
+            source = location.original_contents.encode('utf-8')
+            parts.append(LOCATION.pack(location.lineno,
+                                       string(location.filename),
+                                       string(location.macro), len(source)))
+            parts.append(source)
+
+        parts.append(COUNT.pack(len(strings)))
+        for s in strings:
+            s = s.encode('utf-8')
+            parts.append(COUNT.pack(len(s)))
+            parts.append(s)
+
+        items = [(address, i) for address, i in enumerate(self.index)
+                 if i >= 0]
+        parts.append(COUNT.pack(len(items)))
+        parts.extend(ADDRESS.pack(address, i) for address, i in items)
+
+        return b''.join(parts)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Load a source map from a bytes-like object, raises `struct.error` or
+        `IndexError` if it's truncated.
+
+        :rtype: SourceMap
+        """
+        view = memoryview(data)
+        offset = 0
+
+        def read(fmt):
+            nonlocal offset
+            values = fmt.unpack_from(view, offset)
+            offset += fmt.size
+            return values
+
+        def read_string(length):
+            nonlocal offset
+            if offset + length > len(view):
+                raise IndexError('Truncated source map')
+            s = bytes(view[offset:offset + length]).decode('utf-8')
+            offset += length
+            return s
+
+        locations = []
+        for _ in range(read(COUNT)[0]):
+            lineno, filename, macro, length = read(LOCATION)
+            locations.append((filename, lineno, macro, read_string(length)))
+
+        strings = [read_string(read(COUNT)[0])
+                   for _ in range(read(COUNT)[0])]
+
+        source_map = cls()
+        for filename, lineno, macro, source in locations:
+            source_map.locations.append(Location(
+                strings[filename], lineno,
+                None if macro == NONE else strings[macro], source
+            ))
+        source_map._indices = dict(
+            (location, i) for i, location in enumerate(source_map.locations)
+        )
+
+        for _ in range(read(COUNT)[0]):
+            address, i = read(ADDRESS)
+            if i >= len(source_map.locations):
+                raise IndexError('Invalid source map location: {}'.format(i))
+            source_map._set(address, i)
+
+        return source_map
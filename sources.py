@@ -0,0 +1,101 @@
+"""
+Tiny-ASM input sources.
+
+AREAD reads one character from the VM's source, see
+`VirtualMachine(source=...)`. A source is any object with a `read()` method
+returning the next character, or '' at the end of the input. AREAD stores 0
+then. None is a source without any input.
+
+- `Stream` reads from a text stream, from stdin by default
+- `Buffer` reads from a string or bytes, e.g. scripted input for tests
+- `AsyncStream` reads from an `asyncio.StreamReader`
+
+A source that has no input yet, but may get some later, raises
+`InputPending` instead of waiting for it. The VM stops right before the
+AREAD then and sets `VirtualMachine.waiting`. Once the source's `wait()`
+coroutine returns, the VM can continue, see `VirtualMachine.resume_async`.
+This way, a VM waiting for input doesn't block the event loop.
+"""
+import sys
+
+
+# The default source: read from stdin, see `VirtualMachine`
+STDIN = 'stdin'
+
+# Number of bytes `AsyncStream` reads at once
+BUFFER_SIZE = 4096
+
+
+class InputPending(Exception):
+    """ The source has no input yet, see `AsyncStream` """
+
+
+class Buffer(object):
+    """
+    Read from a string. Bytes are read byte by byte.
+    """
+
+    def __init__(self, data=''):
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('latin-1')
+
+        self.data = data
+        self.position = 0
+
+    def read(self):
+        c = self.data[self.position:self.position + 1]
+        self.position += len(c)
+        return c
+
+    def feed(self, data):
+        """ Append more input """
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('latin-1')
+
+        self.data = self.data[self.position:] + data
+        self.position = 0
+
+
+class Stream(Buffer):
+    """
+    Read from a text stream, a line at a time instead of every character on
+    its own.
+    """
+
+    def __init__(self, stream=None):
+        super().__init__()
+        self.stream = stream
+
+    def read(self):
+        if self.position == len(self.data):
+            # Look up stdin late, so redirecting it works
+            self.data = (self.stream or sys.stdin).readline()
+            self.position = 0
+
+        return super().read()
+
+
+class AsyncStream(Buffer):
+    """
+    Read from an `asyncio.StreamReader`. Raises `InputPending` until `wait`
+    has read more input.
+    """
+
+    def __init__(self, reader):
+        super().__init__()
+        self.reader = reader
+        self.eof = False
+
+    def read(self):
+        if self.position == len(self.data) and not self.eof:
+            raise InputPending()
+
+        return super().read()
+
+    async def wait(self):
+        """ Wait for more input """
+        data = await self.reader.read(BUFFER_SIZE)
+        if data:
+            self.feed(data)
+        else:
+            self.eof = True
@@ -7,11 +7,14 @@ import config
 config.TESTING = True
 
 import assembler
+import cache
+import objfile
 import preprocessor
 from exc import UnknownMnemonicError, InvalidArgumentError, RedefinitionError,\
     RedefinitionWarning, NoSuchConstantError, NoSuchLabelError,\
-    AssemblerException, AssemblerSyntaxError
+    AssemblerException, AssemblerSyntaxError, VirtualRuntimeError
 from preprocessor import prepare_source_code
+from sourcemap import SourceMap
 
 
 def prep(func):
@@ -57,6 +60,122 @@ Halt"""
     assert asm == expected_output
 
 
+def test_binary():
+    obj = objfile.loads(assembler.assembler_to_binary(
+        'start:\nMOV [2] 0\nloop:\nJMP :loop'
+    ))
+
+    assert obj.word_size == config.WORD_SIZE
+    assert obj.entry == 0
+    assert obj.symbols == {'start': 0, 'loop': 3}
+    assert list(obj.code) == [0x08, 0x02, 0x00, 0x0F, 0x03]
+
+
+def test_source_map(tmpdir):
+    lib = tmpdir.join('lib.asm')
+    lib.write('@start(double, 1)\nADD $arg0 $arg0\nMOV $return $arg0\n'
+              '@end()')
+    code = 'MOV [100] 3\n@call(double, [100])\nDPRINT $return\nHALT\n' \
+           '#import {}'.format(lib)
+
+    source_map = SourceMap()
+    assembler.assembler_to_hex(code, source_map=source_map)
+    locations = [(location.filename, location.lineno, location.macro)
+                 for address, location in source_map.items()]
+
+    call = ('<input>', 1, '@call')
+    start, end = (str(lib), 0, '@start'), (str(lib), 3, '@end')
+    assert locations == [
+        ('<input>', 0, None), call, call, call, ('<input>', 2, None),
+        ('<input>', 3, None),
+        start, (str(lib), 1, None), (str(lib), 2, None), end
+    ]
+
+    assert source_map.get(0).original_contents == 'MOV [100] 3'
+    assert source_map.get(1) is None  # An argument
+    assert len(source_map) == 10
+
+    # Stored in object files
+    obj = objfile.loads(assembler.assembler_to_binary(code))
+    assert obj.source_map.items() == source_map.items()
+    assert objfile.loads(assembler.assembler_to_binary(
+        code, source_map=False
+    )).source_map is None
+
+
+def test_binary_wide_tokens():
+    data = objfile.dumps([0x08, 0x00, 300, 0xFF], 8)
+    obj = objfile.loads(bytearray(data))
+
+    assert obj.code.format == 'H'
+    assert list(obj.code) == [0x08, 0x00, 300, 0xFF]
+
+
+def test_binary_symbols():
+    name = 'x' * 300
+    obj = objfile.loads(assembler.assembler_to_binary(name + ':\nHALT'))
+    assert obj.symbols == {name: 0}
+
+
+def test_binary_invalid(tmpdir):
+    path = tmpdir.join('empty.bin')
+    path.write_binary(b'')
+    with pytest.raises(VirtualRuntimeError, match='Not a Tiny object file'):
+        objfile.load(str(path))
+
+    data = objfile.dumps([0xFF], 8, symbols={'start': 0})
+    for end in (len(data) - 6, len(data) - 1):
+        with pytest.raises(VirtualRuntimeError, match='Truncated'):
+            objfile.loads(data[:end])
+
+
+def test_cache(tmpdir):
+    lib = tmpdir.join('lib.asm')
+    lib.write('lib:\nHALT')
+    code = 'JMP :lib\n#import {}'.format(lib)
+
+    assembly_cache = cache.AssemblyCache()
+    expected = assembler.assembler_to_hex(code)
+    assert assembler.assembler_to_hex(code, cache=assembly_cache) == expected
+    assert list(assembly_cache.memory.values()) == [expected]
+
+    # Cache hit
+    assert assembler.assembler_to_hex(code, cache=assembly_cache) == expected
+    assert len(assembly_cache.memory) == 1
+
+    # Changing an imported file changes the key
+    lib.write('MOV [0] 1\nlib:\nHALT')
+    changed = assembler.assembler_to_hex(code, cache=assembly_cache)
+    assert changed == assembler.assembler_to_hex(code) != expected
+    assert len(assembly_cache.memory) == 2
+
+
+def test_cache_eviction(tmpdir):
+    assembly_cache = cache.AssemblyCache(maxsize=2, directory=str(tmpdir),
+                                         max_bytes=40)
+    codes = ['DPRINT {}\nHALT'.format(i) for i in range(3)]
+    keys = [assembly_cache.key(code, '<input>')
+            for code in codes]
+
+    for i, (code, key) in enumerate(zip(codes, keys)):
+        if i:
+            # Make sure the previous file is older than the new one
+            os.utime(assembly_cache.path(keys[i - 1]), (i, i))
+        assembler.assembler_to_hex(code, cache=assembly_cache)
+
+    # Memory: least recently used program evicted
+    assert list(assembly_cache.memory) == keys[1:]
+
+    # Disk: every file has 14 bytes, only two fit
+    assert sorted(tmpdir.listdir()) == sorted(
+        tmpdir.join(key + '.hex') for key in keys[1:]
+    )
+
+    # Loaded from disk after clearing the memory cache
+    assembly_cache.memory.clear()
+    assert assembly_cache.get(keys[2]) == '0x23 0x02 0xFF'
+
+
 def test_unknown_instruction():
     with pytest.raises(UnknownMnemonicError):
         assembler.assembler_to_hex('HEY')
@@ -123,6 +242,15 @@ def test_preprocessor_labels():
     pp = prep(preprocessor.preprocessor_labels)
 
     assert list(pp(['label:', 'JMP :label'])) == ['JMP 0']
+    assert list(pp(['JMP :end', 'loop: JMP :loop', 'end: HALT'])) == \
+        ['JMP 4', 'JMP 2', 'HALT']
+
+
+def test_symbols():
+    symbols = {}
+    assembler.assembler_to_hex('start: JMP :end\nend: HALT', symbols=symbols)
+
+    assert symbols == {'start': 0, 'end': 2}
 
 
 def test_preprocessor_chars():
@@ -173,6 +301,40 @@ def test_preprocessor_import_nonexistend():
         pp(code)
 
 
+def test_preprocessor_import_relative(tmpdir):
+    pp = prep(preprocessor.preprocessor_import)
+    tmpdir.mkdir('lib').join('a.asm').write('#include b.asm\nMOV [0] 1')
+    tmpdir.join('lib', 'b.asm').write('MOV [1] 1')
+    tmpdir.mkdir('include').join('c.asm').write('MOV [2] 1')
+
+    main = tmpdir.join('main.asm')
+    lines = prepare_source_code(str(main), '#import lib/a.asm\n#import c.asm')
+    search_paths = [str(tmpdir.join('include'))]
+    code = preprocessor.preprocessor_import(lines, search_paths)
+
+    assert [c.contents for c in code] == ['MOV [1] 1', 'MOV [0] 1',
+                                          'MOV [2] 1']
+
+
+def test_preprocessor_import_chain(tmpdir):
+    tmpdir.join('a.asm').write('HALT\n#import missing.asm')
+    main = tmpdir.join('main.asm')
+    main.write('\n#import a.asm')
+
+    with pytest.raises(FileNotFoundError) as e:
+        assembler.assembler_to_hex(main.read(), str(main))
+
+    assert str(e.value) == 'File not found: missing.asm\n' \
+                           '  imported from {}:2'.format(main)
+
+
+def test_preprocessor_import_long():
+    lines = ['MOV [0] {}'.format(i % 256) for i in range(20000)]
+    pp = prep(preprocessor.preprocessor_import)
+
+    assert pp(lines) == lines
+
+
 def test_preprocessor_subroutine():
     pp = prep(preprocessor.preprocessor_subroutine)
 
@@ -230,3 +392,53 @@ def test_preprocessor_subroutine():
     pprint(result, open('result.asm', 'w'))
 
     assert result == expected
+
+
+def test_preprocessor_tokens():
+    # Chars are single tokens, even if they're a space or a semicolon
+    assert assembler.assembler_to_hex("APRINT ' '\nlabel: APRINT ';'\n"
+                                      "JMP :label ; comment") == \
+        '0x21 0x20 0x21 0x3b 0x0F 0x02'
+
+
+def test_preprocessor_optimize():
+    pp = prep(preprocessor.preprocessor_optimize)
+
+    # Moves to itself, dead stores and jumps to the next instruction
+    assert pp(['MOV [0] [0]', 'HALT']) == ['HALT']
+    assert pp(['MOV [0] 1', 'MOV [0] 2', 'HALT']) == ['MOV [0] 2', 'HALT']
+    assert pp(['MOV [0] 1', 'ADD [0] 2', 'HALT']) == \
+        ['MOV [0] 1', 'ADD [0] 2', 'HALT']
+    assert pp(['JMP :next', 'next: HALT']) == ['next: HALT']
+
+    # Unreachable code, the labels move to the next instruction
+    assert pp(['JMP :end', 'DPRINT [0]', 'end: HALT']) == ['end: HALT']
+    assert pp(['a: JMP :b', 'b: DPRINT [0]', 'JMP :a']) == \
+        ['a: b: DPRINT [0]', 'JMP :a']
+
+    # Jumps to fixed addresses disable the optimization
+    assert pp(['MOV [0] [0]', 'JMP 0']) == ['MOV [0] [0]', 'JMP 0']
+
+    # Differently spelled addresses are the same cell
+    assert pp(['MOV [0] 7', 'DPRINT [00]', 'MOV [0] 2', 'HALT']) == \
+        ['MOV [0] 7', 'DPRINT [00]', 'MOV [0] 2', 'HALT']
+    assert pp(['MOV [00] [0]', 'HALT']) == ['HALT']
+
+
+def test_optimize():
+    asm_path = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                            'lib', 'math', 'multiply.asm')
+    asm = 'MOV $arg0 10\nMOV $arg1 3\n' \
+          '@call(math_multiply, $arg0, $arg1)\nDPRINT $return\nHALT\n' \
+          '#import {}'.format(asm_path)
+
+    code = assembler.assembler_to_hex(asm, '<test>').split()
+    optimized = assembler.assembler_to_hex(asm, '<test>', optimize=True)
+    assert len(optimized.split()) < len(code)
+
+    # Optimized and unoptimized programs are cached separately
+    assembly_cache = cache.AssemblyCache()
+    assert assembler.assembler_to_hex(asm, '<test>', cache=assembly_cache,
+                                      optimize=True) == optimized
+    assert assembler.assembler_to_hex(asm, '<test>',
+                                      cache=assembly_cache).split() == code
@@ -0,0 +1,98 @@
+from os.path import dirname, join
+
+import config
+config.TESTING = True
+
+import assembler
+from batch import run_batch, run_forks
+from virtualmachine import VirtualMachine
+
+template = """
+MOV $arg0 {arg0}
+MOV $arg1 {arg1}
+@call(math_multiply, $arg0, $arg1)
+DPRINT $return
+HALT
+
+#import {path}
+"""
+
+asm_path = join(dirname(dirname(__file__)), 'lib', 'math', 'multiply.asm')
+
+
+def test_batch():
+    jobs = [{'source': template, 'args': {'arg0': i, 'arg1': 3,
+                                          'path': asm_path}}
+            for i in range(10)]
+
+    results = run_batch(jobs, processes=2)
+
+    assert [r.output for r in results] == [str(i * 3) for i in range(10)]
+    assert all(r.error is None for r in results)
+    assert len(set(r.ticks for r in results)) == 1  # Always 3 iterations
+
+
+def test_batch_seed():
+    jobs = [{'source': 'RANDOM [0]\nRANDOM [1]\nDPRINT [0]\nDPRINT [1]\nHALT',
+             'seed': 42}] * 2 + [{'source': 'RANDOM [0]\nHALT'}]
+
+    results = run_batch(jobs, processes=0)
+
+    assert results[0] == results[1]
+    assert results[0].seed == 42
+    assert results[2].seed is not None
+
+
+def test_batch_stream():
+    source = 'MOV [0] 20\nloop: RANDOM [1]\nDPRINT [1]\nSUB [0] 1\n' \
+             'JGT :loop [0] 0\nHALT'
+    jobs = [{'source': source, 'seed': 42, 'stream': stream}
+            for stream in (0, 1, 1)]
+
+    results = run_batch(jobs, processes=0)
+
+    assert results[1] == results[2]
+    assert results[0].output != results[1].output
+
+
+def test_batch_memory():
+    results = run_batch([{'source': 'DPRINT [3]\nHALT', 'memory': {'3': 9}}],
+                        processes=0)
+
+    assert results[0].output == '9'
+
+
+def test_batch_errors():
+    results = run_batch([{'source': 'FOO'}, {'source': 'JMP 0'},
+                         {'source': 'HALT'}], processes=0)
+
+    assert results[0].error.startswith('UnknownMnemonicError')
+    assert results[1].error.startswith('VirtualRuntimeError')
+    assert results[2] == ('', 1, None, results[2].seed)
+
+
+def test_batch_limits():
+    results = run_batch([{'source': 'loop: ADD [0] 1\nJMP :loop',
+                          'max_ticks': 500},
+                         {'source': 'loop: ADD [0] 1\nJMP :loop',
+                          'timeout': 0.01}], processes=0)
+
+    assert results[0].error == \
+        'VirtualRuntimeError: Exceeded the budget of 500 ticks'
+    assert results[0].ticks == 500
+    assert results[1].error == \
+        'VirtualRuntimeError: Exceeded the timeout of 0.01s'
+
+
+def test_run_forks():
+    vm = VirtualMachine()
+    vm.load(assembler.assembler_to_hex(template.format(
+        arg0='[250]', arg1='[251]', path=asm_path
+    )))
+
+    jobs = [{'memory': {'250': i, '251': 3}} for i in range(6)]
+    results = run_forks(vm, jobs, processes=2)
+
+    assert [r.output for r in results] == [str(i * 3) for i in range(6)]
+    assert all(r.error is None for r in results)
+    assert run_forks(vm, jobs[:2], processes=0)[1].output == '3'
@@ -0,0 +1,24 @@
+import json
+import subprocess
+import sys
+from os.path import dirname, join
+
+ROOT = dirname(dirname(__file__))
+
+
+def test_suite(tmpdir):
+    output = str(tmpdir.join('results.json'))
+    subprocess.check_call([sys.executable, join(ROOT, 'benchmarks', 'suite.py'),
+                           '--quick', '--repeat', '1', '--skip-startup',
+                           '--engine', 'interpreter', '-o', output],
+                          stderr=subprocess.DEVNULL)
+
+    with open(output) as f:
+        results = json.load(f)['results']
+
+    assert set(results) == {'assemble_large', 'assemble_imports_cold',
+                            'assemble_imports_warm', 'pi/interpreter',
+                            'math_multiply/interpreter',
+                            'math_divide/interpreter'}
+    assert results['assemble_large']['lines_per_second'] > 0
+    assert results['pi/interpreter']['ticks_per_second'] > 0
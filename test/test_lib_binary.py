@@ -1,9 +1,11 @@
 from os.path import dirname, join
 
+import pytest
+
 import config
 config.TESTING = True
 
-from virtualmachine import VirtualMachine
+from virtualmachine import VirtualMachine, ENGINES
 
 template = """
 $arg = [_]
@@ -16,21 +18,23 @@ HALT
 """
 
 
-def test_shift_left():
+@pytest.mark.parametrize('engine', ENGINES)
+def test_shift_left(engine):
     asm_path = join(dirname(dirname(__file__)), 'lib', 'binary', 'shift.asm')
     asm = template.format(arg='{arg}', call='binary_shift_left', path=asm_path)
 
-    assert VirtualMachine().run(asm.format(arg=10)) == '20'
-    assert VirtualMachine().run(asm.format(arg=1)) == '2'
-    assert VirtualMachine().run(asm.format(arg=0)) == '0'
+    assert VirtualMachine(engine).run(asm.format(arg=10)) == '20'
+    assert VirtualMachine(engine).run(asm.format(arg=1)) == '2'
+    assert VirtualMachine(engine).run(asm.format(arg=0)) == '0'
 
 
-def test_shift_right():
+@pytest.mark.parametrize('engine', ENGINES)
+def test_shift_right(engine):
     asm_path = join(dirname(dirname(__file__)), 'lib', 'binary', 'shift.asm')
     asm = template.format(arg='{arg}', call='binary_shift_right',
                           path=asm_path)
 
-    assert VirtualMachine().run(asm.format(arg=255)) == '127'
-    assert VirtualMachine().run(asm.format(arg=2)) == '1'
-    assert VirtualMachine().run(asm.format(arg=1)) == '0'
-    assert VirtualMachine().run(asm.format(arg=0)) == '0'
+    assert VirtualMachine(engine).run(asm.format(arg=255)) == '127'
+    assert VirtualMachine(engine).run(asm.format(arg=2)) == '1'
+    assert VirtualMachine(engine).run(asm.format(arg=1)) == '0'
+    assert VirtualMachine(engine).run(asm.format(arg=0)) == '0'
@@ -1,9 +1,11 @@
 from os.path import dirname, join
 
+import pytest
+
 import config
 config.TESTING = True
 
-from virtualmachine import VirtualMachine
+from virtualmachine import VirtualMachine, ENGINES
 
 template = """
 MOV $arg0 {arg0}
@@ -16,26 +18,25 @@ HALT
 """
 
 
-def test_multiply():
+@pytest.mark.parametrize('engine', ENGINES)
+def test_multiply(engine):
     asm_path = join(dirname(dirname(__file__)), 'lib', 'math', 'multiply.asm')
     asm = template.format(arg0='{arg0}', arg1='{arg1}', call='math_multiply',
                           path=asm_path)
-    # asm += open(asm_path).read()
-
-    print(asm)
 
-    assert VirtualMachine().run(asm.format(arg0=10, arg1=2)) == '20'
-    assert VirtualMachine().run(asm.format(arg0=5, arg1=7)) == '35'
-    assert VirtualMachine().run(asm.format(arg0=25, arg1=10)) == '250'
-    assert VirtualMachine().run(asm.format(arg0=10, arg1=25)) == '250'
+    assert VirtualMachine(engine).run(asm.format(arg0=10, arg1=2)) == '20'
+    assert VirtualMachine(engine).run(asm.format(arg0=5, arg1=7)) == '35'
+    assert VirtualMachine(engine).run(asm.format(arg0=25, arg1=10)) == '250'
+    assert VirtualMachine(engine).run(asm.format(arg0=10, arg1=25)) == '250'
 
 
-def test_divide():
+@pytest.mark.parametrize('engine', ENGINES)
+def test_divide(engine):
     asm_path = join(dirname(dirname(__file__)), 'lib', 'math', 'divide.asm')
     asm = template.format(arg0='{arg0}', arg1='{arg1}', call='math_divide',
                           path=asm_path)
 
-    assert VirtualMachine().run(asm.format(arg0=10, arg1=2)) == '5'
-    assert VirtualMachine().run(asm.format(arg0=5, arg1=7)) == '0'
-    assert VirtualMachine().run(asm.format(arg0=25, arg1=25)) == '1'
-    assert VirtualMachine().run(asm.format(arg0=10, arg1=1)) == '10'
+    assert VirtualMachine(engine).run(asm.format(arg0=10, arg1=2)) == '5'
+    assert VirtualMachine(engine).run(asm.format(arg0=5, arg1=7)) == '0'
+    assert VirtualMachine(engine).run(asm.format(arg0=25, arg1=25)) == '1'
+    assert VirtualMachine(engine).run(asm.format(arg0=10, arg1=1)) == '10'
@@ -0,0 +1,48 @@
+import config
+config.TESTING = True
+
+from rng import Random, CHUNK_SIZE
+
+
+def draw(random, n):
+    return [random() for _ in range(n)]
+
+
+def test_random():
+    values = draw(Random(42), 3000)
+
+    assert values == draw(Random(42), 3000)
+    assert values != draw(Random(43), 3000)
+    assert set(values) == set(range(config.RAND_MAX + 1))
+
+
+def test_random_seed_range():
+    # Seeds and streams are taken modulo 2 ** 64
+    assert Random(-1).seed == 2 ** 64 - 1
+    assert draw(Random(2 ** 64 + 42, stream=-1), 100) == \
+        draw(Random(42, stream=2 ** 64 - 1), 100)
+
+
+def test_random_streams():
+    assert draw(Random(42, stream=1), 100) != draw(Random(42), 100)
+    assert draw(Random(42, stream=1), 100) == draw(Random(42, stream=1), 100)
+
+
+def test_random_block_size():
+    assert draw(Random(42, block_size=1), 1000) == \
+        draw(Random(42, block_size=10000), 1000)
+
+
+def test_random_seek():
+    random = Random(42)
+    values = draw(random, 1000)
+
+    for position in (0, 1, CHUNK_SIZE, 2 * CHUNK_SIZE + 7):
+        other = Random(42)
+        other.seek(position)
+        assert other.position == position
+        assert draw(other, 100) == values[position:position + 100]
+
+    copy = random.copy()
+    assert copy.position == random.position == 1000
+    assert draw(copy, 10) == draw(random, 10)
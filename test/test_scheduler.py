@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+import config
+config.TESTING = True
+
+from scheduler import Scheduler
+from sources import AsyncStream
+from virtualmachine import VirtualMachine, ENGINES
+
+LOOP = 'loop: ADD [0] 1\nADD [1] 1\nJMP :loop'
+COUNT = 'loop: ADD [0] 1\nJZ :end [0]\nJMP :loop\nend: HALT'
+
+
+def load(asm, engine=None, **kwargs):
+    vm = VirtualMachine(engine or ENGINES[0], sink=None, **kwargs)
+    vm.load_source(asm)
+    return vm
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_scheduler(engine):
+    vms = [load(LOOP, engine), load('DPRINT 1\nHALT', engine),
+           load('DPRINT 2', engine)]
+
+    scheduler = Scheduler(quantum=100, max_ticks=5000)
+    results = asyncio.run(scheduler.run_all(vms))
+
+    assert results[0].ticks == 5000
+    assert results[0].error == 'Exceeded the budget of 5000 ticks'
+    assert results[1] == ('1', 2, None)
+    assert results[2].error.startswith('MissingHaltError')
+
+
+def test_scheduler_fairness():
+    async def main():
+        scheduler = Scheduler(quantum=100)
+        endless = asyncio.ensure_future(scheduler.run(load(LOOP)))
+        short = asyncio.ensure_future(scheduler.run(load(COUNT)))
+
+        await short
+        assert not endless.done()
+        endless.cancel()
+
+        return short.result()
+
+    assert asyncio.run(main()).error is None
+
+
+def test_scheduler_timeout():
+    async def main():
+        # Never gets any input
+        reader = asyncio.StreamReader()
+        vm = load('AREAD [0]\nHALT', source=AsyncStream(reader))
+        return await Scheduler(timeout=0.01).run(vm)
+
+    result = asyncio.run(main())
+    assert result.error == 'Exceeded the timeout of 0.01s'
+    assert result.ticks == 0
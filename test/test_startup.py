@@ -0,0 +1,15 @@
+import subprocess
+import sys
+from os.path import dirname
+
+# Modules the VM only imports once they're needed
+LAZY = ['assembler', 'asyncio', 'colorama', 'colors', 'cycles', 'inspect',
+        'preprocessor', 'profiler', 'random', 'snapshot', 'tracing']
+
+
+def test_lazy_imports():
+    code = 'import sys, virtualmachine; print(" ".join(sys.modules))'
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=dirname(dirname(__file__)))
+
+    assert not set(LAZY) & set(output.decode().split())
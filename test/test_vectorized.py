@@ -0,0 +1,69 @@
+from os.path import dirname, join
+
+import pytest
+
+import config
+config.TESTING = True
+
+np = pytest.importorskip('numpy')
+
+from virtualmachine import VirtualMachine
+from vectorized import VectorMachine
+
+multiply = """
+MOV $arg0 [20]
+MOV $arg1 [21]
+@call(math_multiply, $arg0, $arg1)
+DPRINT $return
+APRINT ' '
+HALT
+
+#import {}
+""".format(join(dirname(dirname(__file__)), 'lib', 'math', 'multiply.asm'))
+
+
+def test_vectorized():
+    vm = VectorMachine(12)
+    vm.memory[:, 20] = np.arange(12) * 20
+    vm.memory[:, 21] = np.arange(12)
+
+    outputs = vm.run(multiply)
+
+    for i, output in enumerate(outputs):
+        scalar = VirtualMachine()
+        scalar.mem_store(20, i * 20)
+        scalar.mem_store(21, i)
+
+        assert output == scalar.run(multiply)
+        assert vm.ticks[i] == scalar.ticks
+        assert list(vm.memory[i]) == list(scalar.memory)
+
+    assert vm.errors == [None] * 12
+
+
+def test_vectorized_errors():
+    vm = VectorMachine(3)
+    vm.memory[:, 0] = [0, 1, 2]
+
+    vm.run('JEQ :a [0] 1\nJEQ :b [0] 2\nHALT\na: JMP :a\nb: DPRINT 5')
+
+    assert vm.outputs == [[], [], ['5']]
+    assert vm.errors == [None, 'VirtualRuntimeError: Stuck in infinite loop!',
+                         'MissingHaltError: Reached end of code without '
+                         'seeing HALT']
+
+    vm = VectorMachine(2, memory_size=16)
+    vm.run('DPRINT [20]\nHALT')
+    assert vm.errors == ['VirtualRuntimeError: Memory address 20 is out of '
+                         'bounds, the memory has 16 cells'] * 2
+
+
+def test_vectorized_random():
+    def run(seed):
+        vm = VectorMachine(100, seed=seed)
+        return vm.run('RANDOM [0]\nDPRINT [0]\nHALT')
+
+    assert run(1) == run(1)
+    assert len(set(run(1))) > 1
+    assert set(int(output) for output in run(2)) <= \
+        set(range(config.RAND_MAX + 1))
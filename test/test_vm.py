@@ -1,3 +1,6 @@
+import asyncio
+from io import StringIO
+
 import pytest
 
 import config
@@ -5,12 +8,20 @@ from exc import VirtualRuntimeError, MissingHaltError
 
 config.TESTING = True
 
-from virtualmachine import (VirtualMachine)
+import assembler
+import objfile
+import snapshot
+import sources
+from tracing import Printer, RingBuffer, Sampler
+from loops import CountedLoop
+from sinks import Callback, Null, Stream
+from sources import AsyncStream, Buffer
+from virtualmachine import (VirtualMachine, COMPILED, OPTIMIZING, ENGINES)
 
 
-@pytest.fixture
-def vm():
-    return VirtualMachine()
+@pytest.fixture(params=ENGINES)
+def vm(request):
+    return VirtualMachine(request.param)
 
 
 def test_trivial(vm):
@@ -31,3 +42,516 @@ def test_invalid_jump(vm):
 def test_infinite_loop(vm):
     with pytest.raises(VirtualRuntimeError):
         vm.run('JMP 0')
+
+
+@pytest.mark.parametrize('asm', ['JEQ 6 [0] 2', 'MOV [1] 6\nJMP [1]'])
+def test_stuck_state(vm, asm):
+    with pytest.raises(VirtualRuntimeError, match='Stuck in infinite loop'):
+        vm.run('MOV [0] 1\nADD [0] 1\n' + asm)
+
+    ticks = 2 + asm.count('\n')
+    assert (vm.prev_instr_pointer, vm.ticks) == (vm.instr_pointer - 3, ticks)
+
+
+def test_tight_loop(vm):
+    # The jump back isn't mistaken for a jump to itself
+    assert vm.run('loop: ADD [0] 1\nJGT :loop [0] 0\nDPRINT [0]\nHALT') == '0'
+    assert vm.ticks == 2 * 256 + 2
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_max_ticks(engine):
+    vm = VirtualMachine(engine, max_ticks=1000, check_every=300)
+    with pytest.raises(VirtualRuntimeError, match='budget of 1000 ticks'):
+        vm.run('loop: ADD [0] 1\nJMP :loop')
+    assert vm.ticks == 1000
+
+    vm = VirtualMachine(engine, max_ticks=1000)
+    assert vm.run('DPRINT 1\nHALT') == '1'
+
+
+def test_timeout():
+    vm = VirtualMachine(timeout=0.01, check_every=1000)
+    with pytest.raises(VirtualRuntimeError, match='timeout of 0.01s'):
+        vm.run('loop: ADD [0] 1\nJMP :loop')
+
+
+@pytest.mark.parametrize('asm', [
+    'MOV [0] 1\nJMP 0',
+    'loop: ADD [0] 1\nADD [1] 3\nJMP :loop',
+    # Reads at the end of the input don't change anything
+    'loop: AREAD [0]\nJMP :loop',
+])
+def test_detect_cycles(vm, asm):
+    vm = VirtualMachine(vm.engine, detect_cycles=True, source=None)
+    with pytest.raises(VirtualRuntimeError, match='Stuck'):
+        vm.run(asm)
+
+    # Found within a few rounds of the 256 different states
+    assert vm.ticks < 10 * 3 * 256
+
+
+def test_detect_cycles_progress(vm):
+    # Neither the memory nor the instruction pointer tell these rounds apart
+    vm = VirtualMachine(vm.engine, detect_cycles=True, max_ticks=10000,
+                        source=sources.Buffer('x' * 10000))
+    with pytest.raises(VirtualRuntimeError, match='budget'):
+        vm.run('loop: AREAD [0]\nMOV [0] 0\nJMP :loop')
+    assert vm.reads == 3334
+
+    vm = VirtualMachine(vm.engine, detect_cycles=True, max_ticks=10000)
+    with pytest.raises(VirtualRuntimeError, match='budget'):
+        vm.run('loop: RANDOM [0]\nMOV [0] 0\nJMP :loop')
+
+
+@pytest.mark.parametrize('asm', ['MOV [20] 1', 'DPRINT [20]', 'JMP [20]',
+                                 'ADD [0] [20]'])
+def test_out_of_bounds(vm, asm):
+    vm = VirtualMachine(vm.engine, memory_size=16)
+    with pytest.raises(VirtualRuntimeError,
+                       match='Memory address 20 is out of bounds'):
+        vm.run('DPRINT 1\n' + asm + '\nHALT')
+
+    assert (vm.instr_pointer, vm.ticks) == (2, 1)
+    assert vm.output.getvalue() == '1'
+
+
+def test_hexcode(vm):
+    assert vm.run('0x08 0x00 0x05 0x22 0x00 0xFF', preprocess=False) == '5'
+
+
+def test_symbols(vm):
+    vm.run('loop: APRINT 33\nend: HALT')
+
+    assert vm.program.symbols == {'loop': 0, 'end': 2}
+    assert vm.program.label_at(2) == 'end'
+    assert vm.program.label_at(1) is None
+
+
+def test_decoded_program(vm):
+    vm.run('MOV [0] 5\nADD [0] [0]\nHALT')
+
+    mov, add = vm.program.instructions[0], vm.program.instructions[3]
+    assert (mov.mnem, mov.args, mov.deref, mov.size) == \
+        ('MOV', (0, 5), None, 3)
+    assert (add.mnem, add.args, add.deref) == ('ADD', (0, 0), (False, True))
+    assert vm.memory[0] == 10
+
+
+def test_jump_into_argument(vm):
+    # Address 4 is the literal 255 which decodes to HALT
+    vm.run('JMP 4\nMOV [0] 255')
+    assert vm.running is False
+    assert vm.memory[0] == 0
+
+
+def test_object_file(vm, tmpdir):
+    path = tmpdir.join('prog.bin')
+    path.write_binary(assembler.assembler_to_binary('DPRINT 42\nHALT'))
+
+    assert vm.run(objfile.load(str(path))) == '42'
+
+
+def test_object_bytes(vm):
+    data = assembler.assembler_to_binary('start:\nDPRINT 7\nHALT')
+
+    assert vm.run(memoryview(data)) == '7'
+    assert vm.program.symbols == {'start': 0}
+
+
+def test_object_word_size(vm):
+    data = assembler.assembler_to_binary('MOV [0] 200\nADD [0] 100\n'
+                                         'DPRINT [0]\nHALT', word_size=32)
+
+    # Runs at the word size it was assembled for
+    assert vm.run(data) == '300'
+    assert vm.word_size == 32
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        VirtualMachine('jit')
+
+
+def test_profile_and_trace():
+    with pytest.raises(ValueError, match="can't be combined"):
+        VirtualMachine(profile=True, trace=RingBuffer(3))
+
+
+def test_compiled_computed_jump():
+    vm = VirtualMachine(COMPILED)
+    assert vm.run('MOV [0] 8\nJMP [0]\nHALT\nDPRINT 1\nHALT') == ''
+    assert vm.ticks == 3
+
+    # 8 is not a block start when compiling, it's only known from memory
+    vm = VirtualMachine(COMPILED)
+    vm.run('ADD [0] 8\nJMP [0]\nHALT\nDPRINT 1\nHALT')
+    assert vm.output.getvalue() == ''
+    assert 8 in vm.program.compiled[VirtualMachine, vm.word_size,
+                                    len(vm.memory)].leaders
+
+
+def test_compiled_matches_interpreter():
+    asm = """
+    $a = [_]
+    $b = [_]
+    MOV $a 200
+    MOV $b 100
+    loop:
+    ADD $a $b
+    SUB $b 7
+    XOR $a 3
+    NOT [9]
+    JGT :loop $b 50
+    DPRINT $a
+    HALT
+    """
+    interpreter, compiled = VirtualMachine(), VirtualMachine(COMPILED)
+
+    assert interpreter.run(asm) == compiled.run(asm)
+    assert list(interpreter.memory) == list(compiled.memory)
+    assert interpreter.ticks == compiled.ticks
+
+
+def test_profile():
+    vm = VirtualMachine(profile=True)
+    vm.run('MOV [0] 3\nloop: SUB [0] 1\nADD [1] 1\nJGT :loop [0] 0\nHALT')
+
+    profiler = vm.profiler
+    assert sum(profiler.counts) == vm.ticks == 11
+
+    labels = dict((row.name, row.count) for row in profiler.by_label())
+    assert labels == {None: 1, 'loop': 10}
+
+    addresses = profiler.to_json()['addresses']
+    assert [(row['name'], row['count'], row['source']) for row in
+            sorted(addresses, key=lambda row: row['name'])] == [
+        (0, 1, 'MOV [0] 3'), (3, 3, 'loop: SUB [0] 1'), (6, 3, 'ADD [1] 1'),
+        (9, 3, 'JGT :loop [0] 0'), (13, 1, 'HALT')
+    ]
+    assert 'loop' in profiler.report()
+
+    # Loading a program directly starts a profile, too
+    vm = VirtualMachine(profile=True)
+    vm.load(assembler.assembler_to_hex('DPRINT 1\nDPRINT 2\nHALT'))
+    vm.execute()
+    assert vm.profiler.counts == [1, 0, 1, 0, 1]
+    assert vm.profiler.source(0) == ''
+
+
+def test_error_location(vm):
+    with pytest.raises(VirtualRuntimeError):
+        vm.run('DPRINT 1\n\nend: JZ :end 0\nHALT')
+
+    location = vm.location(vm.instr_pointer)
+    assert (location.filename, location.lineno) == ('<input>', 2)
+
+    # Kept in snapshots
+    restored = VirtualMachine()
+    restored.restore(vm.snapshot())
+    assert restored.location(vm.instr_pointer) == location
+
+
+def test_trace_location():
+    output = StringIO()
+    vm = VirtualMachine(trace=Printer(output, lambda pc: vm.location(pc)))
+    vm.run('MOV [0] 3\n\nHALT')
+
+    assert output.getvalue().splitlines()[1].endswith('(<input>:3)')
+
+
+def test_trace():
+    events = RingBuffer(3)
+    vm = VirtualMachine(trace=Sampler(events, 2))
+    vm.run('MOV [0] 3\nloop: SUB [0] 1\nADD [1] 1\nJGT :loop [0] 0\nHALT')
+
+    assert vm.ticks == 11
+    assert [(event.ticks, event.mnem) for event in events] == [
+        (5, 'ADD'), (7, 'SUB'), (9, 'JGT')
+    ]
+
+    add, sub, jgt = events
+    assert add.writes == ((1, 2),) and add.jump is None
+    assert sub.operands == (0, 1) and sub.writes == ((0, 0),)
+    assert jgt.operands == (3, 0, 0) and jgt.jump is None
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_word_size(engine):
+    code = 'MOV [0] 200\nADD [0] 100\nSUB [1] 1\nDPRINT [0]\nHALT'
+    vm8 = VirtualMachine(engine)
+    vm32 = VirtualMachine(engine, word_size=32, memory_size=16)
+
+    assert vm8.run(code) == '44'
+    assert vm32.run(code) == '300'
+    assert vm8.memory[1] == 255 and vm32.memory[1] == 2 ** 32 - 1
+    assert len(vm32.memory) == 16
+
+    with pytest.raises(ValueError):
+        VirtualMachine(word_size=12)
+
+
+COUNTDOWN = 'MOV [0] 5\nloop: SUB [0] 1\nDPRINT [0]\nJGT :loop [0] 0\nHALT'
+
+
+def test_snapshot(vm):
+    vm.load(assembler.assembler_to_hex(COUNTDOWN))
+    vm.execute(4)
+    state = vm.snapshot()
+    assert vm.running and vm.output.getvalue() == '4'
+
+    vm.execute()
+    restored = VirtualMachine(vm.engine)
+    restored.restore(state)
+
+    assert restored.resume() == vm.output.getvalue() == '43210'
+    assert list(restored.memory) == list(vm.memory)
+    assert restored.ticks == vm.ticks == 17
+
+    with pytest.raises(VirtualRuntimeError):
+        restored.restore(state[:-1])
+
+
+RANDOMS = 'MOV [0] 10\nloop: RANDOM [1]\nDPRINT [1]\nSUB [0] 1\n' \
+          'JGT :loop [0] 0\nHALT'
+
+
+def test_snapshot_random(vm):
+    code = assembler.assembler_to_hex(RANDOMS)
+    vm = VirtualMachine(vm.engine, seed=7)
+    vm.load(code)
+    vm.execute(10)
+    state = vm.snapshot()
+    vm.execute()
+
+    restored = VirtualMachine(vm.engine)
+    restored.restore(state)
+    assert restored.resume() == vm.output.getvalue()
+
+    other = VirtualMachine(vm.engine, seed=8)
+    assert other.run(code, preprocess=False) != vm.output.getvalue()
+
+    # Seeds out of the 64 bit range are wrapped around, see `rng`
+    vm = VirtualMachine(vm.engine, seed=-1, stream=2 ** 70)
+    vm.run(code, preprocess=False)
+    restored = VirtualMachine(vm.engine)
+    restored.restore(vm.snapshot())
+    assert restored.random.seed == 2 ** 64 - 1
+
+
+def test_snapshot_word_size(tmpdir):
+    path = str(tmpdir.join('vm.snapshot'))
+    vm = VirtualMachine(word_size=32, memory_size=4)
+    vm.run('MOV [1] 70000\nHALT')
+    snapshot.save(vm, path)
+
+    restored = VirtualMachine()
+    restored.restore(snapshot.load(path))
+    assert (restored.word_size, list(restored.memory)) == (32, [0, 70000, 0, 0])
+    assert restored.running is False
+
+
+def test_checkpoint(vm, tmpdir):
+    path = str(tmpdir.join('vm.snapshot'))
+    vm = VirtualMachine(vm.engine, checkpoint=path, checkpoint_every=5)
+    assert vm.run(COUNTDOWN) == '43210'
+
+    state = snapshot.load(path)
+    assert state.running and state.ticks == 15
+
+    restored = VirtualMachine()
+    restored.restore(state)
+    assert restored.resume() == '43210'
+
+
+def test_fork(vm):
+    vm.load(assembler.assembler_to_hex(
+        'MOV [200] 1\nDPRINT [200]\nADD [0] [200]\nDPRINT [0]\nHALT'
+    ))
+    vm.execute(2)
+
+    children = [vm.fork() for _ in range(3)]
+    for i, child in enumerate(children):
+        child.mem_store(0, i * 10)
+        assert child.resume() == '1{}'.format(i * 10 + 1)
+        assert child.program is vm.program
+
+        # Only the page with cell 0 has been copied
+        assert child.memory.owned_pages() == 1
+
+    assert vm.memory[0] == 0 and vm.memory[200] == 1
+    assert vm.resume() == '11'
+
+
+def test_superinstructions():
+    asm = 'MOV [0] 4\nloop: JEQ :end [0] [1]\nADD [1] 1\nADD [2] 3\n' \
+          'JMP :loop\nend: DPRINT [2]\nHALT'
+    vm, reference = VirtualMachine(), VirtualMachine(profile=True)
+
+    assert vm.run(asm) == reference.run(asm) == '12'
+    assert vm.ticks == reference.ticks
+    assert list(vm.memory) == list(reference.memory)
+
+    fused = vm.program.fused[VirtualMachine, vm.word_size, len(vm.memory),
+                             False]
+    assert fused[vm.program.symbols['loop']].size == 4
+
+    # Sequences don't run past a tick limit
+    vm = VirtualMachine()
+    vm.load(assembler.assembler_to_hex(asm))
+    vm.execute(3)
+    assert (vm.ticks, vm.memory[1]) == (3, 1)
+
+
+def test_superinstructions_stuck():
+    vm = VirtualMachine()
+    with pytest.raises(VirtualRuntimeError):
+        vm.run('MOV [0] 1\nend: JZ :end [1]')
+
+    assert (vm.ticks, vm.instr_pointer, vm.memory[0]) == (1, 3, 1)
+
+
+@pytest.mark.parametrize('word_size, count, step', [
+    (8, 7, 100),    # The sum wraps around
+    (32, 10 ** 6, 3),
+])
+def test_optimizing_loops(word_size, count, step):
+    asm = 'MOV [1] {}\nloop: JEQ :end [0] [1]\nADD [0] 1\nADD [2] {}\n' \
+          'JMP :loop\nend: DPRINT [2]\nHALT'.format(count, step)
+
+    vm = VirtualMachine(OPTIMIZING, word_size=word_size)
+    assert vm.run(asm) == str(count * step % 2 ** word_size)
+    assert vm.ticks == count * 4 + 4
+
+    fused = vm.program.fused[VirtualMachine, word_size, len(vm.memory), True]
+    assert isinstance(fused[vm.program.symbols['loop']], CountedLoop)
+
+    if count < 1000:
+        reference = VirtualMachine(word_size=word_size)
+        reference.run(asm)
+        assert list(vm.memory) == list(reference.memory)
+        assert vm.ticks == reference.ticks
+
+
+def test_optimizing_fallback():
+    # [0] would wrap around before it's less than 5, so the loop can't be
+    # solved and runs normally
+    asm = 'MOV [0] 7\nloop: JLS :end [0] 5\nSUB [0] 10\nADD [1] 1\n' \
+          'JMP :loop\nend: DPRINT [1]\nHALT'
+
+    vm, reference = VirtualMachine(OPTIMIZING), VirtualMachine()
+    assert vm.run(asm) == reference.run(asm)
+    assert vm.ticks == reference.ticks
+
+
+def test_optimizing_large_literal():
+    # No 8 bit cell ever equals 300, so the loop never exits
+    asm = 'loop: JEQ :end [0] 300\nADD [0] 1\nADD [1] 1\nJMP :loop\n' \
+          'end: DPRINT [1]\nHALT'
+
+    for engine in ENGINES:
+        vm = VirtualMachine(engine, word_size=8, max_ticks=10000)
+        with pytest.raises(VirtualRuntimeError, match='budget'):
+            vm.run(asm)
+
+
+def test_optimize(vm):
+    asm = 'MOV [0] 1\nMOV [0] 2\nJMP :next\nDPRINT [1]\n' \
+          'next: MOV [1] [1]\nDPRINT [0]\nHALT'
+
+    reference = VirtualMachine(vm.engine)
+    optimized = VirtualMachine(vm.engine, optimize=True)
+    assert optimized.run(asm) == reference.run(asm) == '2'
+    assert optimized.ticks == 3 < reference.ticks
+
+
+def test_sinks(vm):
+    asm = "APRINT 'a'\nDPRINT 12\nHALT"
+
+    chunks = []
+    vm.sink = Callback(chunks.append)
+    assert vm.run(asm) == 'a12'
+    assert chunks == ['a', '12']
+
+    # Nothing is kept with the null sink
+    vm = VirtualMachine(vm.engine, sink=Null())
+    assert vm.run(asm) == ''
+
+    # In memory only
+    vm = VirtualMachine(vm.engine, sink=None)
+    assert vm.run(asm) == 'a12'
+
+
+def test_sink_buffering(tmpdir):
+    with open(str(tmpdir.join('out')), 'w') as f:
+        sink = Stream(f, buffer_size=2)
+        sink.write('a')
+        assert f.tell() == 0
+        sink.write('bc')
+        assert f.tell() == 3
+
+        sink.write('d')
+        VirtualMachine(sink=sink).run('DPRINT 5\nHALT')
+        assert f.tell() == 5
+
+    assert tmpdir.join('out').read() == 'abcd5'
+
+
+# The compiled code has to stop in the middle of a block for AREAD
+ECHO = 'loop: MOV [1] 0\nAREAD [0]\nJZ :end [0]\nAPRINT [0]\nJMP :loop\n' \
+       'end: HALT'
+
+
+def test_source(vm):
+    vm.source = Buffer(b'hi')
+    assert vm.run(ECHO) == 'hi'
+
+    vm = VirtualMachine(vm.engine, source=sources.Stream(StringIO('a\nb')))
+    assert vm.run(ECHO) == 'a\nb'
+
+    # Without a source, AREAD reads 0
+    vm = VirtualMachine(vm.engine, source=None)
+    assert vm.run(ECHO) == ''
+
+
+def test_async_source(vm):
+    reference = VirtualMachine(vm.engine, source=Buffer('abc'))
+    reference.run(ECHO)
+
+    async def main():
+        reader = asyncio.StreamReader()
+        vm.source = AsyncStream(reader)
+
+        vm.load(assembler.assembler_to_hex(ECHO))
+        task = asyncio.ensure_future(vm.resume_async())
+
+        for chunk in (b'a', b'bc'):
+            await asyncio.sleep(0)
+            assert vm.waiting and not task.done()
+            reader.feed_data(chunk)
+
+        reader.feed_eof()
+        return await task
+
+    assert asyncio.run(main()) == 'abc'
+    assert vm.ticks == reference.ticks
+    assert not vm.waiting
+
+
+def test_async_quantum():
+    vm = VirtualMachine(word_size=32)
+    seen = []
+
+    async def watch():
+        while True:
+            seen.append(vm.ticks)
+            await asyncio.sleep(0)
+
+    async def main():
+        watcher = asyncio.ensure_future(watch())
+        await vm.run_async('loop: ADD [0] 1\nJLS :loop [0] 50000\nHALT')
+        watcher.cancel()
+
+    # Other tasks get to run while the program does
+    asyncio.run(main())
+    assert len(set(seen)) > 5
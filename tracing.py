@@ -0,0 +1,104 @@
+"""
+Tiny-ASM execution tracing.
+
+A trace hook is any callable taking an `Event`. It's called after every
+executed instruction, if it's installed with `VirtualMachine(trace=hook)`.
+Without a hook, the VM's engines don't do any tracing work at all.
+
+The hooks in here can be combined, e.g. `Sampler(RingBuffer(1000), 100)`
+keeps every 100th of the last 100000 instructions.
+"""
+import sys
+from collections import deque, namedtuple
+
+
+# An executed instruction:
+# - ticks:    number of instructions executed before this one
+# - pc:       the instruction's address
+# - opcode:   the opcode as it's listed in `opcodes.instructions`
+# - mnem:     the instruction's mnemonic
+# - operands: the arguments the instruction got, after reading the memory
+# - writes:   the memory writes as (address, value) pairs
+# - jump:     the jump destination, None if it didn't jump
+Event = namedtuple('Event', ['ticks', 'pc', 'opcode', 'mnem', 'operands',
+                             'writes', 'jump'])
+
+
+def format_event(event):
+    """
+    :type event: Event
+    """
+    parts = ['{:8}  {:5}  {:6} ({})'.format(event.ticks, event.pc,
+                                           event.mnem, event.opcode)]
+
+    if event.operands:
+        parts.append(' '.join(str(operand) for operand in event.operands))
+    for address, value in event.writes:
+        parts.append('[{}] = {}'.format(address, value))
+    if event.jump is not None:
+        parts.append('-> {}'.format(event.jump))
+
+    return '  '.join(parts)
+
+
+###############################################################################
+# HOOKS
+###############################################################################
+
+class RingBuffer(object):
+    """
+    Keep the last `size` events, e.g. to look at what led to an error.
+    """
+
+    def __init__(self, size=1024):
+        #: :type: deque[Event]
+        self.events = deque(maxlen=size)
+
+    def __call__(self, event):
+        self.events.append(event)
+
+    def __iter__(self):
+        return iter(self.events)
+
+    def __len__(self):
+        return len(self.events)
+
+
+class Sampler(object):
+    """
+    Pass every `every`-th event on to `hook`.
+    """
+
+    def __init__(self, hook, every):
+        self.hook = hook
+        self.every = every
+        self.counter = 0
+
+    def __call__(self, event):
+        self.counter += 1
+        if self.counter == self.every:
+            self.counter = 0
+            self.hook(event)
+
+
+class Printer(object):
+    """
+    Print every event, to stderr by default.
+
+    If `locate` is given, it's called with an event's address to get where
+    the instruction comes from, e.g. `VirtualMachine.location`, and the
+    file and line are printed along with the event.
+    """
+
+    def __init__(self, stream=None, locate=None):
+        self.stream = stream
+        self.locate = locate
+
+    def __call__(self, event):
+        line = format_event(event)
+
+        location = self.locate(event.pc) if self.locate else None
+        if location is not None:
+            line += '  ({}:{})'.format(location.filename, location.lineno + 1)
+
+        print(line, file=self.stream or sys.stderr)
@@ -0,0 +1,278 @@
+"""
+Tiny-ASM vectorized engine.
+
+Runs many instances of the same program in lockstep, e.g. for Monte Carlo
+programs like `pi.asm`. The instances' memory is a (instances × memory size)
+NumPy matrix and their program counters are a vector.
+
+Instances are grouped by their program counter. Every step executes the
+instruction of the group with the lowest program counter on all of its
+instances at once, with vectorized operations. Instances that diverged wait
+for the others to catch up, e.g. the ones that left a loop early wait for
+the ones still in it, so they mostly run as few large groups.
+
+Requires NumPy.
+"""
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+import assembler
+import sources
+from sources import STDIN
+from config import MEMORY_SIZE, WORD_SIZE, RAND_MAX
+from exc import VirtualRuntimeError, MissingHaltError
+from opcodes import *
+from decoder import memory_accesses
+from virtualmachine import VirtualMachine, load_program, OUT_OF_BOUNDS
+
+
+###############################################################################
+# OPERATIONS
+###############################################################################
+# The vectorized instruction implementations. They're called with the
+# machine, the indices of the instances to execute, the decoded instruction
+# and the arguments (vectors where the memory has been read, ints otherwise).
+# Jumps return the new program counters, None means no instance jumped.
+
+def binary_operation(operator):
+    def operation(vm, idx, decoded, args):
+        dest = args[0]
+        vm.memory[idx, dest] = operator(vm.memory[idx, dest],
+                                        vm.wrap(args[1]))
+
+    return operation
+
+
+def mov(vm, idx, decoded, args):
+    vm.memory[idx, args[0]] = vm.wrap(args[1])
+
+
+def not_(vm, idx, decoded, args):
+    # Like NotInstruction, this stores the inverted address
+    vm.memory[idx, args[0]] = vm.wrap(~ args[0])
+
+
+def random_(vm, idx, decoded, args):
+    vm.memory[idx, args[0]] = vm.random.integers(0, RAND_MAX + 1, len(idx))
+
+
+def aread(vm, idx, decoded, args):
+    source = vm.source or sources.Buffer()
+    chars = [source.read() for _ in idx]
+    vm.memory[idx, args[0]] = [ord(c) if c else 0 for c in chars]
+
+
+def jump_operation(condition):
+    def operation(vm, idx, decoded, args):
+        dest = args[0]
+        taken = np.broadcast_to(condition(*args[1:]), idx.shape)
+        if not taken.any():
+            return None
+
+        dest = np.broadcast_to(dest, idx.shape)
+
+        # Same check as VirtualMachine.instr_jump
+        stuck = taken & (dest == decoded.address)
+        if stuck.any():
+            vm.fail(idx[stuck], VirtualRuntimeError, 'Stuck in infinite loop!')
+
+        return np.where(taken, dest, decoded.address + decoded.size)
+
+    return operation
+
+
+def halt(vm, idx, decoded, args):
+    vm.running[idx] = False
+
+
+def print_operation(convert):
+    def operation(vm, idx, decoded, args):
+        values = np.broadcast_to(args[0], idx.shape)
+        for i, value in zip(idx.tolist(), values.tolist()):
+            vm.outputs[i].append(convert(value))
+
+    return operation
+
+
+OPERATIONS = {
+    AndInstruction: binary_operation(lambda a, b: a & b),
+    OrInstruction: binary_operation(lambda a, b: a | b),
+    XorInstruction: binary_operation(lambda a, b: a ^ b),
+    AddInstruction: binary_operation(lambda a, b: a + b),
+    SubInstruction: binary_operation(lambda a, b: a - b),
+    NotInstruction: not_,
+    MovInstruction: mov,
+    RandomInstruction: random_,
+    AreadInstruction: aread,
+    JmpInstruction: jump_operation(lambda: True),
+    JzInstruction: jump_operation(lambda a: a == 0),
+    JeqInstruction: jump_operation(lambda a, b: a == b),
+    JlsInstruction: jump_operation(lambda a, b: a < b),
+    JgtInstruction: jump_operation(lambda a, b: a > b),
+    HaltInstruction: halt,
+    AprintInstruction: print_operation(lambda a: chr(a)),
+    DprintInstruction: print_operation(str),
+}
+
+
+###############################################################################
+# THE VECTORMACHINE CLASS
+###############################################################################
+
+class VectorMachine(object):
+    """
+    Run `instances` copies of a program in lockstep.
+
+    Unlike `VirtualMachine`, errors don't stop the whole run: the failing
+    instances are stopped and their error is stored in `errors`. The output
+    isn't printed, but kept in `outputs`.
+    """
+
+    # Memory cell types by word size
+    dtypes = {8: 'uint8', 16: 'uint16', 32: 'uint32', 64: 'uint64'}
+
+    #: Instruction classes by mnemonic, the same as VirtualMachine's
+    instructions = VirtualMachine.instructions
+
+    def __init__(self, instances, word_size=WORD_SIZE,
+                 memory_size=MEMORY_SIZE, seed=None, source=STDIN):
+        """
+        :param seed: seed for `RANDOM`, every instance gets its own numbers
+        :param source: where AREAD reads from, the instances take turns.
+                       Has to be a blocking source, see `sources`.
+        """
+        if np is None:
+            raise ImportError('The vectorized engine requires NumPy')
+
+        try:
+            dtype = self.dtypes[word_size]
+        except KeyError:
+            raise ValueError('Unsupported word size: {}'.format(word_size))
+
+        self.instances = instances
+        self.word_size = word_size
+        self.max_int = 2 ** word_size
+        self.random = np.random.default_rng(seed)
+        self.source = sources.Stream() if source == STDIN else source
+
+        #: :type: decoder.Program
+        self.program = None
+        self.operations = {}
+
+        self.memory = np.zeros((instances, memory_size), dtype=dtype)
+        self.pc = np.zeros(instances, dtype=np.int64)
+        self.ticks = np.zeros(instances, dtype=np.int64)
+        self.running = np.ones(instances, dtype=bool)
+        self.failed = np.zeros(instances, dtype=bool)
+
+        #: :type: list[list[str]]
+        self.outputs = [[] for _ in range(instances)]
+        #: The error of every instance, None if there was none
+        #: :type: list[str]
+        self.errors = [None] * instances
+
+    def wrap(self, value):
+        """ Wrap a literal around to the word size """
+        if isinstance(value, int):
+            return value % self.max_int
+        return value
+
+    def fail(self, idx, exc_class, msg):
+        """ Stop the instances `idx` because of an error """
+        for i in idx.tolist():
+            self.errors[i] = '{}: {}'.format(exc_class.__name__, msg)
+
+        self.running[idx] = False
+        self.failed[idx] = True
+
+    ###########################################################################
+    # LOADING
+    ###########################################################################
+
+    def load(self, code):
+        """
+        :param code: see `VirtualMachine.load`
+        """
+        self.program = load_program(code, VirtualMachine.opcode_table(),
+                                    self.word_size)
+        self.pc[:] = self.program.entry
+
+        for mnem, instruction_class in self.instructions.items():
+            try:
+                self.operations[mnem] = OPERATIONS[instruction_class]
+            except KeyError:
+                raise VirtualRuntimeError(
+                    '{} is not supported by the vectorized engine'.format(mnem)
+                )
+
+    ###########################################################################
+    # EXECUTION
+    ###########################################################################
+
+    def execute(self, address, idx):
+        """ Execute the instruction at `address` on the instances `idx` """
+        program = self.program
+
+        if not 0 <= address < len(program):
+            self.fail(idx, MissingHaltError,
+                      'Reached end of code without seeing HALT')
+            return
+
+        decoded = program.instructions[address]
+        if decoded is None:
+            msg, exc_class = program.errors[address]
+            self.fail(idx, exc_class, msg)
+            return
+
+        args = decoded.args
+        try:
+            if decoded.deref is not None:
+                args = [self.memory[idx, arg] if deref else arg
+                        for arg, deref in zip(args, decoded.deref)]
+
+            pc = self.operations[decoded.mnem](self, idx, decoded, args)
+        except IndexError:
+            msg = OUT_OF_BOUNDS.format(max(memory_accesses(decoded)),
+                                       self.memory.shape[1])
+            self.fail(idx, VirtualRuntimeError, msg)
+            return
+
+        self.ticks[idx] += ~ self.failed[idx]
+        self.pc[idx] = address + decoded.size if pc is None else pc
+
+    def step(self):
+        """
+        Execute the instruction at the lowest program counter on all running
+        instances that are there.
+
+        Returns False if no instance is running anymore.
+        """
+        active = np.flatnonzero(self.running)
+        if not len(active):
+            return False
+
+        pcs = self.pc[active]
+        address = int(pcs.min())
+        self.execute(address, active[pcs == address])
+
+        return True
+
+    def run(self, asm, filename=None, preprocess=True):
+        """
+        Run the program on all instances.
+
+        :param asm: see `VirtualMachine.run`
+        :returns: the output of every instance
+        :rtype: list[str]
+        """
+        if preprocess and isinstance(asm, str):
+            asm = assembler.assembler_to_hex(asm, filename)
+
+        self.load(asm)
+
+        while self.step():
+            pass
+
+        return [''.join(output) for output in self.outputs]
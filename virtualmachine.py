@@ -2,28 +2,36 @@
 # IMPORTS
 ###############################################################################
 
+# Only what's needed to run a program is imported here. The assembler,
+# snapshots, profiling, tracing and the CLI's modules are imported when
+# they're used, to keep the startup fast, see `benchmarks/startup.py`.
+
+import sys
+from ctypes import c_uint8, c_uint16, c_uint32, c_uint64
 from io import StringIO
 from timeit import default_timer as timer
 
-import colorama
-
-import assembler
+import objfile
+import sources
+from compiler import compile_program
+from fusion import fuse
+from decoder import (Program, build_opcode_table, decode, parse_hex,
+                     memory_accesses)
 from exc import VirtualRuntimeError, MissingHaltError
+from paging import PagedMemory
+from rng import Random
+from sourcemap import SourceMap
+from sinks import STDOUT, Null, Stream
+from sources import STDIN, InputPending
 from opcodes import *
-from config import MEMORY_SIZE, MAX_INT, DEBUG, TESTING
-from helpers import get_ordered_annotations, fatal_error
-
-
-colorama.init()
+from config import MEMORY_SIZE, WORD_SIZE, DEBUG, TESTING
+from helpers import fatal_error
 
 
 ###############################################################################
 # SMALL HELPERS
 ###############################################################################
 
-# Convert an int to uint8, ensuring it's not larger than WORD_SIZE
-to_uint = lambda i: i % MAX_INT
-
 # Check, if the given string represents an address
 is_address = lambda s: hasattr(s, '__getitem__') and s[0] == '['
 
@@ -33,13 +41,93 @@ is_literal = lambda s: not is_address(s)
 # Get an argument's type
 get_arg_type = lambda t: ADDRESS if is_address(t) else LITERAL
 
+# Memory cell types by word size. Storing a value in a cell wraps it around
+# to the word size.
+MEMORY_TYPES = {8: c_uint8, 16: c_uint16, 32: c_uint32, 64: c_uint64}
+
+# Error for instructions accessing memory that doesn't exist
+OUT_OF_BOUNDS = 'Memory address {} is out of bounds, the memory has {} cells'
+
 
-def get_annotations(instance):
+def allocate_memory(word_size, size):
+    """
+    Allocate zeroed memory of `size` cells with `word_size` bits each.
+    """
     try:
-        func = instance.__call__
-    except AttributeError:
-        return {}
-    return get_ordered_annotations(func)
+        cell_type = MEMORY_TYPES[word_size]
+    except KeyError:
+        raise ValueError('Unsupported word size: {}'.format(word_size))
+
+    return (cell_type * size)()
+
+
+def memory_to_list(memory):
+    """
+    Copy the memory to a list, a lot faster than `list(memory)`.
+    """
+    if isinstance(memory, PagedMemory):
+        return memory.tolist()
+
+    return memoryview(memory).cast('B').cast(memory._type_._type_).tolist()
+
+
+def list_to_memory(memory, cells):
+    """
+    Copy a list back to the memory, see `memory_to_list`.
+    """
+    if isinstance(memory, PagedMemory):
+        memory.update(cells)
+    else:
+        memory[:] = cells
+
+
+def load_program(code, opcode_table, word_size,
+                 exit_func=lambda: sys.exit(1)):
+    """
+    Decode an assembled program.
+
+    :param code: the hex code, an object file (either loaded or as a
+                 bytes-like object) or an already decoded program
+    :param word_size: the word size object files have to be assembled for
+    :rtype: Program
+    """
+    if isinstance(code, Program):
+        return code
+    if isinstance(code, str):
+        return decode(parse_hex(code), opcode_table)
+
+    if not isinstance(code, objfile.ObjectFile):
+        code = objfile.loads(code)
+
+    if code.word_size != word_size:
+        msg = 'Object file has a word size of {} bit, expected ' \
+              '{} bit'.format(code.word_size, word_size)
+        fatal_error(msg, VirtualRuntimeError, exit_func=exit_func)
+
+    return decode(code.code, opcode_table, code.entry, code.symbols,
+                  code.source_map)
+
+
+###############################################################################
+# ENGINES
+###############################################################################
+
+# Run the decoded instructions one by one
+INTERPRETER = 'interpreter'
+
+# Compile the whole program to a Python function, see `compiler`
+COMPILED = 'compiled'
+
+# Interpret the program, but run counted loops in closed form, see `loops`
+OPTIMIZING = 'optimizing'
+
+ENGINES = (INTERPRETER, COMPILED, OPTIMIZING)
+
+# Check the tick budget and the timeout every this many ticks
+CHECK_EVERY = 100000
+
+# Ticks `resume_async` runs before yielding to the event loop
+QUANTUM = 10000
 
 
 ###############################################################################
@@ -47,21 +135,112 @@ def get_annotations(instance):
 ###############################################################################
 
 class VirtualMachine(object):
-    def __init__(self):
+    def __init__(self, engine=INTERPRETER, cache=None, search_paths=(),
+                 profile=False, trace=None, word_size=WORD_SIZE,
+                 memory_size=MEMORY_SIZE, checkpoint=None,
+                 checkpoint_every=None, optimize=False, sink=STDOUT,
+                 source=STDIN, seed=None, stream=0, max_ticks=None,
+                 timeout=None, check_every=CHECK_EVERY, detect_cycles=False):
+        """
+        :param engine: the engine running the program, see `ENGINES`
+        :param cache: the cache to assemble programs with
+        :type cache: cache.AssemblyCache
+        :param search_paths: directories to look up imported files in
+        :param profile: profile the program, see `profiler`. The program is
+                        interpreted then, regardless of `engine`.
+        :param trace: a hook called with every executed instruction, see
+                      `tracing`. The program is interpreted then, too. Can't
+                      be combined with `profile`, the hook's time would be
+                      counted as the instructions' time.
+        :param word_size: bits per memory cell, see `MEMORY_TYPES`
+        :param memory_size: number of memory cells
+        :param checkpoint: path to save a snapshot to every `checkpoint_every`
+                           ticks, see `snapshot`
+        :param optimize: assemble programs with the peephole optimizer, see
+                         `preprocessor.optimize`
+        :param sink: where the output goes besides the in-memory copy, see
+                     `sinks`. By default, it's printed to stdout, in green
+                     on a terminal.
+        :param source: where AREAD reads from, see `sources`. By default,
+                       it's stdin.
+        :param seed: seed for `RANDOM`, a random one is chosen if None. It's
+                     taken modulo 2**64, see `rng`.
+        :param stream: the stream of the seed to draw from, e.g. one per
+                       shard of a run, see `rng`
+        :param max_ticks: stop with an error after this many ticks
+        :param timeout: stop with an error after running a program for this
+                        many seconds
+        :param check_every: check `max_ticks` and `timeout` every this many
+                            ticks
+        :param detect_cycles: stop with an error once the program repeats a
+                              state, see `cycles`. The program is interpreted
+                              without superinstructions then, regardless of
+                              `engine`.
+        """
+        if engine not in ENGINES:
+            raise ValueError('Unknown engine: {}'.format(engine))
+        if profile and trace is not None:
+            raise ValueError("Profiling and tracing can't be combined")
+
         self.testing = TESTING
         self.debug = DEBUG
+        self.engine = engine
+        self.cache = cache
+        self.search_paths = search_paths
+        self.optimize = optimize
 
-        self.tokens = None
+        #: :type: profiler.Profiler
+        self.profiler = None
+        if profile:
+            from profiler import Profiler
+            self.profiler = Profiler()
+        self.trace = trace
 
-        self.memory = [0] * MEMORY_SIZE
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+
+        #: :type: decoder.Program
+        self.program = None
+        #: :type: dict[str, Instruction]
+        self.handlers = {}
+
+        self.word_size = word_size
+        self.memory = allocate_memory(word_size, memory_size)
         self.running = True
         self.instr_pointer = 0
         self.prev_instr_pointer = 0
         self.ticks = 0
         self.jumping = False
-        self.output = StringIO()
 
-    #: :type: dict[str, Instruction]
+        if sink == STDOUT:
+            sink = Stream(color=None)
+        self.sink = sink
+        self.output = self.new_output()
+
+        if source == STDIN:
+            source = sources.Stream()
+        self.source = source
+        #: Wether the VM stopped because its source has no input yet
+        self.waiting = False
+
+        #: The values of `RANDOM`
+        self.random = Random(seed, stream)
+        #: Number of characters read so far
+        self.reads = 0
+
+        self.max_ticks = max_ticks
+        self.timeout = timeout
+        self.check_every = check_every
+        #: When the timeout is over, set once the program starts running
+        self.deadline = None
+
+        #: :type: cycles.CycleDetector
+        self.cycles = None
+        if detect_cycles:
+            from cycles import CycleDetector
+            self.cycles = CycleDetector()
+
+    #: :type: dict[str, type]
     instructions = {
         'AND': AndInstruction,
         'OR': OrInstruction,
@@ -79,20 +258,19 @@ class VirtualMachine(object):
         'HALT': HaltInstruction,
         'APRINT': AprintInstruction,
         'DPRINT': DprintInstruction,
-        'AREAD': lambda m: (m, ord(sys.stdin.read(1)))
+        'AREAD': AreadInstruction
     }
 
+    # Opcode tables, resolved once per VirtualMachine class
+    _opcode_tables = {}
+
     ###########################################################################
     # SMALL HELPERS
     ###########################################################################
 
-    def debug(self, msg):
-        if self.debug:
-            print(msg)
-
     def mem_store(self, dest, arg):
-        """ Store arg in dest. """
-        self.memory[dest] = to_uint(arg)
+        """ Store arg in dest, the memory wraps it around. """
+        self.memory[dest] = arg
 
     def mem_read(self, m):
         """ Read from a memory address. """
@@ -102,45 +280,98 @@ class VirtualMachine(object):
         """ Move the instruction pointer to dest. """
         assert dest is not None, 'Tried to jump to None'
 
-        if self.prev_instr_pointer == dest:
-            fatal_error('Stuck in infinite loop!', VirtualRuntimeError)
+        # A jump to itself keeps jumping to itself, nothing changes in
+        # between
+        if self.instr_pointer == dest:
+            self.error('Stuck in infinite loop!', VirtualRuntimeError)
+
+        # Every loop jumps back somewhere
+        elif self.cycles is not None and dest < self.instr_pointer and \
+                self.cycles(self.state(dest)):
+            self.error('Stuck in infinite loop!', VirtualRuntimeError)
 
         self.prev_instr_pointer = self.instr_pointer
 
         self.instr_pointer = dest
         self.jumping = True
 
+    def state(self, instr_pointer):
+        """
+        Get everything the rest of the run depends on, if the program
+        continues at `instr_pointer`.
+        """
+        return (instr_pointer, tuple(memory_to_list(self.memory)),
+                self.random.position, self.reads)
+
+    def location(self, address):
+        """
+        Get where the instruction at `address` comes from, None if unknown.
+
+        :rtype: sourcemap.Location
+        """
+        if self.program is None or self.program.source_map is None:
+            return None
+        return self.program.source_map.get(address)
+
+    def error(self, msg, exc_class):
+        """
+        Report a runtime error at the current instruction, after the output
+        so far
+        """
+        self.flush()
+        fatal_error(msg, exc_class, self.location(self.instr_pointer),
+                    exit_func=self.halt)
+
+    def out_of_bounds(self, decoded):
+        """ Report an instruction accessing memory that doesn't exist """
+        msg = OUT_OF_BOUNDS.format(max(memory_accesses(decoded)),
+                                   len(self.memory))
+        self.error(msg, VirtualRuntimeError)
+
     def halt(self):
         """ Stop the execution. """
         if self.testing:
             self.running = False
         else:
+            self.flush()
             sys.exit(1)
 
     ###########################################################################
-    # PROCESSING HELPERS
+    # OUTPUT
     ###########################################################################
 
-    def process_arg(self, i, annotations, opcode):
-        """
-        Process an instruction's argument.
-        """
-        mnem = opcodes[opcode]
-        arg_type = instructions[mnem][opcode][i]
-        arg = self.tokens[self.instr_pointer + i + 1]
+    def new_output(self, text=''):
+        """ Create the in-memory copy of the output """
+        if isinstance(self.sink, Null):
+            return self.sink
 
-        # Transform literals to ints
-        arg = int(arg, 0)
+        output = StringIO()
+        output.write(text)
+        return output
 
-        # Some instructions allow a parameter to be an address OR an literal
-        # but the implementation requires a literal. In this case, we need
-        # to pass the memory content instead of the address.
-        required_arg_type = list(annotations.values())[i]
+    def write(self, s):
+        self.output.write(s)
+        if self.sink is not None:
+            self.sink.write(s)
 
-        if arg_type == ADDRESS and required_arg_type == LITERAL:
-            arg = self.mem_read(arg)
+    def flush(self):
+        """ Write out the output the sink has buffered """
+        if self.sink is not None:
+            self.sink.flush()
 
-        return arg
+    def read(self):
+        """ Read a char from the source, '' at the end of the input """
+        if self.source is None:
+            return ''
+
+        c = self.source.read()
+        if c:
+            self.reads += 1
+        return c
+
+    ###########################################################################
+    # PROCESSING HELPERS
+    ###########################################################################
 
     def process_return_value(self, return_type, return_value):
         """
@@ -158,95 +389,638 @@ class VirtualMachine(object):
                 self.mem_store(dest, value)
 
     ###########################################################################
-    # THE RUN METHOD
+    # LOADING
     ###########################################################################
 
-    def run(self, asm, filename=None, preprocess=True):
-        start = timer()
+    @classmethod
+    def opcode_table(cls):
+        """ Get the opcode table for this class' instructions. """
+        try:
+            return cls._opcode_tables[cls]
+        except KeyError:
+            table = build_opcode_table(cls.instructions)
+            cls._opcode_tables[cls] = table
+            return table
 
-        # Tokenize code
-        if preprocess:
-            self.tokens = assembler.assembler_to_hex(asm, filename)
+    def load(self, code):
+        """
+        Decode the assembled program and bind the instruction handlers.
+        Object files run at the word size they were assembled for, the VM
+        switches to it if it differs.
 
-        self.tokens = self.tokens.split()
+        :param code: see `load_program`
+        """
+        if not isinstance(code, (str, Program)):
+            if not isinstance(code, objfile.ObjectFile):
+                code = objfile.loads(code)
 
-        # Main loop
-        while self.running:
-            self.jumping = False
+            if code.word_size != self.word_size:
+                self.set_word_size(code.word_size)
+
+        self.program = load_program(code, self.opcode_table(), self.word_size,
+                                    exit_func=self.halt)
+        self.instr_pointer = self.program.entry
+        self.deadline = None
+        self.bind_handlers()
+
+        if self.profiler is not None:
+            self.profiler.reset(self.program)
+
+    def set_word_size(self, word_size):
+        """ Switch the word size, the memory's values are wrapped around """
+        memory = allocate_memory(word_size, len(self.memory))
+        memory[:] = memory_to_list(self.memory)
+
+        self.word_size = word_size
+        self.memory = memory
+
+    def bind_handlers(self):
+        self.handlers = dict((mnem, instruction_class(self))
+                             for mnem, instruction_class
+                             in self.instructions.items())
+
+    ###########################################################################
+    # ENGINES
+    ###########################################################################
+
+    def superinstructions(self):
+        """
+        Get the loaded program's superinstructions, see `fusion`. The
+        optimizing engine runs counted loops as superinstructions, too.
+        """
+        optimize = self.engine == OPTIMIZING
+        key = (type(self), self.word_size, len(self.memory), optimize)
+        try:
+            return self.program.fused[key]
+        except KeyError:
+            fused = fuse(self.program, self.instructions, len(self.memory))
+            if optimize:
+                from loops import optimize_loops
+                fused = optimize_loops(self.program, self.instructions,
+                                       self.word_size, len(self.memory),
+                                       fused)
+
+            self.program.fused[key] = fused
+            return fused
+
+    def interpret(self, ticks=None):
+        """
+        Run the loaded program instruction by instruction, or rather
+        superinstruction by superinstruction where possible.
+
+        :param ticks: stop after this many instructions, even if the VM is
+                      still running
+        """
+        instructions = self.program.instructions
+        errors = self.program.errors
+        handlers = self.handlers
+        memory = self.memory
+
+        # Cycle detection has to see every jump, see `instr_jump`
+        if self.cycles is None:
+            fused = self.superinstructions()
+        else:
+            fused = [None] * len(self.program)
+
+        stop = float('inf') if ticks is None else self.ticks + ticks
+
+        while self.running and self.ticks != stop:
+            instr_pointer = self.instr_pointer
 
             # Check bounds of instr_pointer
-            if self.instr_pointer >= len(self.tokens):
-                fatal_error('Reached end of code without seeing HALT',
-                            MissingHaltError, exit_func=self.halt)
-
-            # Get current opcode
-            opcode = self.tokens[self.instr_pointer]
-            mnem = opcodes[opcode].upper()
-
-            if self.debug:
-                print('Instruction: {} ({})'.format(mnem, opcode))
-
-            # Look up instruction
-            instruction_class = self.instructions[mnem]
-            instruction = instruction_class(self)
-            instruction_spec = instructions[mnem]
-            annotations = get_annotations(instruction)
-
-            # Look up number of arguments
-            num_args = len(list(instruction_spec.values())[0])
-
-            if self.debug:
-                print('Number of args:', num_args)
-                print('Argument spec:', instruction_spec[opcode])
-
-            # Collect arguments
-            if num_args:
-                try:
-                    args = [self.process_arg(i, annotations, opcode)
-                            for i in range(num_args)]
-                except IndexError:
-                    msg = 'Unexpectedly reached EOF. Maybe an argument is ' \
-                          'missing or a messed up jump occured'
-                    fatal_error(msg, VirtualRuntimeError, exit_func=self.halt)
-            else:
-                args = []
+            try:
+                decoded = instructions[instr_pointer]
+            except IndexError:
+                self.error('Reached end of code without seeing HALT',
+                           MissingHaltError)
+                continue
+
+            # Run a whole sequence at once, unless it would run past `stop`
+            superinstruction = fused[instr_pointer]
+            if superinstruction is not None and \
+                    self.ticks + superinstruction.size <= stop:
+                self.instr_pointer, self.prev_instr_pointer, executed = \
+                    superinstruction(self, memory, self.prev_instr_pointer,
+                                     stop)
+                self.ticks += executed
+                continue
 
-            if self.debug:
-                print('Arguments:', args)
+            self.jumping = False
 
-            # Run instruction
-            return_value = instruction(*args)
+            if decoded is None:
+                msg, exc_class = errors[instr_pointer]
+                self.error(msg, exc_class)
+                continue
 
-            # Process return value
+            # Collect arguments, run the instruction and process its return
+            # value. Only memory accesses raise IndexErrors.
             try:
-                return_type = annotations['return']
-            except KeyError:
-                return_type = None
-            self.process_return_value(return_type, return_value)
+                args = decoded.args
+                if decoded.deref is not None:
+                    args = [memory[arg] if deref else arg
+                            for arg, deref in zip(args, decoded.deref)]
+
+                return_value = handlers[decoded.mnem](*args)
+                if return_value is not None:
+                    self.process_return_value(decoded.return_type,
+                                              return_value)
+            except IndexError:
+                self.out_of_bounds(decoded)
+                continue
 
             # Increase counters
             self.ticks += 1
             if not self.jumping:
-                self.prev_instr_pointer = self.instr_pointer
-                self.instr_pointer += 1  # Skip current opcode
-                self.instr_pointer += num_args  # Skip arguments
+                self.prev_instr_pointer = instr_pointer
+                self.instr_pointer = instr_pointer + decoded.size
+
+    def interpret_profiled(self, ticks=None):
+        """
+        Run the loaded program like `interpret`, but count the executions
+        and measure the time of every instruction.
+        """
+        instructions = self.program.instructions
+        errors = self.program.errors
+        handlers = self.handlers
+        memory = self.memory
+        counts = self.profiler.counts
+        times = self.profiler.times
+
+        stop = None if ticks is None else self.ticks + ticks
+
+        while self.running and self.ticks != stop:
+            self.jumping = False
+            instr_pointer = self.instr_pointer
+
+            try:
+                decoded = instructions[instr_pointer]
+            except IndexError:
+                self.error('Reached end of code without seeing HALT',
+                           MissingHaltError)
+                continue
+
+            if decoded is None:
+                msg, exc_class = errors[instr_pointer]
+                self.error(msg, exc_class)
+                continue
+
+            start = timer()
+
+            try:
+                args = decoded.args
+                if decoded.deref is not None:
+                    args = [memory[arg] if deref else arg
+                            for arg, deref in zip(args, decoded.deref)]
+
+                return_value = handlers[decoded.mnem](*args)
+                if return_value is not None:
+                    self.process_return_value(decoded.return_type,
+                                              return_value)
+            except IndexError:
+                self.out_of_bounds(decoded)
+                continue
+
+            times[instr_pointer] += timer() - start
+            counts[instr_pointer] += 1
+
+            self.ticks += 1
+            if not self.jumping:
+                self.prev_instr_pointer = instr_pointer
+                self.instr_pointer = instr_pointer + decoded.size
+
+    def interpret_traced(self, ticks=None):
+        """
+        Run the loaded program like `interpret`, but pass every executed
+        instruction on to the trace hook.
+        """
+        instructions = self.program.instructions
+        errors = self.program.errors
+        handlers = self.handlers
+        memory = self.memory
+        trace = self.trace
+
+        from tracing import Event
+
+        stop = None if ticks is None else self.ticks + ticks
+
+        while self.running and self.ticks != stop:
+            self.jumping = False
+            instr_pointer = self.instr_pointer
+
+            try:
+                decoded = instructions[instr_pointer]
+            except IndexError:
+                self.error('Reached end of code without seeing HALT',
+                           MissingHaltError)
+                continue
+
+            if decoded is None:
+                msg, exc_class = errors[instr_pointer]
+                self.error(msg, exc_class)
+                continue
+
+            writes = ()
+            try:
+                args = decoded.args
+                if decoded.deref is not None:
+                    args = [memory[arg] if deref else arg
+                            for arg, deref in zip(args, decoded.deref)]
+
+                return_value = handlers[decoded.mnem](*args)
+                if return_value is not None:
+                    self.process_return_value(decoded.return_type,
+                                              return_value)
+
+                    if decoded.return_type == ReturnValue.DATA:
+                        dest = return_value[0]
+                        writes = ((dest, memory[dest]),)
+            except IndexError:
+                self.out_of_bounds(decoded)
+                continue
+
+            trace(Event(self.ticks, instr_pointer, decoded.opcode,
+                        decoded.mnem, tuple(args), writes,
+                        self.instr_pointer if self.jumping else None))
+
+            self.ticks += 1
+            if not self.jumping:
+                self.prev_instr_pointer = instr_pointer
+                self.instr_pointer = instr_pointer + decoded.size
+
+    def run_compiled(self, ticks=None):
+        """
+        Run the loaded program compiled to a Python function.
+
+        :param ticks: see `interpret`
+        """
+        key = (type(self), self.word_size, len(self.memory))
+        try:
+            compiled = self.program.compiled[key]
+        except KeyError:
+            compiled = compile_program(self.program, self.instructions,
+                                       self.word_size, len(self.memory))
+            self.program.compiled[key] = compiled
+
+        stop = float('inf') if ticks is None else self.ticks + ticks
+
+        while self.running and self.ticks < stop:
+            # The compiled code works on a list, copy the memory back once
+            # it returns
+            memory = memory_to_list(self.memory)
+            try:
+                state = compiled(self, memory, self.handlers,
+                                 self.instr_pointer, self.prev_instr_pointer,
+                                 self.ticks, stop)
+            finally:
+                list_to_memory(self.memory, memory)
+
+            self.instr_pointer, self.prev_instr_pointer, self.ticks = state
+
+            if not self.running or self.waiting or self.ticks >= stop:
+                break
+
+            if self.instr_pointer in compiled.leaders:
+                # The next block would run past `stop`
+                self.interpret(stop - self.ticks)
+
+            # Jumped to an address that isn't compiled yet
+            elif not compiled.add_block(self.instr_pointer):
+                # Nothing to execute there, let the interpreter report it
+                self.interpret()
+
+    def run_engine(self, ticks=None):
+        """
+        Run the loaded program on the selected engine.
+
+        :param ticks: see `interpret`
+        """
+        if self.profiler is not None:
+            self.interpret_profiled(ticks)
+        elif self.trace is not None:
+            self.interpret_traced(ticks)
+        elif self.engine == COMPILED and self.cycles is None:
+            self.run_compiled(ticks)
+        else:
+            self.interpret(ticks)
+
+    def run_limited(self, ticks=None):
+        """
+        Run the loaded program like `run_engine`, but stop with an error
+        once it exceeds `max_ticks` or `timeout`. They're checked every
+        `check_every` ticks.
+        """
+        stop = None if ticks is None else self.ticks + ticks
+        if self.timeout is not None and self.deadline is None:
+            self.deadline = timer() + self.timeout
+
+        while self.running and not self.waiting and self.ticks != stop:
+            if self.max_ticks is not None and self.ticks >= self.max_ticks:
+                msg = 'Exceeded the budget of {} ticks'.format(self.max_ticks)
+                self.error(msg, VirtualRuntimeError)
+                break
+
+            if self.deadline is not None and timer() >= self.deadline:
+                msg = 'Exceeded the timeout of {}s'.format(self.timeout)
+                self.error(msg, VirtualRuntimeError)
+                break
+
+            chunk = self.check_every
+            if stop is not None:
+                chunk = min(chunk, stop - self.ticks)
+            if self.max_ticks is not None:
+                chunk = min(chunk, self.max_ticks - self.ticks)
+
+            self.run_engine(chunk)
+
+    def execute(self, ticks=None):
+        """
+        Run the loaded program on the selected engine, within the budgets.
+
+        Stops early if the source has no input yet, see `waiting`.
+
+        :param ticks: see `interpret`
+        """
+        self.waiting = False
+
+        try:
+            if self.max_ticks is None and self.timeout is None:
+                self.run_engine(ticks)
+            else:
+                self.run_limited(ticks)
+        except InputPending:
+            # The engines stop right before the AREAD
+            self.waiting = True
+        finally:
+            self.flush()
+
+    ###########################################################################
+    # SNAPSHOTS
+    ###########################################################################
+
+    def fork(self):
+        """
+        Create a VM that continues from the current state, e.g. to run it
+        with different inputs.
+
+        The new VM shares the decoded (and compiled) program. Its memory
+        shares its pages with this VM's memory until either VM writes to a
+        page, see `paging`.
+
+        :rtype: VirtualMachine
+        """
+        if not isinstance(self.memory, PagedMemory):
+            self.memory = PagedMemory.from_memory(self.memory)
+
+        import copy
+
+        child = copy.copy(self)
+        child.memory = self.memory.fork()
+        child.output = child.new_output(self.output.getvalue())
+        child.random = self.random.copy()
+        child.deadline = None  # The child gets a timeout of its own
+        if self.cycles is not None:
+            child.cycles = type(self.cycles)()
+        child.bind_handlers()
+        child.checkpoint = None  # Don't overwrite this VM's checkpoints
 
-            if self.debug:
-                print('Memory:', self.memory)
-                print()
-                print()
+        if self.profiler is not None:
+            child.profiler = type(self.profiler)()
+            child.profiler.reset(self.program)
 
-        if self.debug:
+        return child
+
+    def snapshot(self):
+        """
+        Take a snapshot of the current state, see `snapshot`.
+
+        :rtype: bytes
+        """
+        import snapshot
+        return snapshot.dumps(self)
+
+    def restore(self, state):
+        """
+        Restore a snapshot. The VM takes over the snapshot's word and memory
+        size and its program, call `resume` to continue running it.
+
+        :param state: a snapshot as bytes-like object or already loaded
+        """
+        import snapshot
+
+        if not isinstance(state, snapshot.Snapshot):
+            state = snapshot.loads(state)
+
+        self.word_size = state.word_size
+        self.memory = allocate_memory(state.word_size, state.memory_size)
+        snapshot.set_memory_bytes(self.memory, state.memory)
+
+        self.load(state.program)
+        self.running = state.running
+        self.instr_pointer = state.instr_pointer
+        self.prev_instr_pointer = state.prev_instr_pointer
+        self.ticks = state.ticks
+        self.jumping = False
+
+        self.output = self.new_output(state.output)
+
+        seed, stream, position = state.random
+        self.random = Random(seed, stream)
+        self.random.seek(position)
+
+    ###########################################################################
+    # THE RUN METHOD
+    ###########################################################################
+
+    def run(self, asm, filename=None, preprocess=True):
+        start = timer()
+        self.load_source(asm, filename, preprocess)
+        return self.resume(start)
+
+    async def run_async(self, asm, filename=None, preprocess=True,
+                        quantum=QUANTUM):
+        """ Run a program like `run`, see `resume_async` """
+        self.load_source(asm, filename, preprocess)
+        return await self.resume_async(quantum)
+
+    def load_source(self, asm, filename=None, preprocess=True):
+        """
+        Assemble the program if it's source code and load it.
+        """
+        symbols, source_map = None, None
+        if preprocess and isinstance(asm, str):
+            import assembler
+
+            # Keep the symbol table and the source map, unless the program
+            # comes from the cache
+            if self.cache is None or self.profiler is not None:
+                symbols = {}
+                source_map = SourceMap()
+
+            asm = assembler.assembler_to_hex(asm, filename, cache=self.cache,
+                                             search_paths=self.search_paths,
+                                             symbols=symbols,
+                                             source_map=source_map,
+                                             optimize=self.optimize)
+
+        self.load(asm)
+        if symbols:
+            self.program.symbols = symbols
+        if source_map is not None:
+            self.program.source_map = source_map
+
+    def resume(self, start=None):
+        """
+        Continue running the loaded program, e.g. after `restore`. Returns
+        the output, including the output from before the snapshot.
+
+        Returns early if the source has no input yet, see `waiting`.
+        """
+        if start is None:
+            start = timer()
+
+        if self.checkpoint is not None and self.checkpoint_every:
+            import snapshot
+
+            while self.running:
+                self.execute(self.checkpoint_every)
+                if self.running:
+                    snapshot.save(self, self.checkpoint)
+                if self.waiting:
+                    break
+        else:
+            self.execute()
+
+        if self.debug and not self.waiting:
             print()
             print('Exited after {} ticks in {:.5}s'.format(self.ticks,
                                                            timer() - start))
 
         return self.output.getvalue()
 
+    async def resume_async(self, quantum=QUANTUM):
+        """
+        Continue running the loaded program like `resume`, but wait for input
+        without blocking the event loop, see `sources.AsyncStream`.
+
+        :param quantum: yield to the event loop every `quantum` ticks, so
+                        other tasks (e.g. VMs) get to run, see `scheduler`.
+                        None only yields while waiting for input.
+        """
+        import asyncio
+
+        while self.running:
+            self.execute(quantum)
+
+            if self.waiting:
+                await self.source.wait()
+            elif self.running:
+                await asyncio.sleep(0)
+
+        return self.output.getvalue()
+
 
 def main():
-    filename = sys.argv[1]
-    VirtualMachine().run(open(filename).read(), filename)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Tiny-ASM virtual machine')
+    parser.add_argument('filename',
+                        help='.asm or object file, or with --batch the jobs')
+    parser.add_argument('--engine', choices=ENGINES, default=INTERPRETER)
+    parser.add_argument('-I', dest='search_paths', action='append',
+                        default=[], metavar='DIR',
+                        help='add a directory to look up imports in')
+    parser.add_argument('-O', dest='optimize', action='store_true',
+                        help='remove code without effect when assembling')
+    parser.add_argument('--no-color', dest='color', action='store_false',
+                        help="don't print the output in color")
+    parser.add_argument('--batch', action='store_true',
+                        help='run the jobs in a JSON lines file, see `batch`')
+    parser.add_argument('--processes', type=int,
+                        help='number of worker processes for --batch')
+    parser.add_argument('--profile', action='store_true',
+                        help='print a profile of the program after running')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='write the profile as JSON to FILE')
+    parser.add_argument('--trace', action='store_true',
+                        help='print every executed instruction to stderr')
+    parser.add_argument('--trace-every', type=int, default=1, metavar='N',
+                        help='only print every N-th instruction')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='save a snapshot of the VM to FILE regularly')
+    parser.add_argument('--checkpoint-every', type=int, default=1000000,
+                        metavar='N', help='save the snapshot every N ticks')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue running the snapshot in filename')
+    parser.add_argument('--max-ticks', type=int, metavar='N',
+                        help='stop with an error after N ticks')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='stop with an error after running that long')
+    parser.add_argument('--detect-cycles', action='store_true',
+                        help='stop with an error once the program repeats '
+                             'a state (interprets the program)')
+    parser.add_argument('--seed', type=int,
+                        help='seed for RANDOM, a random one by default')
+    parser.add_argument('--stream', type=int, default=0,
+                        help='the stream of the seed to draw from, see `rng`')
+    args = parser.parse_args()
+
+    filename = args.filename
+
+    if args.batch:
+        import batch
+        batch.main(filename, args.processes, args.engine)
+        return
+
+    with open(filename, 'rb') as f:
+        is_object = objfile.is_object(f.read(len(objfile.MAGIC)))
+
+    trace = None
+    if args.trace:
+        from tracing import Printer, Sampler
+        # Looks up the lines in the program `vm` loads below
+        trace = Printer(locate=lambda address: vm.location(address))
+        if args.trace_every > 1:
+            trace = Sampler(trace, args.trace_every)
+
+    profile = args.profile or args.profile_json is not None
+    if profile and trace is not None:
+        parser.error("--trace can't be combined with --profile or "
+                     "--profile-json")
+
+    interactive = sys.stdout.isatty()
+    if interactive and args.color:
+        # Translates the colors on Windows
+        import colorama
+        colorama.init()
+
+    sink = Stream(color=args.color and interactive,
+                  line_buffering=interactive)
+    vm = VirtualMachine(args.engine, search_paths=args.search_paths,
+                        profile=profile, trace=trace,
+                        checkpoint=args.checkpoint,
+                        checkpoint_every=args.checkpoint_every,
+                        optimize=args.optimize, sink=sink, seed=args.seed,
+                        stream=args.stream, max_ticks=args.max_ticks,
+                        timeout=args.timeout,
+                        detect_cycles=args.detect_cycles)
+    try:
+        if args.resume:
+            import snapshot
+            vm.restore(snapshot.load(filename))
+            # Print the output from before the snapshot again
+            sink.write(vm.output.getvalue())
+            vm.resume()
+        elif is_object:
+            vm.run(objfile.load(filename))
+        else:
+            vm.run(open(filename).read(), filename)
+    finally:
+        # HALT exits right away, report the profile anyway
+        if args.profile:
+            print()
+            print(vm.profiler.report())
+        if args.profile_json is not None:
+            vm.profiler.dump(args.profile_json)
 
 if __name__ == '__main__':
     main()